@@ -0,0 +1,126 @@
+"""
+Compare the cost of encoding batches of spans.
+
+Run this with ``python -m benchmarks.encoding`` from the root of the
+source tree.  Each row encodes a batch of spans that look like
+finished requests.  The *json* row builds a dictionary for each span
+and dumps the list in the same manner as a naive JSON reporter would.
+The *pickle* row is the default encoding of
+:class:`divak.reporting.SpoolingReporter`, the *SpanBatch* row is
+:func:`divak.encoding.encode_spans`, and the *zipkin* row is the request
+body that :class:`divak.zipkin.ZipkinReporter` sends.  Multiplying the
+*us/span* column by the request rate gives the share of a CPU that
+exporting every request costs.
+
+The columns are the CPU time and the encoded size per span, the
+memory that the intermediate representation holds per span, and the
+peak number of bytes traced by :mod:`tracemalloc` per span while
+encoding.
+
+"""
+import json
+import pickle
+import timeit
+import tracemalloc
+
+import divak.encoding
+import divak.tracing
+import divak.zipkin
+
+
+def create_spans(count):
+    spans = []
+    for index in range(count):
+        span = divak.tracing.Span(1000.0 + index)
+        span.prepare_start = span.start + 0.0001
+        span.prepare_end = span.start + 0.0002
+        span.first_byte = span.start + 0.004
+        span.finish = span.start + 0.005
+        span.service = 'orders'
+        span.route = divak.tracing.intern('/orders/(?P<order_id>\\d+)')
+        span.method = 'GET'
+        span.uri = '/orders/{}'.format(index)
+        span.request_id = '8d7f6a0e-4b4e-4f4a-9f55-{:012d}'.format(index)
+        span.status = 200
+        spans.append(span)
+    return spans
+
+
+def to_dicts(spans):
+    return [{'service': span.service, 'route': span.route,
+             'method': span.method, 'uri': span.uri,
+             'request_id': span.request_id, 'status': span.status,
+             'trace_id': span.trace_id, 'span_id': span.span_id,
+             'parent_id': span.parent_id, 'start': span.start,
+             'prepare_start': span.prepare_start,
+             'prepare_end': span.prepare_end,
+             'first_byte': span.first_byte, 'finish': span.finish}
+            for span in spans]
+
+
+def encode_json(spans):
+    return json.dumps(to_dicts(spans)).encode('utf-8')
+
+
+def encode_pickle(spans):
+    return pickle.dumps(spans, 2)
+
+
+ZIPKIN = divak.zipkin.ZipkinReporter()
+
+
+def encode_zipkin(spans):
+    encoded = []
+    for span in spans:
+        ZIPKIN.encode(span, 0.0, encoded)
+    return ('[' + ','.join(encoded) + ']').encode('utf-8')
+
+
+ENCODERS = [
+    ('json', to_dicts, encode_json),
+    ('pickle', None, encode_pickle),
+    ('SpanBatch', divak.encoding.SpanBatch, divak.encoding.encode_spans),
+    ('zipkin', None, encode_zipkin),
+]
+
+
+def retained(build, spans):
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        held = build(spans)
+        current, _ = tracemalloc.get_traced_memory()
+        del held
+    finally:
+        tracemalloc.stop()
+    return (current - start) / float(len(spans))
+
+
+def peak(encode, spans):
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        encode(spans)
+        _, high = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (high - start) / float(len(spans))
+
+
+def main():
+    count = 1000
+    spans = create_spans(count)
+    print('{:<12} {:>10} {:>10} {:>12} {:>12}'.format(
+        'encoding', 'us/span', 'B/span', 'held B/span', 'peak B/span'))
+    for name, build, encode in ENCODERS:
+        elapsed = min(timeit.repeat(lambda: encode(spans), number=20,
+                                    repeat=5))
+        size = len(encode(spans)) / float(count)
+        held = retained(build, spans) if build is not None else 0.0
+        print('{:<12} {:10.2f} {:10.1f} {:12.1f} {:12.1f}'.format(
+            name, elapsed / 20 / count * 1e6, size, held,
+            peak(encode, spans)))
+
+
+if __name__ == '__main__':
+    main()
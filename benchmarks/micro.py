@@ -0,0 +1,186 @@
+"""
+Microbenchmarks for the divak functions that run on every request.
+
+Run this with ``python -m benchmarks.micro`` from the root of the
+source tree.  It measures the first call to
+:func:`divak.internals.initialize_logging` against the legacy logger
+scan with increasing numbers of existing loggers, the cost of emitting
+a record with the request ID, :meth:`divak.api.Recorder.log_request`
+against the Tornado implementation, :meth:`divak.api.Logger.prepare`
+against the previous :func:`tornado.gen.coroutine` implementation, and
+the per-request transforms.
+
+"""
+import logging
+import timeit
+
+from tornado import gen, httputil, web
+
+import benchmarks.overhead
+import benchmarks.transforms
+import divak.api
+import divak.internals
+import divak.tracing
+
+
+def report(name, elapsed, number, unit='us', scale=1e6):
+    print('{:<40} {:10.2f} {}'.format(name, elapsed / number * scale, unit))
+
+
+def bench_initialize_logging():
+    saved_factory = logging.getLogRecordFactory()
+    saved_class = logging.getLoggerClass()
+    initializers = [
+        ('legacy scan', divak.internals._initialize_legacy_logging),
+        ('record factory', divak.internals.initialize_logging),
+    ]
+    for count in (10, 1000, 10000):
+        created = ['benchmarks.micro.logger{}'.format(n)
+                   for n in range(count)]
+        handlers = [logging.NullHandler() for _ in created]
+        for name, handler in zip(created, handlers):
+            logging.getLogger(name).addHandler(handler)
+
+        def uninitialize():
+            logging.setLogRecordFactory(logging.LogRecord)
+            logging.setLoggerClass(saved_class)
+            for handler in handlers:
+                del handler.filters[:]
+
+        for name, initialize in initializers:
+            elapsed = min(timeit.repeat(initialize, setup=uninitialize,
+                                        number=1, repeat=5))
+            report('{} ({} loggers)'.format(name, count), elapsed, 1)
+        for name in created:
+            logging.Logger.manager.loggerDict.pop(name, None)
+    logging.setLogRecordFactory(saved_factory)
+    logging.setLoggerClass(saved_class)
+
+
+class FormattingHandler(logging.Handler):
+
+    def emit(self, record):
+        self.format(record)
+
+
+def bench_record_emit():
+    number = 100000
+    request = httputil.HTTPServerRequest(uri='/')
+    request.divak_request_id = 'request-id'
+    handler = FormattingHandler()
+    handler.setFormatter(logging.Formatter(
+        '%(levelname)s %(divak_request_id)s %(message)s'))
+    legacy_handler = FormattingHandler()
+    legacy_handler.setFormatter(handler.formatter)
+    legacy_handler.addFilter(divak.internals.DivakRequestIdFilter())
+
+    configurations = [
+        ('DivakLogger + filter', divak.internals.DivakLogger,
+         legacy_handler, logging.LogRecord),
+        ('record factory', logging.Logger, handler,
+         divak.internals.RequestIdLogRecord),
+    ]
+    saved_factory = logging.getLogRecordFactory()
+    token = divak.internals.active_request.set(request)
+    try:
+        for name, logger_class, log_handler, record_factory in configurations:
+            logger = logger_class('benchmarks.micro.emit')
+            logger.addHandler(log_handler)
+            logger.propagate = False
+            logging.setLogRecordFactory(record_factory)
+            elapsed = min(timeit.repeat(lambda: logger.info('message'),
+                                        number=number, repeat=5))
+            report('emit record ({})'.format(name), elapsed, number)
+    finally:
+        divak.internals.active_request.reset(token)
+        logging.setLogRecordFactory(saved_factory)
+
+
+def create_finished_handler(app):
+    request = httputil.HTTPServerRequest(
+        method='GET', uri='/', connection=benchmarks.overhead.NullConnection(),
+        headers=httputil.HTTPHeaders({'User-Agent': 'divak-benchmark'}))
+    for transform in app.transforms:
+        transform(request)
+    handler = benchmarks.overhead.PlainHandler(app, request)
+    handler.set_status(200)
+    request._finish_time = request._start_time + 0.001
+    return handler
+
+
+def bench_log_request():
+    number = 100000
+    for name, factory in benchmarks.overhead.CONFIGURATIONS[:3]:
+        app = factory()
+        handler = create_finished_handler(app)
+        elapsed = min(timeit.repeat(lambda: app.log_request(handler),
+                                    number=number, repeat=5))
+        report('log_request ({})'.format(name), elapsed, number)
+
+
+class LoggerHandler(divak.api.Logger, web.RequestHandler):
+    pass
+
+
+class CoroutineLoggerHandler(LoggerHandler):
+    """The :func:`tornado.gen.coroutine` implementation of prepare."""
+
+    @gen.coroutine
+    def prepare(self):
+        span = getattr(self.request, 'divak_span', None)
+        if span is not None:
+            span.prepare_start = divak.tracing.monotonic()
+
+        if not hasattr(self, 'logger'):
+            self.logger = logging.getLogger('{}.{}'.format(
+                self.__class__.__module__, self.__class__.__name__))
+        buffer_size = self.settings.get('divak_log_buffer_size', None)
+        if buffer_size:
+            self.logger = divak.internals.BufferingLogger(self.logger,
+                                                          buffer_size)
+
+        maybe_future = super(divak.api.Logger, self).prepare()
+        if maybe_future:
+            yield maybe_future
+
+        if span is not None:
+            span.prepare_end = divak.tracing.monotonic()
+
+
+def bench_prepare():
+    number = 100000
+    app = benchmarks.overhead.CONFIGURATIONS[1][1]()
+    for name, handler_class in (('gen.coroutine', CoroutineLoggerHandler),
+                                ('synchronous', LoggerHandler)):
+        request = httputil.HTTPServerRequest(
+            method='GET', uri='/',
+            connection=benchmarks.overhead.NullConnection())
+        for transform in app.transforms:
+            transform(request)
+        handler = handler_class(app, request)
+        elapsed = min(timeit.repeat(handler.prepare, number=number,
+                                    repeat=5))
+        report('Logger.prepare ({})'.format(name), elapsed, number)
+
+
+def bench_transforms():
+    number = 50000
+    for count in (0, 1, 5):
+        propagators = benchmarks.transforms.create_propagators(count)
+        transforms = benchmarks.transforms.combined_transforms(propagators)
+        cost = benchmarks.transforms.measure(transforms, number)
+        report('transforms ({} propagators)'.format(count), cost, 1,
+               scale=1)
+
+
+def main():
+    benchmarks.overhead.configure_logging()
+    bench_initialize_logging()
+    bench_record_emit()
+    bench_log_request()
+    bench_prepare()
+    bench_transforms()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+Measure the overhead that divak adds to request processing.
+
+Run this with ``python -m benchmarks.overhead`` from the root of the
+source tree.  Each configuration in :data:`CONFIGURATIONS` is served
+from a child process on a localhost port while the parent process
+drives it from keep-alive connections and records the latency of
+every request.  The report includes requests per second, the median
+and 99th percentile latency, and the number of memory blocks and
+bytes that each request leaves allocated.
+
+The allocation figures are measured separately in-process by feeding
+requests directly into the application's HTTP message delegate so
+that client and socket allocations are excluded.  They are the
+differences between :mod:`tracemalloc` snapshots taken before and
+after the measured requests divided by the number of requests.
+Memory that is allocated and released within a request does not
+appear in these figures; they show what the requests retain such as
+queued observations, cache entries, and leaks.
+
+"""
+import argparse
+import logging
+import multiprocessing
+import socket
+import threading
+import tracemalloc
+
+from tornado import concurrent, gen, httpserver, httputil, ioloop, netutil
+from tornado import web
+
+import divak.api
+import divak.tracing
+
+
+class PlainHandler(web.RequestHandler):
+
+    def get(self):
+        self.write('ok')
+
+
+class LoggingHandler(divak.api.Logger, web.RequestHandler):
+
+    def get(self):
+        self.logger.info('processing request')
+        self.write('ok')
+
+
+class RecorderApplication(divak.api.Recorder, web.Application):
+    pass
+
+
+def plain_application():
+    return web.Application([web.url('/', PlainHandler)])
+
+
+def recorder_application():
+    return RecorderApplication([web.url('/', PlainHandler)])
+
+
+def propagator_application():
+    app = recorder_application()
+    app.add_divak_propagator(divak.api.RequestIdPropagator())
+    return app
+
+
+def logger_application():
+    return RecorderApplication([web.url('/', LoggingHandler)])
+
+
+CONFIGURATIONS = [
+    ('tornado.web.Application', plain_application),
+    ('Recorder', recorder_application),
+    ('Recorder + propagator', propagator_application),
+    ('Recorder + Logger', logger_application),
+]
+"""``(name, application factory)`` pairs that are measured."""
+
+REQUEST = (b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+           b'User-Agent: divak-benchmark\r\n\r\n')
+
+
+def configure_logging():
+    """
+    Send every log record to a :class:`logging.NullHandler`.
+
+    Records are created and access log messages are formatted as
+    they would be in production without the cost of writing them.
+
+    """
+    root = logging.getLogger()
+    root.handlers[:] = [logging.NullHandler()]
+    root.setLevel(logging.INFO)
+
+
+class NullConnection(object):
+    """
+    Minimal :class:`tornado.httputil.HTTPConnection` that discards output.
+
+    :attr:`finished` is resolved when the response is finished.  Call
+    :meth:`.reset` before each request.
+
+    """
+
+    def __init__(self):
+        self.finished = None
+        self.reset()
+
+    def reset(self):
+        self.finished = concurrent.Future()
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        return self._complete(callback)
+
+    def write(self, chunk, callback=None):
+        return self._complete(callback)
+
+    def finish(self):
+        self.finished.set_result(None)
+
+    @staticmethod
+    def _complete(callback):
+        if callback is not None:  # tornado < 5
+            callback()
+        future = concurrent.Future()
+        future.set_result(None)
+        return future
+
+
+@gen.coroutine
+def run_request(app, connection):
+    """
+    Process a single ``GET /`` request without a network connection.
+
+    :param tornado.web.Application app: the application to call
+    :param NullConnection connection: connection to write the response
+        to
+
+    """
+    connection.reset()
+    delegate = app.start_request(None, connection)
+    delegate.headers_received(
+        httputil.RequestStartLine('GET', '/', 'HTTP/1.1'),
+        httputil.HTTPHeaders({'Host': '127.0.0.1',
+                              'User-Agent': 'divak-benchmark'}))
+    delegate.finish()
+    yield connection.finished
+
+
+@gen.coroutine
+def measure_allocations(app, requests):
+    """
+    Measure the memory that requests leave allocated.
+
+    :param tornado.web.Application app: the application to call
+    :param int requests: the number of requests to average over
+    :return: the net number of memory blocks and bytes per request
+    :rtype: tuple
+
+    """
+    connection = NullConnection()
+    for _ in range(100):  # warm up caches
+        yield run_request(app, connection)
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, __file__)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        for _ in range(requests):
+            yield run_request(app, connection)
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+    finally:
+        tracemalloc.stop()
+
+    blocks = size = 0
+    for stat in after.compare_to(before, 'filename'):
+        blocks += stat.count_diff
+        size += stat.size_diff
+    return blocks / requests, size / requests
+
+
+def serve(factory, sockets):
+    configure_logging()
+    server = httpserver.HTTPServer(factory())
+    server.add_sockets(sockets)
+    ioloop.IOLoop.current().start()
+
+
+def read_response(sock, buffer):
+    while True:
+        head_end = buffer.find(b'\r\n\r\n')
+        if head_end >= 0:
+            head = buffer[:head_end].lower()
+            length_start = head.index(b'content-length:') + 15
+            length_end = head.find(b'\r\n', length_start)
+            if length_end < 0:
+                length_end = len(head)
+            total = head_end + 4 + int(head[length_start:length_end])
+            if len(buffer) >= total:
+                return buffer[total:]
+        data = sock.recv(65536)
+        if not data:
+            raise RuntimeError('server closed connection')
+        buffer += data
+
+
+def drive(port, deadline, latencies):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buffer = b''
+    clock = divak.tracing.monotonic
+    try:
+        while clock() < deadline:
+            start = clock()
+            sock.sendall(REQUEST)
+            buffer = read_response(sock, buffer)
+            latencies.append(clock() - start)
+    finally:
+        sock.close()
+
+
+def measure_throughput(factory, duration, connections):
+    """
+    Measure an application over localhost.
+
+    :param factory: callable that returns the application to serve
+    :param float duration: number of seconds to generate load for
+    :param int connections: number of concurrent client connections
+    :return: requests per second and the sorted request latencies
+    :rtype: tuple
+
+    """
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = multiprocessing.Process(target=serve, args=(factory, sockets))
+    server.daemon = True
+    server.start()
+    for sock in sockets:
+        sock.close()
+    try:
+        # warm up the server and make sure that it is listening
+        drive(port, divak.tracing.monotonic() + 0.5, [])
+
+        latencies = []
+        deadline = divak.tracing.monotonic() + duration
+        threads = [threading.Thread(target=drive,
+                                    args=(port, deadline, latencies))
+                   for _ in range(connections)]
+        started = divak.tracing.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = divak.tracing.monotonic() - started
+    finally:
+        server.terminate()
+        server.join()
+    latencies.sort()
+    return len(latencies) / elapsed, latencies
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds of load per configuration')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='number of concurrent client connections')
+    parser.add_argument('--allocation-requests', type=int, default=2000,
+                        help='number of requests to trace allocations for')
+    args = parser.parse_args()
+
+    configure_logging()
+    print('{:<26} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        '', 'req/s', 'p50 (us)', 'p99 (us)', 'net blk/req',
+        'net B/req'))
+    for name, factory in CONFIGURATIONS:
+        rate, latencies = measure_throughput(factory, args.duration,
+                                             args.connections)
+        app = factory()
+        blocks, size = ioloop.IOLoop.current().run_sync(
+            lambda: measure_allocations(app, args.allocation_requests))
+        print('{:<26} {:10.0f} {:10.1f} {:10.1f} {:12.2f} {:12.1f}'.format(
+            name, rate, percentile(latencies, 0.50) * 1e6,
+            percentile(latencies, 0.99) * 1e6, blocks, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+Compare the cost of the request ID factories.
+
+Run this with ``python -m benchmarks.request_ids`` from the root of
+the source tree.
+
+"""
+import timeit
+import uuid
+
+import divak.api
+
+
+def uuid4_factory():
+    return str(uuid.uuid4())
+
+
+def main():
+    number = 200000
+    factories = [
+        ('str(uuid.uuid4())', uuid4_factory),
+        ('RandomIdFactory', divak.api.RandomIdFactory()),
+        ('SequentialIdFactory', divak.api.SequentialIdFactory()),
+    ]
+    baseline = None
+    for name, factory in factories:
+        elapsed = min(timeit.repeat(factory, number=number, repeat=5))
+        per_call = elapsed / number * 1e9
+        if baseline is None:
+            baseline = per_call
+        print('{:<20} {:8.1f} ns/id {:6.2f}x'.format(
+            name, per_call, baseline / per_call))
+
+
+if __name__ == '__main__':
+    main()
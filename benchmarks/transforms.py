@@ -0,0 +1,110 @@
+"""
+Compare the per-request cost of the divak transforms.
+
+Run this with ``python -m benchmarks.transforms`` from the root of
+the source tree.  The *chain* rows install a separate transform per
+propagator in the same manner as the 0.0.3 release did.  The
+*combined* rows use the single :class:`divak.internals.RequestTransform`
+that :class:`divak.api.Recorder` installs.  The requests and response
+headers are created before the timer is started.
+
+"""
+import functools
+import gc
+
+from tornado import httputil
+
+import divak.api
+import divak.internals
+import divak.tracing
+
+
+def create_propagators(count):
+    factory = divak.api.SequentialIdFactory()
+    return [divak.api.RequestIdPropagator('Request-Id-{}'.format(n),
+                                          value_factory=factory)
+            for n in range(count)]
+
+
+class EnsureRequestIdTransformer(divak.internals.IdentityTransformer):
+    """Copy of the transform that the 0.0.3 release installed first."""
+
+    def __init__(self, request, *args, **kwargs):
+        if not hasattr(request, 'divak_request_id'):
+            setattr(request, 'divak_request_id', None)
+        if not hasattr(request, 'divak_sampled'):
+            setattr(request, 'divak_sampled', True)
+        super(EnsureRequestIdTransformer, self).__init__(
+            request, *args, **kwargs)
+
+
+class RequestSpanTransformer(divak.internals.IdentityTransformer):
+    """Transform that attached a span before RequestTransform did."""
+
+    def __init__(self, request, *args, **kwargs):
+        super(RequestSpanTransformer, self).__init__(request, *args, **kwargs)
+        self._span = divak.tracing.Span(divak.tracing.monotonic())
+        request.divak_span = self._span
+
+    def transform_first_chunk(self, status_code, headers, chunk,
+                              include_footers):
+        self._span.first_byte = divak.tracing.monotonic()
+        return status_code, headers, chunk
+
+
+def chain_transforms(propagators):
+    transforms = [EnsureRequestIdTransformer, RequestSpanTransformer]
+    transforms.extend(p.handle_request for p in propagators)
+    return transforms
+
+
+def combined_transforms(propagators):
+    return [functools.partial(divak.internals.RequestTransform,
+                              list(propagators))]
+
+
+def run(transforms, requests):
+    gc.disable()  # same as timeit
+    try:
+        start = divak.tracing.monotonic()
+        for request, headers in requests:
+            for transform in [t(request) for t in transforms]:
+                transform.transform_first_chunk(200, headers, b'', False)
+                transform.transform_chunk(b'', True)
+        return divak.tracing.monotonic() - start
+    finally:
+        gc.enable()
+
+
+def measure(transforms, number):
+    """
+    Measure the cost of running `transforms` for a request.
+
+    :param list transforms: the transform functions to call
+    :param int number: the number of requests to time
+    :return: the cost in microseconds per request
+    :rtype: float
+
+    """
+    best = None
+    for _ in range(5):
+        requests = [(httputil.HTTPServerRequest(uri='/status'),
+                     httputil.HTTPHeaders()) for _ in range(number)]
+        elapsed = run(transforms, requests)
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number * 1e6
+
+
+def main():
+    number = 50000
+    print('{:<10} {:>12} {:>8}'.format('', 'propagators', 'us/req'))
+    for count in (0, 1, 5):
+        propagators = create_propagators(count)
+        for name, factory in (('chain', chain_transforms),
+                              ('combined', combined_transforms)):
+            cost = measure(factory(propagators), number)
+            print('{:<10} {:>12d} {:8.2f}'.format(name, count, cost))
+
+
+if __name__ == '__main__':
+    main()
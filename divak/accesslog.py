@@ -0,0 +1,357 @@
+import functools
+import json.encoder
+import logging
+import re
+import threading
+
+from tornado import concurrent, ioloop
+
+try:
+    import queue
+except ImportError:  # pragma: no cover -- python 2
+    import Queue as queue
+
+
+_STOP = object()
+
+_encode_json_string = getattr(json.encoder, 'c_encode_basestring_ascii',
+                              None) or json.encoder.encode_basestring_ascii
+_LOGFMT_UNSAFE = re.compile(r'[\s"=\\]')
+
+
+def _remote_ip(handler, request):
+    return request.remote_ip
+
+
+def _forwarded_for(handler, request):
+    return request.headers.get('X-Forwarded-For', None)
+
+
+def _status(handler, request):
+    return handler.get_status()
+
+
+def _elapsed(handler, request):
+    return request.request_time()
+
+
+def _method(handler, request):
+    return request.method
+
+
+def _uri(handler, request):
+    return request.uri
+
+
+def _user_agent(handler, request):
+    return request.headers.get('User-Agent', None)
+
+
+def _request_id(handler, request):
+    return getattr(request, 'divak_request_id', None)
+
+
+FIELDS = {
+    'remoteip': (_remote_ip, '%s'),
+    'forwardedfor': (_forwarded_for, '%s'),
+    'status': (_status, '%d'),
+    'elapsed': (_elapsed, '%.6f'),
+    'method': (_method, '%s'),
+    'uri': (_uri, '%s'),
+    'useragent': (_user_agent, '%s'),
+    'divak_request_id': (_request_id, '%s'),
+}
+"""
+Fields that are available to structured access log formats.
+
+This maps a field name to a function that extracts the value from
+a request handler and request and the printf-style conversion that
+is used to render numeric values.
+
+"""
+
+DEFAULT_FIELDS = ('remoteip', 'forwardedfor', 'method', 'uri', 'status',
+                  'elapsed', 'useragent', 'divak_request_id')
+"""Fields that structured formats include by default."""
+
+
+class BackgroundLogHandler(logging.Handler):
+    """
+    Log handler that emits records from a background thread.
+
+    :param handlers: the :class:`logging.Handler` instances that
+        records are passed to
+    :keyword int max_queue_size: maximum number of records to hold
+        while waiting for the background thread
+
+    :meth:`.emit` puts the record into a bounded queue without blocking
+    and a daemon thread passes queued records to each of `handlers`.
+    This keeps slow streams and file systems from stalling the IOLoop
+    at the cost of possibly losing records.  Records that do not fit
+    into the queue are counted in :attr:`.dropped` and discarded.
+
+    Call :meth:`.stop` to process whatever is queued and stop the
+    background thread.  It returns immediately with a future that
+    resolves once the thread has finished so the IOLoop is never
+    blocked waiting for it.
+
+    .. attribute:: dropped
+
+       Number of records that were discarded because the queue was
+       full.
+
+    .. attribute:: handlers
+
+       :class:`list` of handlers that records are passed to.
+
+    """
+
+    def __init__(self, handlers, max_queue_size=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._on_exit = None
+
+    def start(self):
+        """Start the background thread."""
+        if self._thread is None:
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._stopping,),
+                                            name='divak-access-log')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Process queued records and stop the background thread.
+
+        :returns: a future that resolves when the background thread
+            has processed the queued records and exited
+        :rtype: tornado.concurrent.Future
+
+        """
+        future = concurrent.Future()
+        if self._thread is None:
+            future.set_result(None)
+            return future
+        io_loop = ioloop.IOLoop.current()
+        self._on_exit = functools.partial(io_loop.add_callback,
+                                          future.set_result, None)
+        self._signal_stop()
+        return future
+
+    def emit(self, record):
+        if record.args:
+            # format the message now since args can be mutable
+            record.msg = record.getMessage()
+            record.args = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        thread = self._signal_stop()
+        if thread is not None:
+            thread.join()
+        logging.Handler.close(self)
+
+    def _signal_stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass  # the thread drains the queue and sees _stopping
+        return thread
+
+    def _run(self, stopping):
+        try:
+            self._process_records(stopping)
+        finally:
+            on_exit, self._on_exit = self._on_exit, None
+            if on_exit is not None:
+                on_exit()
+
+    def _process_records(self, stopping):
+        get, get_nowait = self._queue.get, self._queue.get_nowait
+        while True:
+            if stopping.is_set():
+                try:
+                    record = get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                record = get()
+            if record is _STOP:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def collect_handlers(logger):
+    """
+    Find the handlers that `logger` would send records to.
+
+    :param logging.Logger logger: the logger to examine
+    :return: the handlers attached to `logger` and the ancestors
+        that it propagates to
+    :rtype: list
+
+    """
+    handlers = []
+    while logger is not None:
+        for handler in logger.handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+        logger = logger.parent if logger.propagate else None
+    return handlers
+
+
+class TextFormat(object):
+    """
+    Human-readable access log format.
+
+    This is the default format used by :class:`divak.api.Recorder`.
+    It generates messages that look like::
+
+       127.0.0.1 "GET /status" 200 "curl/7.54.0" 0.001341
+
+    The values are also passed in the ``extra`` dictionary so that
+    they are available to log formatters.
+
+    """
+
+    def format(self, handler):
+        """
+        Format the access log message for `handler`.
+
+        :param tornado.web.RequestHandler handler: the handler that
+            processed the request
+        :return: the message and the ``extra`` dictionary to log
+        :rtype: tuple
+
+        """
+        request = handler.request
+        args = {'remoteip': request.remote_ip,
+                'status': handler.get_status(),
+                'elapsed': request.request_time(),
+                'method': request.method,
+                'uri': request.uri,
+                'useragent': request.headers.get('User-Agent', '-'),
+                'divak_request_id': getattr(request, 'divak_request_id',
+                                            '-')}
+        return ('{remoteip} "{method} {uri}" {status} "{useragent}" '
+                '{elapsed:.6f}'.format(**args), args)
+
+
+class _StructuredFormat(object):
+    """
+    Shared implementation of the structured access log formats.
+
+    :param fields: sequence of field names to include
+    :param str field_template: :meth:`str.format` template that renders
+        a field from its ``name`` and printf-style ``conversion``
+    :param str separator: string to put between the fields
+    :param str prefix: string to put before the first field
+    :param str suffix: string to put after the last field
+    :param encode_string: callable that renders a string value or
+        :data:`None`
+
+    """
+
+    def __init__(self, fields, field_template, separator, prefix, suffix,
+                 encode_string):
+        super(_StructuredFormat, self).__init__()
+        unknown = [name for name in fields if name not in FIELDS]
+        if unknown:
+            raise ValueError('unknown access log fields: {}'.format(
+                ', '.join(unknown)))
+        self.fields = tuple(fields)
+        self._template = prefix + separator.join(
+            field_template.format(name=name, conversion=FIELDS[name][1])
+            for name in self.fields) + suffix
+        self._getters = tuple(FIELDS[name][0] for name in self.fields)
+        self._encoders = tuple(
+            encode_string if FIELDS[name][1] == '%s' else None
+            for name in self.fields)
+
+    def format(self, handler):
+        """
+        Format the access log message for `handler`.
+
+        :param tornado.web.RequestHandler handler: the handler that
+            processed the request
+        :return: the message and the ``extra`` dictionary to log
+        :rtype: tuple
+
+        """
+        request = handler.request
+        values = []
+        for getter, encode in zip(self._getters, self._encoders):
+            value = getter(handler, request)
+            values.append(value if encode is None else encode(value))
+        return (self._template % tuple(values),
+                {'divak_request_id': getattr(request, 'divak_request_id',
+                                             '-')})
+
+
+class JSONFormat(_StructuredFormat):
+    """
+    Access log format that generates a JSON object per request.
+
+    :param fields: sequence of field names to include.  The available
+        fields are the keys of :data:`FIELDS` and the default is
+        :data:`DEFAULT_FIELDS`.
+
+    The message template is built once when the instance is created so
+    formatting a request is a handful of attribute lookups and a single
+    string interpolation.  Missing values are rendered as ``null``::
+
+       {"remoteip":"10.0.0.1","forwardedfor":null,"method":"GET",...}
+
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        super(JSONFormat, self).__init__(fields, '"{name}":{conversion}',
+                                         ',', '{', '}', _json_string)
+
+
+class LogfmtFormat(_StructuredFormat):
+    """
+    Access log format that generates a logfmt line per request.
+
+    :param fields: sequence of field names to include.  The available
+        fields are the keys of :data:`FIELDS` and the default is
+        :data:`DEFAULT_FIELDS`.
+
+    Values are quoted only when they contain whitespace, quotes,
+    backslashes, or equal signs and missing values are empty::
+
+       remoteip=10.0.0.1 forwardedfor= method=GET uri=/status ...
+
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        super(LogfmtFormat, self).__init__(fields, '{name}={conversion}',
+                                           ' ', '', '', _logfmt_string)
+
+
+def _json_string(value):
+    if value is None:
+        return 'null'
+    return _encode_json_string(value)
+
+
+def _logfmt_string(value):
+    if value is None:
+        return ''
+    if _LOGFMT_UNSAFE.search(value) is not None:
+        return _encode_json_string(value)
+    return value
@@ -1,20 +1,85 @@
+import binascii
+import functools
+import itertools
 import logging
+import os
+import re
 import uuid
 import weakref
 
 from tornado import gen, web
 import tornado.log
 
+import divak.accesslog
 import divak.internals
+import divak.metrics
+import divak.profiling
+import divak.reporting
+import divak.tracing
 
 
 class Recorder(web.Application):
-    """Imbues an application with recording abilities."""
+    """
+    Imbues an application with recording abilities.
+
+    The following application settings control how observations are
+    delivered to reporters added by :meth:`.add_divak_reporter`.  See
+    :class:`divak.reporting.ReportingPipeline` for details.
+
+    - ``divak_report_batch_size``: maximum number of observations per
+      batch (*default 100*)
+    - ``divak_report_interval``: seconds between periodic flushes
+      (*default 1.0*)
+    - ``divak_report_queue_size``: maximum number of queued
+      observations (*default 10000*)
+    - ``divak_report_overflow``: what to do when the queue is full
+      (*default* :data:`~divak.reporting.OVERFLOW_DROP_OLDEST`)
+
+    The following settings enable the per-request log buffer in
+    :class:`.Logger` request handlers.
+
+    - ``divak_log_buffer_size``: maximum number of records to buffer
+      for each request (*default* :data:`None` which disables the
+      buffer)
+    - ``divak_log_buffer_threshold``: request duration in seconds that
+      causes the buffer to be flushed (*default* :data:`None` which
+      flushes only for server errors)
+
+    """
+
+    REQUEST_DURATION = 'divak_request_duration_seconds'
+    """Name of the request latency histograms."""
+
+    RESPONSE_BYTES = 'divak_response_bytes_total'
+    """Name of the per-route response body byte counters."""
+
+    RESPONSE_CHUNKS = 'divak_response_chunks_total'
+    """Name of the per-route response chunk counters."""
+
+    RESPONSE_STREAM_DURATION = 'divak_response_stream_seconds'
+    """Name of the histograms of time between first and last chunks."""
+
+    RESPONSE_CHUNK_GAP = 'divak_response_chunk_gap_seconds'
+    """Name of the histograms of the longest gap between chunks."""
 
     def __init__(self, *args, **kwargs):
+        # this is used by add_handlers which tornado calls from __init__
+        self._divak_routes = divak.internals.RouteResolver(self)
         super(Recorder, self).__init__(*args, **kwargs)
-        self.add_transform(divak.internals.EnsureRequestIdTransformer)
+        self._divak_propagators = []
+        self.add_transform(functools.partial(
+            divak.internals.RequestTransform, self._divak_propagators))
         divak.internals.initialize_logging()
+        self._divak_service = None
+        self._divak_pipeline = None
+        self._divak_tail_sampler = None
+        self._divak_access_log = None
+        self._divak_access_format = divak.accesslog.TextFormat()
+        self._divak_metrics = None
+        self._divak_histograms = {}
+        self._divak_profiler = None
+        self._divak_loop_monitor = None
+        self._divak_stream_metrics = None
 
     def set_divak_service(self, service_name):
         """
@@ -24,6 +89,22 @@ class Recorder(web.Application):
             observer
 
         """
+        self._divak_service = service_name
+
+    def set_divak_access_log_format(self, access_format):
+        """
+        Set the format used for access log messages.
+
+        :param access_format: an object with a ``format`` method that
+            accepts a request handler and returns the message and
+            ``extra`` dictionary to log.  The default is a
+            :class:`divak.accesslog.TextFormat` instance.  Use
+            :class:`~divak.accesslog.JSONFormat` or
+            :class:`~divak.accesslog.LogfmtFormat` for structured
+            access logs.
+
+        """
+        self._divak_access_format = access_format
 
     def add_divak_propagator(self, propagator):
         """
@@ -32,8 +113,45 @@ class Recorder(web.Application):
         :param propagator: a propagator instance to inspect requests
             and potentially modify responses
 
+        The propagator's ``install`` method is called with the
+        application.  If it returns :data:`True`, then the propagator's
+        ``process_request`` method is called with each request from
+        a single :class:`~divak.internals.RequestTransform`.  It returns
+        a sequence of ``(name, value)`` pairs to insert into the
+        response headers or :data:`None`.
+
+        """
+        if propagator.install(self):
+            self._divak_propagators.append(propagator)
+
+    def get_divak_outbound_headers(self, request, span_id=None):
+        """
+        Retrieve the headers to send with outbound requests.
+
+        :param tornado.httputil.HTTPServerRequest request: the request
+            that the outbound requests are made on behalf of
+        :param str span_id: the ID of the client span that describes
+            the outbound request.  If this is omitted, then the
+            request's span is used as the parent of the called service.
+        :return: ``(name, value)`` pairs to add to outbound requests
+        :rtype: list
+
+        This calls the ``outbound_headers`` method of each propagator
+        that has one.  It is used by :class:`divak.client.HTTPClient`
+        to continue the trace in the services that are called.
+        `span_id` is passed as the second parameter of
+        ``outbound_headers`` when it is specified.
+
         """
-        propagator.install(self)
+        headers = []
+        for propagator in self._divak_propagators:
+            outbound_headers = getattr(propagator, 'outbound_headers', None)
+            if outbound_headers is not None:
+                if span_id is None:
+                    headers.extend(outbound_headers(request) or ())
+                else:
+                    headers.extend(outbound_headers(request, span_id) or ())
+        return headers
 
     def add_divak_reporter(self, reporter):
         """
@@ -41,7 +159,224 @@ class Recorder(web.Application):
 
         :param reporter: a reporter instance to receive observations
 
+        Reporters receive batches of observations from IOLoop callbacks
+        by way of a :class:`~divak.reporting.ReportingPipeline` that is
+        created when the first reporter is added.
+
+        """
+        if self._divak_pipeline is None:
+            settings = self.settings
+            self._divak_pipeline = divak.reporting.ReportingPipeline(
+                batch_size=settings.get('divak_report_batch_size', 100),
+                flush_interval=settings.get('divak_report_interval', 1.0),
+                max_queue_size=settings.get('divak_report_queue_size',
+                                            10000),
+                overflow_policy=settings.get(
+                    'divak_report_overflow',
+                    divak.reporting.OVERFLOW_DROP_OLDEST),
+                tail_sampler=self._divak_tail_sampler)
+        self._divak_pipeline.reporters.append(reporter)
+
+    def set_divak_tail_sampler(self, tail_sampler):
+        """
+        Choose which finished requests are sent to reporters.
+
+        :param tail_sampler: an object with a ``filter`` method such as
+            :class:`divak.tracing.TailSampler` or :data:`None` to
+            send every sampled request
+
+        The tail sampler is called with each batch of spans when it is
+        flushed by the :class:`~divak.reporting.ReportingPipeline`.
+
+        """
+        self._divak_tail_sampler = tail_sampler
+        if self._divak_pipeline is not None:
+            self._divak_pipeline.tail_sampler = tail_sampler
+
+    def enable_divak_metrics(self, path='/metrics', registry=None):
         """
+        Record per-route latency histograms and expose them.
+
+        :keyword str path: the URL path to serve the metrics from
+        :keyword divak.metrics.MetricsRegistry registry: the registry
+            to record the histograms in.  A new registry is created if
+            this is omitted.
+        :return: the registry that metrics are recorded in
+        :rtype: divak.metrics.MetricsRegistry
+
+        Once enabled, the processing time of each request is recorded
+        in a :class:`~divak.metrics.LatencyHistogram` that is named by
+        :attr:`.REQUEST_DURATION` and labelled by the URL pattern that
+        routed the request and the class of the response status
+        (e.g., ``2xx``).  A :class:`~divak.metrics.PrometheusHandler`
+        is installed at `path` to expose the histograms.
+
+        """
+        if self._divak_metrics is None:
+            if registry is None:
+                registry = divak.metrics.MetricsRegistry()
+            registry.describe(self.REQUEST_DURATION,
+                              'Time spent processing requests.')
+            self._divak_metrics = registry
+            self.add_handlers(r'.*$', [
+                web.url(path, divak.metrics.PrometheusHandler,
+                        {'registry': registry})])
+        return self._divak_metrics
+
+    def enable_divak_profiler(self, budget, path='/profile', interval=0.01):
+        """
+        Sample the stacks of slow requests and expose them.
+
+        :param float budget: requests that take at least this many
+            seconds have their samples kept
+        :keyword str path: the URL path to serve the samples from
+        :keyword float interval: seconds between samples
+        :return: the sampler
+        :rtype: divak.profiling.StackSampler
+
+        This starts a :class:`~divak.profiling.StackSampler` that
+        samples the stack of the calling thread so call it from the
+        thread that runs the IOLoop.  The samples of requests that
+        exceed `budget` are aggregated by route and a
+        :class:`~divak.profiling.ProfileHandler` is installed at `path`
+        to expose them as collapsed stacks.
+
+        """
+        if self._divak_profiler is None:
+            self._divak_profiler = divak.profiling.StackSampler(
+                budget, interval=interval,
+                route_for=self._divak_routes.route_for)
+            self.add_handlers(r'.*$', [
+                web.url(path, divak.profiling.ProfileHandler,
+                        {'sampler': self._divak_profiler})])
+            self._divak_profiler.start()
+        return self._divak_profiler
+
+    def enable_divak_loop_monitor(self, threshold=0.1, interval=0.05):
+        """
+        Detect requests that block the IOLoop.
+
+        :keyword float threshold: seconds that the IOLoop has to be
+            blocked before it is reported
+        :keyword float interval: seconds between lag measurements
+        :return: the monitor
+        :rtype: divak.profiling.LoopMonitor
+
+        This starts a :class:`~divak.profiling.LoopMonitor` for the
+        current IOLoop so call it from the thread that runs the IOLoop.
+        The lag histograms are recorded in the registry returned by
+        :meth:`.enable_divak_metrics` which enables metrics with the
+        default settings if they are not already enabled.
+
+        """
+        if self._divak_loop_monitor is None:
+            self._divak_loop_monitor = divak.profiling.LoopMonitor(
+                threshold=threshold, interval=interval,
+                registry=self.enable_divak_metrics())
+            self._divak_loop_monitor.start()
+        return self._divak_loop_monitor
+
+    def enable_divak_stream_accounting(self):
+        """
+        Account for the bytes and chunks of each response.
+
+        :return: the registry that the metrics are recorded in
+        :rtype: divak.metrics.MetricsRegistry
+
+        This installs :class:`divak.internals.StreamTransform` to count
+        the bytes and chunks of each response and to time the gaps
+        between chunks.  The totals are stored in the span of sampled
+        requests and recorded in the following metrics labelled by the
+        URL pattern that routed the request:
+
+        - :attr:`.RESPONSE_BYTES` and :attr:`.RESPONSE_CHUNKS` count
+          the response bytes and chunks
+        - :attr:`.RESPONSE_STREAM_DURATION` is a histogram of the time
+          between the first and last chunk so dividing the byte counter
+          by its sum is the streaming throughput of the route
+        - :attr:`.RESPONSE_CHUNK_GAP` is a histogram of the longest
+          gap between two chunks of each response which exposes
+          stalled streams and slow clients
+
+        The metrics are recorded in the registry returned by
+        :meth:`.enable_divak_metrics` which enables metrics with the
+        default settings if they are not already enabled.
+
+        """
+        registry = self.enable_divak_metrics()
+        if self._divak_stream_metrics is None:
+            registry.describe(self.RESPONSE_BYTES,
+                              'Response body bytes written.')
+            registry.describe(self.RESPONSE_CHUNKS,
+                              'Response body chunks written.')
+            registry.describe(self.RESPONSE_STREAM_DURATION,
+                              'Time between the first and last chunks.')
+            registry.describe(self.RESPONSE_CHUNK_GAP,
+                              'Longest time between two chunks.')
+            self._divak_stream_metrics = {}
+            self.add_transform(divak.internals.StreamTransform)
+        return registry
+
+    def start_request(self, server_conn, request_conn):
+        return divak.internals.ActiveRequestScope(
+            super(Recorder, self).start_request(server_conn, request_conn))
+
+    def add_handlers(self, host_pattern, host_handlers):
+        super(Recorder, self).add_handlers(host_pattern, host_handlers)
+        self._divak_routes.reset()
+
+    def enable_divak_background_access_log(self, max_queue_size=10000):
+        """
+        Write access log records from a background thread.
+
+        :keyword int max_queue_size: maximum number of access log
+            records to hold while waiting for the background thread
+
+        The handlers that :data:`tornado.log.access_log` currently
+        sends records to, including the handlers of its ancestors, are
+        moved behind a :class:`~divak.accesslog.BackgroundLogHandler`
+        so that :meth:`.log_request` never waits on handler I/O.  Call
+        this *after* you configure logging since handlers that are added
+        later are not included.  :meth:`.stop_divak` drains the queue
+        and restores the original handlers.
+
+        """
+        if self._divak_access_log is not None:
+            return
+        access_log = tornado.log.access_log
+        handler = divak.accesslog.BackgroundLogHandler(
+            divak.accesslog.collect_handlers(access_log), max_queue_size)
+        self._divak_access_log = (handler, access_log.handlers[:],
+                                  access_log.propagate)
+        access_log.handlers[:] = [handler]
+        access_log.propagate = False
+        handler.start()
+
+    @gen.coroutine
+    def stop_divak(self):
+        """
+        Stop background divak activity and flush pending observations.
+
+        :returns: a future that resolves when pending observations
+            have been delivered to the reporters
+        :rtype: tornado.concurrent.Future
+
+        Call this from your shutdown logic before stopping the IOLoop.
+
+        """
+        if self._divak_profiler is not None:
+            self._divak_profiler.stop()
+        if self._divak_loop_monitor is not None:
+            self._divak_loop_monitor.stop()
+        if self._divak_pipeline is not None:
+            yield self._divak_pipeline.stop()
+        if self._divak_access_log is not None:
+            handler, handlers, propagate = self._divak_access_log
+            self._divak_access_log = None
+            yield handler.stop()
+            access_log = tornado.log.access_log
+            access_log.handlers[:] = handlers
+            access_log.propagate = propagate
 
     def log_request(self, handler):
         """
@@ -50,25 +385,91 @@ class Recorder(web.Application):
         :param tornado.web.RequestHandler handler: the handler that
             processed the request
 
+        The message is generated by the format that was set with
+        :meth:`.set_divak_access_log_format`.  Formatting is skipped
+        entirely if :data:`tornado.log.access_log` is not enabled for
+        the log level that corresponds to the response status.
+
         """
-        if handler.get_status() < 400:
-            log_method = tornado.log.access_log.info
-        elif handler.get_status() < 500:
-            log_method = tornado.log.access_log.warning
+        status = handler.get_status()
+        if status < 400:
+            level = logging.INFO
+        elif status < 500:
+            level = logging.WARNING
         else:
-            log_method = tornado.log.access_log.error
+            level = logging.ERROR
 
         request = handler.request  # type: tornado.httpserver.HTTPRequest
-        args = {'remoteip': '127.0.0.1',
-                'status': handler.get_status(),
-                'elapsed': request.request_time(),
-                'method': request.method,
-                'uri': request.uri,
-                'useragent': request.headers.get('User-Agent', '-'),
-                'divak_request_id': getattr(request, 'divak_request_id', '-')}
-        log_method(
-            '{remoteip} "{method} {uri}" {status} "{useragent}" '
-            '{elapsed:.6f}'.format(**args), extra=args)
+        span = getattr(request, 'divak_span', None)
+        if span is not None:
+            span.finish = divak.tracing.monotonic()
+
+        if self._divak_metrics is not None:
+            self._record_divak_latency(handler, status)
+        stream = None
+        if self._divak_stream_metrics is not None:
+            stream = getattr(request, 'divak_stream', None)
+            if stream is not None:
+                self._record_divak_stream(handler, stream)
+        if self._divak_profiler is not None:
+            self._divak_profiler.finish(handler, request.request_time())
+
+        access_log = tornado.log.access_log
+        if access_log.isEnabledFor(level):
+            message, extra = self._divak_access_format.format(handler)
+            access_log.log(level, message, extra=extra)
+
+        if (self._divak_pipeline is not None and span is not None and
+                request.divak_sampled):
+            span.service = self._divak_service
+            span.route = self._divak_routes.route_for(handler)
+            span.request_id = getattr(request, 'divak_request_id', None)
+            span.method = divak.tracing.intern(request.method)
+            span.uri = request.uri
+            span.status = status
+            span.trace_id = getattr(request, 'divak_trace_id', None)
+            if span.trace_id is not None:
+                span.span_id = request.divak_span_id
+                span.parent_id = request.divak_parent_id
+            if stream is not None:
+                span.response_bytes = stream.bytes
+                span.chunks = stream.chunks
+                span.max_chunk_gap = stream.max_gap
+            self._divak_pipeline.add(span)
+
+    def _record_divak_latency(self, handler, status):
+        route = self._divak_routes.route_for(handler)
+        try:
+            histograms = self._divak_histograms[route]
+        except KeyError:
+            histograms = self._divak_histograms[route] = [None] * 6
+        status_class = min(status // 100, 5)
+        histogram = histograms[status_class]
+        if histogram is None:
+            histogram = histograms[status_class] = (
+                self._divak_metrics.histogram(
+                    self.REQUEST_DURATION,
+                    (('route', route),
+                     ('status', '{}xx'.format(status_class)))))
+        histogram.record(handler.request.request_time())
+
+    def _record_divak_stream(self, handler, stream):
+        route = self._divak_routes.route_for(handler)
+        try:
+            metrics = self._divak_stream_metrics[route]
+        except KeyError:
+            labels = (('route', route),)
+            registry = self._divak_metrics
+            metrics = self._divak_stream_metrics[route] = (
+                registry.counter(self.RESPONSE_BYTES, labels),
+                registry.counter(self.RESPONSE_CHUNKS, labels),
+                registry.histogram(self.RESPONSE_STREAM_DURATION, labels),
+                registry.histogram(self.RESPONSE_CHUNK_GAP, labels))
+        response_bytes, chunks, duration, gap = metrics
+        response_bytes.increment(stream.bytes)
+        chunks.increment(stream.chunks)
+        duration.record(stream.duration)
+        gap.record(stream.max_gap)
 
 
 class RequestIdPropagator(object):
@@ -81,7 +482,8 @@ class RequestIdPropagator(object):
     :keyword value_factory: if this keyword is specified, then it's value
         is called to generate a response header if a new header value is
         required.  If this value is unspecified, then a UUID4 will be
-        generated.
+        generated.  :class:`.RandomIdFactory` and
+        :class:`.SequentialIdFactory` are cheaper alternatives.
 
     This class implements propagation of a request header into the
     response.  If the incoming request does not include a matching header,
@@ -89,9 +491,10 @@ class RequestIdPropagator(object):
     can disable the generation of new values by setting `value_factory`
     to :data:`None`.
 
-    An instance of :class:`.HeaderRelayTransformer` is wired in to
-    transform the request output by inserting the header value from the
-    ``divak_request_id`` property of the active request.
+    :meth:`.process_request` is called for each request by
+    :class:`.Recorder` and returns the header to insert into the
+    response.  :meth:`.handle_request` implements the same behavior
+    as a stand-alone Tornado transform function.
 
     """
 
@@ -111,8 +514,47 @@ class RequestIdPropagator(object):
         :rtype: bool
 
         """
-        application.add_transform(self.handle_request)
-        return False
+        return True
+
+    def process_request(self, request):
+        """
+        Extract or generate the request ID.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :return: the response headers to insert
+        :rtype: tuple
+
+        This method pulls the header value out of the request and
+        assigns it to ``request.divak_request_id``.  If the incoming
+        request does not have a request ID header, then a new value may
+        be generated before assigning it.
+
+        """
+        header_value = request.headers.get(self._header_name, None)
+        if header_value is None:
+            if self._value_factory is None:
+                request.divak_request_id = None
+                return None
+            header_value = str(self._value_factory())
+        request.divak_request_id = header_value
+        return ((self._header_name, header_value),)
+
+    def outbound_headers(self, request, span_id=None):
+        """
+        Retrieve the headers to send with outbound requests.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :param str span_id: the ID of the outbound request's client
+            span.  This is ignored.
+        :return: the request ID header or :data:`None`
+        :rtype: tuple
+
+        """
+        if request.divak_request_id is None:
+            return None
+        return ((self._header_name, request.divak_request_id),)
 
     def handle_request(self, request):
         """
@@ -124,22 +566,461 @@ class RequestIdPropagator(object):
             that is configured to insert the request ID header
         :rtype: HeaderRelayTransformer
 
-        This function is called to process each request.  It pulls the
-        header value out of the request and assigns it to
-        ``request.divak_request_id``.  If the incoming request does not
-        have a request ID header, then a new value may be generated before
-        assigning it.  Finally, a new instance of
-        :class:`HeaderRelayTransformer` is created to process the output
-        generated by processing `request`.
+        This function can be installed with
+        :meth:`tornado.web.Application.add_transform` to use the
+        propagator without :class:`.Recorder`.  It calls
+        :meth:`.process_request` and then creates a new instance of
+        :class:`HeaderRelayTransformer` to process the output generated
+        by processing `request`.
 
         """
-        header_value = request.headers.get(self._header_name, None)
-        if header_value is None and self._value_factory is not None:
-            header_value = str(self._value_factory())
-        request.divak_request_id = header_value
+        self.process_request(request)
         return HeaderRelayTransformer(self._header_name, request)
 
 
+class SamplingPropagator(object):
+    """
+    Makes and propagates the decision to record a request.
+
+    :param sampler: the sampler that is consulted when the request
+        does not carry a sampling decision.  This is an object with a
+        ``should_sample`` method that accepts a request and returns a
+        boolean such as :class:`divak.tracing.ProbabilisticSampler`,
+        :class:`divak.tracing.RateLimitingSampler`, or
+        :class:`divak.tracing.RouteSampler`.
+    :param str header_name: the name of the header that carries the
+        sampling decision.  If this value is unspecified, then the
+        header name defaults to ``Trace-Sampled``.
+
+    The decision is made once per request and stored in the
+    ``divak_sampled`` property of the request.  If the incoming request
+    includes the sampling header, then the upstream decision is honored
+    and the sampler is not consulted.  The decision is written to the
+    response header as ``1`` or ``0`` so that callers and downstream
+    services can follow it.  Requests that are not sampled do not have
+    a ``divak_span`` and are not sent to reporters.
+
+    """
+
+    def __init__(self, sampler, header_name='Trace-Sampled'):
+        super(SamplingPropagator, self).__init__()
+        self._sampler = sampler
+        self._header_name = header_name
+
+    def install(self, application):
+        """
+        Install the propagator into the application.
+
+        :param tornado.web.Application application: the application
+            to install this propagator into
+        :returns: :data:`True` if the propagator wants to be called
+            in the future or :data:`False` otherwise
+        :rtype: bool
+
+        """
+        return True
+
+    def process_request(self, request):
+        """
+        Make the sampling decision for `request`.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :return: the response headers to insert
+        :rtype: tuple
+
+        """
+        header_value = request.headers.get(self._header_name, None)
+        if header_value is not None:
+            header_value = header_value.strip().lower()
+        if header_value in ('1', 'true'):
+            sampled = True
+        elif header_value in ('0', 'false'):
+            sampled = False
+        else:
+            sampled = bool(self._sampler.should_sample(request))
+        request.divak_sampled = sampled
+        return ((self._header_name, '1' if sampled else '0'),)
+
+    def outbound_headers(self, request, span_id=None):
+        """
+        Retrieve the headers to send with outbound requests.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :param str span_id: the ID of the outbound request's client
+            span.  This is ignored.
+        :return: the sampling decision header
+        :rtype: tuple
+
+        """
+        return ((self._header_name, '1' if request.divak_sampled else '0'),)
+
+    def handle_request(self, request):
+        """
+        Initial transform function.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :return: a transformer that inserts the decision into the
+            response headers
+
+        This function can be installed with
+        :meth:`tornado.web.Application.add_transform` to use the
+        propagator without :class:`.Recorder`.
+
+        """
+        ((name, value),) = self.process_request(request)
+        return divak.internals.SetHeaderTransformer(name, value)
+
+
+_TRACEPARENT = re.compile(
+    r'([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+_ZERO_TRACE_ID = '0' * 32
+_ZERO_SPAN_ID = '0' * 16
+_B3_SINGLE = re.compile(
+    r'(?:((?:[0-9a-f]{16}){1,2})-([0-9a-f]{16})'
+    r'(?:-([01d])(?:-[0-9a-f]{16})?)?|[01d])$')
+_B3_TRACE_ID = re.compile(r'(?:[0-9a-f]{16}){1,2}$')
+_B3_SPAN_ID = re.compile(r'[0-9a-f]{16}$')
+_B3_SAMPLED = frozenset(['1', 'd', 'true'])
+_B3_NOT_SAMPLED = frozenset(['0', 'false'])
+
+
+def _format_traceparent(request, span_id=None):
+    return '-'.join(('00', request.divak_trace_id,
+                     span_id or request.divak_span_id,
+                     '01' if request.divak_sampled else '00'))
+
+
+class TraceContextPropagator(object):
+    """
+    Joins and continues traces using the W3C Trace Context headers.
+
+    :keyword sampler: the sampler that is consulted when the request
+        does not include a valid ``traceparent`` header.  If this is
+        unspecified, then the sampling decision is left alone.
+    :keyword bool write_response: should the ``traceresponse`` header
+        be included in responses?
+
+    If the request includes a valid `traceparent`_ header, then the
+    request joins the trace and the ``sampled`` flag of the header is
+    stored in ``divak_sampled``.  Otherwise a new trace is started.
+    Either way, a new span ID is generated for the request.  The
+    following properties are set on the request:
+
+    - ``divak_trace_id``: the 32 character trace ID
+    - ``divak_span_id``: the 16 character ID of this request's span
+    - ``divak_parent_id``: the span ID from ``traceparent`` or
+      :data:`None` if the request started the trace
+    - ``divak_tracestate``: the ``tracestate`` header or :data:`None`
+
+    The trace ID is also used as the ``divak_request_id`` if another
+    propagator has not set it.  :class:`divak.client.HTTPClient` sends
+    ``traceparent`` with the outbound request's client span as the
+    parent along with the unmodified ``tracestate``.
+
+    The header is validated with a single precompiled regular
+    expression and the identifiers are generated by
+    :class:`.RandomIdFactory` instances.
+
+    .. _traceparent: https://www.w3.org/TR/trace-context/
+
+    """
+
+    def __init__(self, sampler=None, write_response=True):
+        super(TraceContextPropagator, self).__init__()
+        self._sampler = sampler
+        self._write_response = write_response
+        self._new_trace_id = RandomIdFactory(id_bytes=16)
+        self._new_span_id = RandomIdFactory(id_bytes=8)
+
+    def install(self, application):
+        """
+        Install the propagator into the application.
+
+        :param tornado.web.Application application: the application
+            to install this propagator into
+        :returns: :data:`True` if the propagator wants to be called
+            in the future or :data:`False` otherwise
+        :rtype: bool
+
+        """
+        return True
+
+    def process_request(self, request):
+        """
+        Join or start the trace for `request`.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :return: the response headers to insert
+        :rtype: tuple
+
+        """
+        headers = request.headers
+        header = headers.get('traceparent', None)
+        match = None if header is None else _TRACEPARENT.match(header)
+        if match is not None:
+            version, trace_id, parent_id, flags, extra = match.groups()
+            if (version == 'ff' or (version == '00' and extra) or
+                    trace_id == _ZERO_TRACE_ID or parent_id == _ZERO_SPAN_ID):
+                match = None
+
+        if match is None:
+            trace_id = self._new_trace_id()
+            parent_id = None
+            request.divak_tracestate = None
+            if self._sampler is not None:
+                request.divak_sampled = self._sampler.should_sample(request)
+        else:
+            request.divak_sampled = int(flags, 16) & 1 == 1
+            request.divak_tracestate = headers.get('tracestate', None)
+
+        request.divak_trace_id = trace_id
+        request.divak_span_id = self._new_span_id()
+        request.divak_parent_id = parent_id
+        if request.divak_request_id is None:
+            request.divak_request_id = trace_id
+        if self._write_response:
+            return (('traceresponse', _format_traceparent(request)),)
+        return None
+
+    def outbound_headers(self, request, span_id=None):
+        """
+        Retrieve the headers to send with outbound requests.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :param str span_id: the ID of the outbound request's client
+            span.  This is sent as the parent ID instead of the
+            request's span ID if it is specified.
+        :return: the ``traceparent`` and ``tracestate`` headers
+        :rtype: tuple
+
+        """
+        traceparent = ('traceparent', _format_traceparent(request, span_id))
+        if request.divak_tracestate is None:
+            return (traceparent,)
+        return traceparent, ('tracestate', request.divak_tracestate)
+
+
+class B3Propagator(object):
+    """
+    Joins and continues traces using the Zipkin B3 headers.
+
+    :keyword sampler: the sampler that is consulted when the request
+        does not include a sampling decision.  If this is unspecified,
+        then the sampling decision is left alone.
+    :keyword bool single_header: should outbound requests and responses
+        use the single ``b3`` header instead of the ``X-B3-*`` headers?
+    :keyword bool write_response: should the B3 headers be included in
+        responses?
+
+    Both the `single header`_ and the multiple header forms of B3 are
+    accepted.  The single header is used if both are present.  The
+    request properties are the same as the ones that
+    :class:`.TraceContextPropagator` sets except for
+    ``divak_tracestate``.  The debug flag is treated as a decision to
+    sample the request.
+
+    .. _single header: https://github.com/openzipkin/b3-propagation
+
+    """
+
+    def __init__(self, sampler=None, single_header=False,
+                 write_response=True):
+        super(B3Propagator, self).__init__()
+        self._sampler = sampler
+        self._single_header = single_header
+        self._write_response = write_response
+        self._new_trace_id = RandomIdFactory(id_bytes=16)
+        self._new_span_id = RandomIdFactory(id_bytes=8)
+
+    def install(self, application):
+        """
+        Install the propagator into the application.
+
+        :param tornado.web.Application application: the application
+            to install this propagator into
+        :returns: :data:`True` if the propagator wants to be called
+            in the future or :data:`False` otherwise
+        :rtype: bool
+
+        """
+        return True
+
+    def process_request(self, request):
+        """
+        Join or start the trace for `request`.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :return: the response headers to insert
+        :rtype: tuple
+
+        """
+        headers = request.headers
+        trace_id = parent_id = decision = None
+        header = headers.get('b3', None)
+        if header is not None:
+            match = _B3_SINGLE.match(header)
+            if match is not None:
+                trace_id, parent_id, decision = match.groups()
+                if trace_id is None:
+                    decision = header
+        else:
+            trace_id = headers.get('X-B3-TraceId', None)
+            parent_id = headers.get('X-B3-SpanId', None)
+            if (trace_id is None or parent_id is None or
+                    _B3_TRACE_ID.match(trace_id) is None or
+                    _B3_SPAN_ID.match(parent_id) is None):
+                trace_id = parent_id = None
+            if headers.get('X-B3-Flags', None) == '1':
+                decision = 'd'
+            else:
+                decision = headers.get('X-B3-Sampled', None)
+
+        if decision in _B3_SAMPLED:
+            request.divak_sampled = True
+        elif decision in _B3_NOT_SAMPLED:
+            request.divak_sampled = False
+        elif self._sampler is not None:
+            request.divak_sampled = self._sampler.should_sample(request)
+
+        if trace_id is None:
+            trace_id = self._new_trace_id()
+            parent_id = None
+        request.divak_trace_id = trace_id
+        request.divak_span_id = self._new_span_id()
+        request.divak_parent_id = parent_id
+        if request.divak_request_id is None:
+            request.divak_request_id = trace_id
+        if self._write_response:
+            return self.outbound_headers(request)
+        return None
+
+    def outbound_headers(self, request, span_id=None):
+        """
+        Retrieve the headers to send with outbound requests.
+
+        :param tornado.web.httpserver.HTTPRequest request:
+            the request that is being processed
+        :param str span_id: the ID of the outbound request's client
+            span.  If this is specified, then it is sent as the span ID
+            and the request's span ID is sent as the parent ID.
+        :return: the B3 headers
+        :rtype: tuple
+
+        """
+        sampled = '1' if request.divak_sampled else '0'
+        if span_id is None:
+            span_id, parent_id = request.divak_span_id, request.divak_parent_id
+        else:
+            parent_id = request.divak_span_id
+        if self._single_header:
+            value = '-'.join((request.divak_trace_id, span_id, sampled))
+            if parent_id is not None:
+                value += '-' + parent_id
+            return (('b3', value),)
+        headers = [('X-B3-TraceId', request.divak_trace_id),
+                   ('X-B3-SpanId', span_id),
+                   ('X-B3-Sampled', sampled)]
+        if parent_id is not None:
+            headers.append(('X-B3-ParentSpanId', parent_id))
+        return headers
+
+
+class RandomIdFactory(object):
+    """
+    Generates random request IDs from pre-fetched blocks of bytes.
+
+    :keyword int block_size: number of identifiers to generate from
+        each call to :func:`os.urandom`.  The default is 256.
+    :keyword int id_bytes: number of random bytes in each identifier.
+        The default is 16.
+
+    Calling an instance returns a 32 character hexadecimal string
+    containing 128 random bits which is the same amount of randomness
+    as a UUID4 (which has 122 random bits).  Pass ``id_bytes=8`` to
+    generate 64-bit identifiers such as span IDs.  Instead of making a system
+    call and creating a :class:`uuid.UUID` for each identifier, this
+    class reads `block_size` identifiers worth of bytes from
+    :func:`os.urandom` at once, converts them to hexadecimal in a single
+    call, and slices an identifier out of the string on each call.
+
+    **Uniqueness** is probabilistic in the same way that UUID4 values
+    are.  The pre-fetched block is discarded when the process forks so
+    workers started by :func:`tornado.process.fork_processes` never
+    hand out the same bytes.  The generated identifiers are
+    unpredictable provided that the pre-fetched bytes are not leaked.
+
+    """
+
+    def __init__(self, block_size=256, id_bytes=16):
+        super(RandomIdFactory, self).__init__()
+        self._block_size = block_size
+        self._id_bytes = id_bytes
+        self._id_length = 2 * id_bytes
+        self._block = ''
+        self._offset = 0
+        self._pid = None
+
+    def __call__(self):
+        offset = self._offset
+        if offset >= len(self._block) or (
+                self._pid != divak.internals.process_id()):
+            self._refill()
+            offset = 0
+        self._offset = offset + self._id_length
+        return self._block[offset:offset + self._id_length]
+
+    def _refill(self):
+        self._pid = divak.internals.process_id()
+        self._block = binascii.hexlify(
+            os.urandom(self._id_bytes * self._block_size)).decode('ascii')
+
+
+class SequentialIdFactory(object):
+    """
+    Generates request IDs from a per-process prefix and a counter.
+
+    :keyword str separator: string to insert between the prefix and
+        the counter value.  The default is ``-``.
+
+    Calling an instance returns a random 16 character hexadecimal
+    prefix that is chosen when the factory is first used in a process,
+    the separator, and a monotonically increasing hexadecimal counter.
+    Generating an identifier is a counter increment and a string
+    format operation.
+
+    **Uniqueness** is guaranteed within a process by the counter.
+    Across processes it relies on each process choosing a different
+    64-bit random prefix.  The prefix and counter are regenerated after
+    a fork so forked workers will not share a prefix unless they pick
+    the same one at random which is vanishingly unlikely for any
+    realistic number of workers.  The identifiers are *predictable*
+    and reveal how many requests a process has handled so do not use
+    this factory if that matters to you.
+
+    """
+
+    def __init__(self, separator='-'):
+        super(SequentialIdFactory, self).__init__()
+        self._separator = separator
+        self._prefix = None
+        self._counter = None
+        self._pid = None
+
+    def __call__(self):
+        if self._pid != divak.internals.process_id():
+            self._pid = divak.internals.process_id()
+            self._prefix = binascii.hexlify(os.urandom(8)).decode(
+                'ascii') + self._separator
+            self._counter = itertools.count(1)
+        return '{}{:x}'.format(self._prefix, next(self._counter))
+
+
 class HeaderRelayTransformer(object):
     """
     Tornado transformer that relays a header from request to response.
@@ -209,41 +1090,94 @@ class HeaderRelayTransformer(object):
 
 class Logger(web.RequestHandler):
     """
-    Imbues a :class:`tornado.web.RequestHandler` with a contextual logger.
+    Imbues a :class:`tornado.web.RequestHandler` with a logger.
 
-    This class adds a ``logger`` attribute that inserts divak tags into
-    the logging record.  Tags added by calling :meth:`.add_divak_tag` are
-    automatically made available in log messages.  The ``divak_request_id``
-    value is guaranteed to be available in all log messages provided that
-    you are using :class:`.Application` in your application's class list.
+    This class adds a ``logger`` attribute that inserts the request ID
+    into the logging record.  The ``divak_request_id`` value is
+    guaranteed to be available in all log messages provided that you
+    are using :class:`.Recorder` in your application's class list.
+    When :data:`divak.internals.ACTIVE_REQUEST_SUPPORTED` is true, the
+    request ID is also retrieved from the active request context so it
+    is available in records from *any* logger that is used while
+    processing the request and not only from ``self.logger``.
 
     The ``logger`` attribute is set in :meth:`.prepare` and will wrap
     an existing ``logger`` attribute or create a new one using the self's
-    class module and class name as the logger name.
+    class module and class name as the logger name.  The start and end
+    of :meth:`.prepare` are recorded in the request's ``divak_span``.
+
+    :meth:`.prepare` finishes synchronously and returns :data:`None`
+    unless the super class implementation returns an awaitable, in which
+    case it returns a future that resolves after the awaitable does.
+    This follows the :meth:`tornado.web.RequestHandler.prepare`
+    convention so handlers that override ``prepare`` as a coroutine
+    should only await the super class result when it is not
+    :data:`None`::
+
+       async def prepare(self):
+           maybe_future = super().prepare()
+           if maybe_future is not None:
+               await maybe_future
+
+    If the ``divak_log_buffer_size`` application setting is set, then
+    ``self.logger`` is wrapped in a
+    :class:`~divak.internals.BufferingLogger` for each request.  Records
+    that are below the logger's level are held in memory and passed to
+    the logger's handlers only when the request fails with a server
+    error or takes longer than the ``divak_log_buffer_threshold``
+    setting.  Otherwise they are discarded when the request finishes.
 
     .. attribute:: logger
 
-       A :class:`logging.LoggerAdapter` that inserts divak tags into log
-       records using the ``extra`` dict.
+       The logger for the request.  The request ID is set on its
+       records by the log record factory that :class:`.Recorder`
+       installs.  When :data:`divak.internals.ACTIVE_REQUEST_SUPPORTED`
+       is false, this is a :class:`logging.LoggerAdapter` that inserts
+       the request ID using the ``extra`` dict instead.
 
     """
 
-    def __init__(self, *args, **kwargs):
-        self._logging_context = {}
-        super(Logger, self).__init__(*args, **kwargs)
-
-    @gen.coroutine
     def prepare(self):
+        span = getattr(self.request, 'divak_span', None)
+        if span is not None:
+            span.prepare_start = divak.tracing.monotonic()
+
         if hasattr(self, 'logger'):
             logger = self.logger
         else:
-            full_name = '{}.{}'.format(self.__class__.__module__,
-                                       self.__class__.__name__)
-            logger = logging.getLogger(full_name)
-        self.logger = logging.LoggerAdapter(logger, self._logging_context)
-        self._logging_context['divak_request_id'] = (
-            self.request.divak_request_id)
+            logger = logging.getLogger('{}.{}'.format(
+                self.__class__.__module__, self.__class__.__name__))
+        buffer_size = self.settings.get('divak_log_buffer_size', None)
+        if buffer_size:
+            logger = divak.internals.BufferingLogger(logger, buffer_size)
+            self._divak_log_buffer = logger
+        if not divak.internals.ACTIVE_REQUEST_SUPPORTED:
+            logger = logging.LoggerAdapter(logger, {
+                'divak_request_id':
+                getattr(self.request, 'divak_request_id', None) or ''})
+        self.logger = logger
 
         maybe_future = super(Logger, self).prepare()
-        if maybe_future:  # pragma: no cover -- pure paranoia
-            yield maybe_future
+        if maybe_future is not None:
+            return self._divak_finish_prepare(maybe_future, span)
+
+        if span is not None:
+            span.prepare_end = divak.tracing.monotonic()
+
+    @gen.coroutine
+    def _divak_finish_prepare(self, maybe_future, span):
+        yield maybe_future
+        if span is not None:
+            span.prepare_end = divak.tracing.monotonic()
+
+    def on_finish(self):
+        log_buffer = getattr(self, '_divak_log_buffer', None)
+        if log_buffer is not None:
+            threshold = self.settings.get('divak_log_buffer_threshold', None)
+            if self.get_status() >= 500 or (
+                    threshold is not None and
+                    self.request.request_time() >= threshold):
+                log_buffer.flush()
+            else:
+                log_buffer.discard()
+        super(Logger, self).on_finish()
@@ -0,0 +1,120 @@
+from tornado import gen, httpclient, httputil
+
+import divak.api
+import divak.internals
+import divak.tracing
+
+
+class HTTPClient(object):
+    """
+    Wraps :class:`tornado.httpclient.AsyncHTTPClient` to continue traces.
+
+    :param divak.api.Recorder application: the application that the
+        requests are made from
+    :keyword tornado.httpclient.AsyncHTTPClient http_client: the client
+        to send requests with.  The shared
+        :class:`~tornado.httpclient.AsyncHTTPClient` instance for the
+        current IOLoop is used if this is omitted.
+
+    When :meth:`.fetch` is called while the application is processing a
+    request, the headers from
+    :meth:`~divak.api.Recorder.get_divak_outbound_headers` are added to
+    the outbound request unless it already has them.  If the active
+    request is being sampled, then a :class:`divak.tracing.ClientSpan`
+    describing the outbound request is added to its span and its ID
+    is sent as the parent ID in the trace headers.  The request
+    is found in :data:`divak.internals.active_request` so nothing is
+    added unless :data:`divak.internals.ACTIVE_REQUEST_SUPPORTED` is
+    true.
+
+    .. attribute:: application
+
+       The application that is passed to the initializer.
+
+    """
+
+    def __init__(self, application, http_client=None):
+        super(HTTPClient, self).__init__()
+        self.application = application
+        self._http_client = http_client
+        self._new_span_id = divak.api.RandomIdFactory(id_bytes=8)
+
+    @gen.coroutine
+    def fetch(self, request, raise_error=True, **kwargs):
+        """
+        Send an outbound request.
+
+        :param request: the URL to fetch or a
+            :class:`~tornado.httpclient.HTTPRequest` instance
+        :keyword bool raise_error: should an error response raise a
+            :exc:`~tornado.httpclient.HTTPError`?
+        :param kwargs: additional keyword parameters are passed to
+            :class:`~tornado.httpclient.HTTPRequest` when `request`
+            is a URL
+        :rtype: tornado.httpclient.HTTPResponse
+
+        This has the same semantics as
+        :meth:`tornado.httpclient.AsyncHTTPClient.fetch` minus the
+        deprecated `callback` parameter.
+
+        """
+        if isinstance(request, httpclient.HTTPRequest):
+            if kwargs:
+                raise ValueError("kwargs can't be used if request is an "
+                                 "HTTPRequest object")
+        else:
+            request = httpclient.HTTPRequest(url=request, **kwargs)
+
+        span = span_id = None
+        active = divak.internals.active_request.get()
+        if active is not None:
+            parent = getattr(active, 'divak_span', None)
+            if parent is not None:
+                span_id = self._new_span_id()
+                span = divak.tracing.ClientSpan(
+                    request.method, request.url, divak.tracing.monotonic(),
+                    span_id)
+                parent.add_child(span)
+            headers = request.headers
+            if not isinstance(headers, httputil.HTTPHeaders):
+                # header names are case-insensitive so a plain dict
+                # would miss headers that the caller already set
+                headers = request.headers = httputil.HTTPHeaders(headers)
+            for name, value in self.application.get_divak_outbound_headers(
+                    active, span_id):
+                if name not in headers:
+                    headers[name] = value
+
+        http_client = self._http_client or httpclient.AsyncHTTPClient()
+        try:
+            response = yield http_client.fetch(request, raise_error=False)
+        except Exception:
+            if span is not None:
+                span.finish = divak.tracing.monotonic()
+                span.status = 599
+            raise
+
+        if span is not None:
+            _record_response(span, response)
+        if raise_error and response.error:
+            raise response.error
+        raise gen.Return(response)
+
+
+def _record_response(span, response):
+    span.finish = divak.tracing.monotonic()
+    span.status = response.code
+    span.request_time = response.request_time
+
+    time_info = response.time_info or {}
+    span.namelookup = time_info.get('namelookup')
+    span.connect = time_info.get('connect')
+    if span.connect is not None:
+        # curl reports a zero connect time for reused connections
+        span.reused = span.connect == 0.0
+
+    span.queue = time_info.get('queue')
+    if span.queue is None and response.request_time is not None:
+        # simple_httpclient does not report the queue time but its
+        # request_time excludes it in tornado 5.1 and newer
+        span.queue = max(0.0, span.duration - response.request_time)
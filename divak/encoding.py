@@ -0,0 +1,308 @@
+import array
+import operator
+import struct
+import sys
+
+import divak.tracing
+
+
+_MAGIC = b'DVKB'
+_VERSION = 3
+_HEADER = struct.Struct('<4sBIII')
+_LENGTH = struct.Struct('<I')
+_NONE = 0xFFFFFFFF
+_UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+_SPAN_STRINGS = ('service', 'route', 'method', 'uri', 'request_id',
+                 'trace_id', 'span_id', 'parent_id')
+_SPAN_TIMES = ('start', 'prepare_start', 'prepare_end', 'first_byte',
+               'finish', 'max_chunk_gap')
+_SPAN_COUNTS = ('response_bytes', 'chunks')
+_get_span_strings = operator.attrgetter(*_SPAN_STRINGS)
+_get_span_times = operator.attrgetter(*_SPAN_TIMES)
+_get_span_counts = operator.attrgetter(*_SPAN_COUNTS)
+_CHILD_STRINGS = ('method', 'url', 'span_id')
+_CHILD_TIMES = ('start', 'finish', 'queue', 'namelookup', 'connect',
+                'request_time')
+
+
+class SpanBatch(object):
+    """
+    Column-oriented container of :class:`divak.tracing.Span` instances.
+
+    :param spans: optional iterable of spans to :meth:`.extend` the
+        batch with
+
+    Each span attribute is stored in its own :class:`array.array`
+    column so a batch holds a handful of arrays instead of one object
+    per span.  Timestamps are stored as doubles with NaN standing in
+    for :data:`None`.  Counts are stored the same way since doubles
+    hold integers exactly up to 2**53 and, unlike a 64-bit integer
+    typecode, are available on every platform that :mod:`array`
+    supports.  String attributes are stored as indexes into
+    :attr:`.strings` which holds each distinct string once per batch.
+    The :class:`~divak.tracing.ClientSpan` children of every span are
+    stored in a second set of columns along with the index of their
+    parent.
+
+    Use :meth:`.encode` to serialize the batch and :meth:`.decode` to
+    read it back.  Iterating over a batch creates new
+    :class:`~divak.tracing.Span` instances from the columns.
+
+    .. attribute:: strings
+
+       :class:`list` of the distinct strings in the batch.
+
+    """
+
+    def __init__(self, spans=()):
+        super(SpanBatch, self).__init__()
+        self.strings = []
+        self._string_index = {None: _NONE}
+        self._columns = _create_columns(_SPAN_STRINGS, _SPAN_TIMES)
+        for name in _SPAN_COUNTS:
+            self._columns[name] = array.array('d')
+        self._status = array.array('H')
+        self._child_columns = _create_columns(_CHILD_STRINGS, _CHILD_TIMES)
+        self._child_parent = array.array(_UINT32)
+        self._child_status = array.array('H')
+        self._child_reused = array.array('b')
+        self._string_appends = [self._columns[name].append
+                                for name in _SPAN_STRINGS]
+        self._time_appends = [self._columns[name].append
+                              for name in _SPAN_TIMES]
+        self._count_appends = [self._columns[name].append
+                               for name in _SPAN_COUNTS]
+        self.extend(spans)
+
+    def __len__(self):
+        return len(self._status)
+
+    def __iter__(self):
+        strings = self.strings
+        columns = [(name, self._columns[name]) for name in _SPAN_STRINGS]
+        times = [(name, self._columns[name]) for name in _SPAN_TIMES]
+        counts = [(name, self._columns[name]) for name in _SPAN_COUNTS]
+        children = self._iter_children()
+        child = next(children, None)
+        for index, status in enumerate(self._status):
+            span = divak.tracing.Span(None)
+            for name, column in columns:
+                setattr(span, name, _string(strings, column[index]))
+            for name, column in times:
+                value = column[index]
+                setattr(span, name, None if value != value else value)
+            for name, column in counts:
+                value = column[index]
+                setattr(span, name, None if value != value else int(value))
+            span.status = status or None
+            while child is not None and child[0] == index:
+                span.add_child(child[1])
+                child = next(children, None)
+            yield span
+
+    def append(self, span):
+        """
+        Add `span` to the batch.
+
+        :param divak.tracing.Span span: the span to add
+
+        """
+        intern = self._intern
+        lookup = self._string_index.get
+        for append, value in zip(self._string_appends,
+                                 _get_span_strings(span)):
+            index = lookup(value)
+            append(intern(value) if index is None else index)
+        for append, value in zip(self._time_appends, _get_span_times(span)):
+            append(_NAN if value is None else value)
+        for append, value in zip(self._count_appends,
+                                 _get_span_counts(span)):
+            append(_NAN if value is None else value)
+
+        index = len(self._status)
+        self._status.append(span.status or 0)
+        if span.children:
+            columns = self._child_columns
+            for child in span.children:
+                self._child_parent.append(index)
+                self._child_status.append(child.status or 0)
+                self._child_reused.append(
+                    -1 if child.reused is None else int(child.reused))
+                for name in _CHILD_STRINGS:
+                    columns[name].append(intern(getattr(child, name)))
+                for name in _CHILD_TIMES:
+                    value = getattr(child, name)
+                    columns[name].append(_NAN if value is None else value)
+
+    def extend(self, spans):
+        """
+        Add each span in `spans` to the batch.
+
+        :param spans: iterable of :class:`~divak.tracing.Span` instances
+
+        """
+        append = self.append
+        for span in spans:
+            append(span)
+
+    def encode(self):
+        """
+        Serialize the batch.
+
+        :rtype: bytes
+
+        The encoded batch is a fixed header with the number of strings,
+        spans, and child spans followed by the length-prefixed UTF-8
+        strings and then the raw little-endian bytes of each column.
+        Since the columns are copied as blocks of memory, the cost is
+        dominated by the string table.
+
+        """
+        parts = [_HEADER.pack(_MAGIC, _VERSION, len(self.strings),
+                              len(self._status), len(self._child_parent))]
+        pack = _LENGTH.pack
+        for value in self.strings:
+            data = value.encode('utf-8')
+            parts.append(pack(len(data)))
+            parts.append(data)
+        for values, _ in self._iter_columns():
+            parts.append(_to_little_endian(values))
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Create a batch from the output of :meth:`.encode`.
+
+        :param bytes data: the encoded batch
+        :rtype: SpanBatch
+        :raises ValueError: if `data` is not an encoded batch
+
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError('encoded batch is truncated')
+        magic, version, string_count, span_count, child_count = (
+            _HEADER.unpack_from(data, 0))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('data is not an encoded span batch')
+
+        batch = cls()
+        offset = _HEADER.size
+        try:
+            for _ in range(string_count):
+                length, = _LENGTH.unpack_from(data, offset)
+                offset += _LENGTH.size
+                batch._intern(data[offset:offset + length].decode('utf-8'))
+                offset += length
+            for values, is_child in batch._iter_columns():
+                offset = _read_column(values, data, offset,
+                                      child_count if is_child else span_count)
+        except struct.error:
+            raise ValueError('encoded batch is truncated')
+        if offset != len(data):
+            raise ValueError('encoded batch has trailing data')
+        return batch
+
+    def _intern(self, value):
+        index = self._string_index.get(value)
+        if index is None:
+            index = self._string_index[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def _iter_columns(self):
+        yield self._status, False
+        for name in _SPAN_STRINGS + _SPAN_TIMES + _SPAN_COUNTS:
+            yield self._columns[name], False
+        for values in (self._child_parent, self._child_status,
+                       self._child_reused):
+            yield values, True
+        for name in _CHILD_STRINGS + _CHILD_TIMES:
+            yield self._child_columns[name], True
+
+    def _iter_children(self):
+        strings = self.strings
+        columns = self._child_columns
+        for index, parent in enumerate(self._child_parent):
+            child = divak.tracing.ClientSpan(None, None, None)
+            for name in _CHILD_STRINGS:
+                setattr(child, name, _string(strings, columns[name][index]))
+            for name in _CHILD_TIMES:
+                value = columns[name][index]
+                setattr(child, name, None if value != value else value)
+            child.status = self._child_status[index] or None
+            reused = self._child_reused[index]
+            child.reused = None if reused < 0 else bool(reused)
+            yield parent, child
+
+
+def encode_spans(spans):
+    """
+    Encode a list of spans as a :class:`.SpanBatch`.
+
+    :param list spans: the :class:`~divak.tracing.Span` instances to
+        encode
+    :rtype: bytes
+
+    This can be passed as the `encode` parameter of
+    :class:`divak.reporting.SpoolingReporter`.
+
+    """
+    return SpanBatch(spans).encode()
+
+
+def decode_spans(data):
+    """
+    Decode the output of :func:`.encode_spans`.
+
+    :param bytes data: the encoded spans
+    :rtype: list
+
+    This can be passed as the `decode` parameter of
+    :class:`divak.reporting.SpoolingReporter`.
+
+    """
+    return list(SpanBatch.decode(data))
+
+
+_NAN = float('nan')
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _string(strings, index):
+    return None if index == _NONE else strings[index]
+
+
+def _create_columns(string_names, time_names):
+    columns = {}
+    for name in string_names:
+        columns[name] = array.array(_UINT32)
+    for name in time_names:
+        columns[name] = array.array('d')
+    return columns
+
+
+def _to_little_endian(values):
+    if _BIG_ENDIAN:  # pragma: no cover -- little-endian test machines
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return _tobytes(values)
+
+
+def _read_column(values, data, offset, count):
+    end = offset + values.itemsize * count
+    if end > len(data):
+        raise ValueError('encoded batch is truncated')
+    _frombytes(values, data[offset:end])
+    if _BIG_ENDIAN:  # pragma: no cover -- little-endian test machines
+        values.byteswap()
+    return end
+
+
+try:
+    _tobytes = array.array.tobytes
+    _frombytes = array.array.frombytes
+except AttributeError:  # pragma: no cover -- python 2
+    _tobytes = array.array.tostring
+    _frombytes = array.array.fromstring
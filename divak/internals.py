@@ -1,4 +1,155 @@
+import collections
 import logging
+import os
+
+from tornado import httputil
+import tornado
+
+import divak.tracing
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover -- python < 3.7
+    contextvars = None
+
+
+_process_id = os.getpid()
+
+
+def _update_process_id():
+    global _process_id
+    _process_id = os.getpid()
+
+
+def process_id():
+    """
+    Return the current process ID without a system call if possible.
+
+    :rtype: int
+
+    This is used to detect when a process has been forked so that
+    per-process state can be regenerated in the child.  The value is
+    cached and refreshed by an :func:`os.register_at_fork` hook when
+    the hook is available.  Otherwise, this simply calls
+    :func:`os.getpid`.
+
+    """
+    return _process_id
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_update_process_id)
+else:  # pragma: no cover -- python < 3.7
+    process_id = os.getpid  # noqa: F811
+
+
+class _UnsupportedVar(object):
+    """
+    Stand-in for :class:`contextvars.ContextVar` that never holds a value.
+
+    This is used when :data:`.ACTIVE_REQUEST_SUPPORTED` is false.  A
+    value that is set outside of a context that follows the request's
+    coroutines would leak into whichever request runs next, so setting
+    the value does nothing and :meth:`.get` always returns the default.
+
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self._default = default
+
+    def get(self):
+        return self._default
+
+    def set(self, value):
+        return None
+
+    def reset(self, token):
+        pass
+
+
+ACTIVE_REQUEST_SUPPORTED = (contextvars is not None and
+                            tornado.version_info >= (5, 0))
+"""
+Is the active request carried across ``yield`` statements?
+
+Tornado runs coroutines on :mod:`asyncio` from version 5 on and
+:mod:`asyncio` copies the :mod:`contextvars` context into each callback
+from Python 3.7 on.  Both are required for :data:`.active_request` to
+follow a request through its coroutines.
+
+"""
+
+if ACTIVE_REQUEST_SUPPORTED:
+    active_request = contextvars.ContextVar('divak_active_request',
+                                            default=None)
+else:  # pragma: no cover -- python < 3.7 or tornado < 5
+    active_request = _UnsupportedVar('divak_active_request')
+"""
+Context variable that holds the request that is being processed.
+
+The request is set by :class:`.RequestTransform` and is inherited by
+the coroutines that process the request.  This is always :data:`None`
+unless :data:`.ACTIVE_REQUEST_SUPPORTED` is true.
+
+"""
+
+
+def get_request_id():
+    """
+    Retrieve the request ID of the active request.
+
+    :return: the ``divak_request_id`` of the active request or an
+        empty string if there is no active request or it does not
+        have an ID
+    :rtype: str
+
+    """
+    request = active_request.get()
+    if request is None:
+        return ''
+    return request.divak_request_id or ''
+
+
+class ActiveRequestScope(httputil.HTTPMessageDelegate):
+    """
+    Confines the active request to the coroutines that process it.
+
+    :param tornado.httputil.HTTPMessageDelegate delegate: the delegate
+        that processes the request
+
+    Tornado creates the request handler and invokes the transforms from
+    inside of the HTTP connection's read loop.  The coroutine that runs
+    the handler inherits a copy of the context at that time so setting
+    :data:`.active_request` in a transform makes the request visible to
+    the handler.  This delegate restores the previous value once the
+    handler is started so that the request does not leak into the
+    connection's context.
+
+    """
+
+    def __init__(self, delegate):
+        self._delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        token = active_request.set(None)
+        try:
+            return self._delegate.headers_received(start_line, headers)
+        finally:
+            active_request.reset(token)
+
+    def data_received(self, chunk):
+        return self._delegate.data_received(chunk)
+
+    def finish(self):
+        token = active_request.set(None)
+        try:
+            return self._delegate.finish()
+        finally:
+            active_request.reset(token)
+
+    def on_connection_close(self):
+        return self._delegate.on_connection_close()
 
 
 class IdentityTransformer(object):
@@ -15,20 +166,259 @@ class IdentityTransformer(object):
         return chunk
 
 
-class EnsureRequestIdTransformer(IdentityTransformer):
+class SetHeaderTransformer(IdentityTransformer):
     """
-    Transformer that creates the ``divak_request_id`` property on requests.
+    Transformer that sets a response header to a fixed value.
 
-    This simple Tornado transformer uses :func:`setattr` to ensure that
-    every request has a ``divak_request_id`` property.
+    :param str header_name: the response header to set
+    :param str value: the value to set it to
+
+    The header is only set if the request handler has not already
+    set it.
 
     """
 
-    def __init__(self, request, *args, **kwargs):
-        if not hasattr(request, 'divak_request_id'):
-            setattr(request, 'divak_request_id', None)
-        super(EnsureRequestIdTransformer, self).__init__(
-            request, *args, **kwargs)
+    def __init__(self, header_name, value):
+        super(SetHeaderTransformer, self).__init__(None)
+        self._header_name = header_name
+        self._value = value
+
+    def transform_first_chunk(self, status_code, headers, chunk,
+                              include_footers):
+        if headers.get(self._header_name, None) is None:
+            headers[self._header_name] = self._value
+        return status_code, headers, chunk
+
+
+class RouteResolver(object):
+    """
+    Finds the URL pattern that routed a request to a handler.
+
+    :param tornado.web.Application application: the application
+        to resolve routes for
+
+    Tornado does not record which :class:`~tornado.web.URLSpec` matched
+    a request so this class builds a map from handler class to the
+    URL patterns that the class is installed for.  The map is built
+    lazily for each handler class.  If a handler class is installed for
+    a single pattern, then resolving the route is a dictionary lookup.
+    Otherwise, the patterns are matched against the request path.  Call
+    :meth:`.reset` after adding handlers to the application.
+
+    """
+
+    UNMATCHED = 'unmatched'
+    """Route that is returned for handlers that are not routed."""
+
+    def __init__(self, application):
+        super(RouteResolver, self).__init__()
+        self._application = application
+        self._patterns = {}
+
+    def reset(self):
+        """Discard the cached patterns."""
+        self._patterns.clear()
+
+    def route_for(self, handler):
+        """
+        Find the URL pattern for `handler`.
+
+        :param tornado.web.RequestHandler handler: the handler that
+            processed the request
+        :return: the matched URL pattern without the trailing ``$``
+            or :attr:`.UNMATCHED`
+        :rtype: str
+
+        """
+        handler_class = handler.__class__
+        try:
+            patterns = self._patterns[handler_class]
+        except KeyError:
+            patterns = self._find_patterns(handler_class)
+            self._patterns[handler_class] = patterns
+
+        if len(patterns) == 1:
+            return patterns[0][1]
+        path = handler.request.path
+        for regex, pattern in patterns:
+            if regex.match(path):
+                return pattern
+        return self.UNMATCHED
+
+    def _find_patterns(self, handler_class):
+        patterns = []
+        for target, regex in _iter_routes(self._application):
+            if target is handler_class and regex is not None:
+                pattern = regex.pattern
+                if pattern.endswith('$'):
+                    pattern = pattern[:-1]
+                patterns.append((regex, divak.tracing.intern(pattern)))
+        return tuple(patterns)
+
+
+def _iter_routes(application):
+    """Generate the (target, regex) pairs that `application` routes."""
+    if hasattr(application, 'default_router'):  # tornado >= 4.5
+        routers = [application.default_router]
+        while routers:
+            router = routers.pop(0)
+            for rule in router.rules:
+                if hasattr(rule.target, 'rules'):
+                    routers.append(rule.target)
+                else:
+                    yield rule.target, getattr(rule.matcher, 'regex', None)
+    else:  # pragma: no cover -- tornado < 4.5
+        for _, specs in application.handlers:
+            for spec in specs:
+                yield spec.handler_class, spec.regex
+
+
+class RequestTransform(object):
+    """
+    Transform that performs all of the per-request divak processing.
+
+    :param propagators: sequence of propagators to call for each
+        request
+    :param tornado.httputil.HTTPServerRequest request: the request
+        that is being processed
+
+    :class:`divak.api.Recorder` installs this class as a transform
+    using :func:`functools.partial` to bind the list of propagators.
+    It replaces a chain of separate transforms with a single object
+    that:
+
+    1. ensures that the ``divak_request_id`` and ``divak_sampled``
+       properties exist on the request,
+    2. makes `request` the value of :data:`.active_request`,
+    3. calls ``process_request`` on each propagator and collects the
+       response headers that they return,
+    4. attaches a :class:`divak.tracing.Span` to sampled requests as
+       ``divak_span``, and
+    5. inserts the collected headers and records the time to first
+       byte when the first chunk is transformed.
+
+    """
+
+    __slots__ = ('_span', '_headers')
+
+    def __init__(self, propagators, request):
+        start = divak.tracing.monotonic()
+        attributes = request.__dict__
+        attributes.setdefault('divak_request_id', None)
+        attributes.setdefault('divak_sampled', True)
+        active_request.set(request)
+
+        headers = None
+        for propagator in propagators:
+            relay = propagator.process_request(request)
+            if relay:
+                if headers is None:
+                    headers = list(relay)
+                else:
+                    headers.extend(relay)
+        self._headers = headers
+
+        if request.divak_sampled:
+            self._span = divak.tracing.Span(start)
+        else:
+            self._span = None
+        request.divak_span = self._span
+
+    def transform_first_chunk(self, status_code, headers, chunk,
+                              include_footers):
+        if self._span is not None:
+            self._span.first_byte = divak.tracing.monotonic()
+        if self._headers is not None:
+            for name, value in self._headers:
+                # would like to use setdefault but HTTPHeaders does
+                # not support it in tornado 4.3
+                if headers.get(name, None) is None:
+                    headers[name] = value
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, include_footers):
+        return chunk
+
+
+class StreamTransform(object):
+    """
+    Transform that accounts for the chunks of a response.
+
+    :param tornado.httputil.HTTPServerRequest request: the request
+        that is being processed
+
+    :meth:`divak.api.Recorder.enable_divak_stream_accounting` installs
+    this class as a transform.  It attaches itself to the request as
+    ``divak_stream`` and counts the number of non-empty chunks and
+    bytes that pass through it.  Since Tornado transforms each chunk
+    when the handler flushes it, the time between successive chunks is
+    the time that the handler took to produce the next chunk plus the
+    time that it waited for the client to read the previous one.  The
+    longest of these gaps is kept in :attr:`.max_gap`.  Only the
+    length of each chunk is used so the chunks are never copied or
+    retained.
+
+    The bytes are counted after the transforms that Tornado installs
+    so they are the compressed size if the response is compressed.
+
+    .. attribute:: bytes
+
+       Number of response body bytes.
+
+    .. attribute:: chunks
+
+       Number of non-empty chunks.
+
+    .. attribute:: max_gap
+
+       Longest time in seconds between two successive chunks.
+
+    .. attribute:: first_chunk
+
+       Monotonic timestamp of the first chunk or :data:`None`.
+
+    .. attribute:: last_chunk
+
+       Monotonic timestamp of the most recent chunk or :data:`None`.
+
+    """
+
+    __slots__ = ('bytes', 'chunks', 'max_gap', 'first_chunk', 'last_chunk')
+
+    def __init__(self, request):
+        self.bytes = 0
+        self.chunks = 0
+        self.max_gap = 0.0
+        self.first_chunk = None
+        self.last_chunk = None
+        request.divak_stream = self
+
+    @property
+    def duration(self):
+        """Seconds between the first and last chunks."""
+        if self.first_chunk is None:
+            return 0.0
+        return self.last_chunk - self.first_chunk
+
+    def transform_first_chunk(self, status_code, headers, chunk,
+                              include_footers):
+        self.first_chunk = self.last_chunk = divak.tracing.monotonic()
+        if chunk:
+            self.bytes += len(chunk)
+            self.chunks += 1
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, include_footers):
+        now = divak.tracing.monotonic()
+        if self.last_chunk is not None:
+            gap = now - self.last_chunk
+            if gap > self.max_gap:
+                self.max_gap = gap
+        self.last_chunk = now
+        if chunk:
+            self.bytes += len(chunk)
+            self.chunks += 1
+        return chunk
 
 
 class DivakRequestIdFilter(logging.Filter):
@@ -38,13 +428,15 @@ class DivakRequestIdFilter(logging.Filter):
     This makes it possible to use ``divak_request_id`` in log formats
     without having to do additional work.  You shouldn't need to tinker
     with this yourself since :class:`divak.api.Recorder` does it for you
-    when a instance is created.
+    when a instance is created.  It is only used on Python versions
+    that do not have :func:`logging.setLogRecordFactory`.  The value is
+    retrieved by calling :func:`.get_request_id`.
 
     """
 
     def filter(self, record):
         if not hasattr(record, 'divak_request_id'):
-            setattr(record, 'divak_request_id', '')
+            setattr(record, 'divak_request_id', get_request_id())
         return 1
 
 
@@ -53,7 +445,10 @@ class DivakLogger(logging.Logger):
     Extends class:`logging.Logger` to ensure that divak_request_id is set.
 
     This class is installed via :func:`logging.setLoggerClass` to ensure
-    that the ``divak_request_id`` attribute is set on all records.
+    that the ``divak_request_id`` attribute is set on all records on
+    Python versions that do not have :func:`logging.setLogRecordFactory`.
+    The value is the request ID of the active request as returned from
+    :func:`.get_request_id`.
 
     """
 
@@ -62,7 +457,130 @@ class DivakLogger(logging.Logger):
         # between python versions
         record = super(DivakLogger, self).makeRecord(*args, **kwargs)
         if not hasattr(record, 'divak_request_id'):
-            setattr(record, 'divak_request_id', '')
+            setattr(record, 'divak_request_id', get_request_id())
+        return record
+
+
+class BufferingLogger(logging.Logger):
+    """
+    Holds records that the wrapped logger would discard.
+
+    :param logging.Logger logger: the logger that records are sent to
+    :param int capacity: the maximum number of records to hold
+
+    This logger is enabled for every level so records that are below
+    the effective level of `logger` are created and appended to a
+    bounded buffer instead of being discarded.  Records at or above
+    the effective level are passed to `logger` immediately.  Call
+    :meth:`.flush` to pass the buffered records to `logger`'s handlers
+    or :meth:`.discard` to throw them away.  When the buffer is full,
+    the oldest record is discarded and counted in :attr:`.dropped`.
+
+    .. attribute:: dropped
+
+       Number of records that were discarded because the buffer was
+       full.
+
+    """
+
+    def __init__(self, logger, capacity):
+        super(BufferingLogger, self).__init__(logger.name, logging.DEBUG)
+        self.logger = logger
+        self.records = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+    def makeRecord(self, *args, **kwargs):
+        return self.logger.makeRecord(*args, **kwargs)
+
+    def handle(self, record):
+        if record.levelno >= self.logger.getEffectiveLevel():
+            self.logger.handle(record)
+        else:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append(record)
+
+    def flush(self):
+        """Pass the buffered records to the wrapped logger."""
+        records, handle = self.records, self.logger.handle
+        while records:
+            handle(records.popleft())
+
+    def discard(self):
+        """Throw the buffered records away."""
+        self.records.clear()
+
+
+class _DefaultRequestId(object):
+    """
+    Non-data descriptor that supplies a record's default request ID.
+
+    Attributes in the instance dictionary take precedence over non-data
+    descriptors so a ``divak_request_id`` that is copied from ``extra``
+    by :meth:`logging.Logger.makeRecord` replaces the default.
+
+    """
+
+    def __get__(self, record, owner=None):
+        if record is None:
+            return self
+        return record._divak_request_id
+
+
+class RequestIdLogRecord(logging.LogRecord):
+    """
+    Log record that defaults `divak_request_id` to the active request.
+
+    This class is installed by :func:`.initialize_logging` with
+    :func:`logging.setLogRecordFactory`.  The request ID is captured
+    once when the record is constructed by calling
+    :func:`.get_request_id` so it is present regardless of which logger
+    class created the record.  The ID is exposed by a class-level
+    default instead of being stored as ``divak_request_id`` in the
+    record's dictionary.  This keeps :meth:`logging.Logger.makeRecord`
+    from rejecting a ``divak_request_id`` that is passed in ``extra``
+    and the value from ``extra`` takes precedence.  The default is
+    copied into the record's dictionary when the message is formatted
+    so that format strings such as ``%(divak_request_id)s`` work.
+
+    """
+
+    divak_request_id = _DefaultRequestId()
+
+    def __init__(self, *args, **kwargs):
+        super(RequestIdLogRecord, self).__init__(*args, **kwargs)
+        self._divak_request_id = get_request_id()
+
+    def getMessage(self):
+        attributes = self.__dict__
+        if 'divak_request_id' not in attributes:
+            attributes['divak_request_id'] = self._divak_request_id
+        return super(RequestIdLogRecord, self).getMessage()
+
+
+class RequestIdRecordFactory(object):
+    """
+    Log record factory that sets `divak_request_id` on every record.
+
+    :param factory: the record factory to create records with
+
+    This is installed by :func:`.initialize_logging` when a record
+    factory other than :class:`logging.LogRecord` is already installed.
+    The attribute is set when the record is constructed by calling
+    :func:`.get_request_id`.  Since the records are not
+    :class:`.RequestIdLogRecord` instances, passing ``divak_request_id``
+    in the ``extra`` parameter of a log call raises a :exc:`KeyError`.
+
+    """
+
+    __slots__ = ('factory',)
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, *args, **kwargs):
+        record = self.factory(*args, **kwargs)
+        record.divak_request_id = get_request_id()
         return record
 
 
@@ -75,35 +593,45 @@ def initialize_logging():
     ``divak_request_id`` property.  This makes it possible to refer to
     the request id in your log formats.
 
-    Firstly, it installs a new :class:`logging.Logger` class by calling
-    :func:`logging.setLoggerClass` that sets the attribute in it's
-    :meth:`logging.Logger.makeRecord` method if it not already present.
-    Then it spins through the existing loggers and adds
-    :class:`.DivakRequestIdFilter` to any handler that doesn't already have
-    one.  This process ensures that new and existing loggers can refer to
-    the request id in log formats.
+    :class:`.RequestIdLogRecord` is installed by calling
+    :func:`logging.setLogRecordFactory` if the default factory is in
+    use.  Another factory is wrapped in a
+    :class:`.RequestIdRecordFactory` instead.  Since every record is
+    created by the factory, this covers existing loggers and loggers of
+    any class without visiting them.  Calling this again does nothing
+    if either factory is already installed.
+
+    Python versions without :func:`logging.setLogRecordFactory` fall
+    back to installing :class:`.DivakLogger` by calling
+    :func:`logging.setLoggerClass` and adding a
+    :class:`.DivakRequestIdFilter` to the handlers of existing loggers.
 
     """
-    # First we need to insert our own logger class.  That is the
-    # easy part.
-    logging.setLoggerClass(DivakLogger)
+    if hasattr(logging, 'setLogRecordFactory'):
+        factory = logging.getLogRecordFactory()
+        if factory is logging.LogRecord:
+            logging.setLogRecordFactory(RequestIdLogRecord)
+        elif not (factory is RequestIdLogRecord or
+                  isinstance(factory, RequestIdRecordFactory)):
+            logging.setLogRecordFactory(RequestIdRecordFactory(factory))
+        return
+
+    _initialize_legacy_logging()  # pragma: no cover -- python 2
 
-    # ... and then insert filters on all active logging.Handler
-    # instances that already exist... so much work!
+
+def _initialize_legacy_logging():  # pragma: no cover -- python 2
+    logging.setLoggerClass(DivakLogger)
     log_filter = DivakRequestIdFilter()
     known_handlers = set()
-    for logger in logging.Logger.manager.loggerDict.values():
+    loggers = list(logging.Logger.manager.loggerDict.values())
+    loggers.append(logging.getLogger())
+    for logger in loggers:
         if isinstance(logger, logging.Logger):
             for handler in logger.handlers:
                 if handler not in known_handlers:
                     if not _has_divak_filter(handler.filters):
                         handler.addFilter(log_filter)
                     known_handlers.add(handler)
-    for handler in logging.getLogger().handlers:
-        if handler not in known_handlers:
-            if not _has_divak_filter(handler.filters):
-                handler.addFilter(log_filter)
-            known_handlers.add(filter)
 
 
 def _has_divak_filter(filters):
@@ -0,0 +1,444 @@
+import array
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import struct
+
+from tornado import process, web
+
+
+MIN_EXPONENT = -14
+"""Values at or below ``2 ** MIN_EXPONENT`` seconds share the first bucket."""
+
+OCTAVES = 21
+"""Number of powers of two that are covered by linear sub-buckets."""
+
+SUB_BUCKETS = 4
+"""Number of linear sub-buckets in each power of two."""
+
+
+def _bucket_bounds():
+    bounds = [math.ldexp(1.0, MIN_EXPONENT)]
+    for octave in range(OCTAVES):
+        base = math.ldexp(1.0, MIN_EXPONENT + octave)
+        for sub in range(SUB_BUCKETS):
+            bounds.append(base + base * (sub + 1) / SUB_BUCKETS)
+    return tuple(bounds)
+
+
+BUCKET_BOUNDS = _bucket_bounds()
+"""Upper bound of each finite histogram bucket in seconds."""
+
+
+class LatencyHistogram(object):
+    """
+    Fixed-size histogram of durations.
+
+    :keyword values: optional storage for the histogram.  This is a
+        mutable sequence of ``len(BUCKET_BOUNDS) + 2`` floats that is
+        allocated when omitted.
+
+    The buckets are *log-linear*: each power of two between
+    ``2 ** MIN_EXPONENT`` and ``2 ** (MIN_EXPONENT + OCTAVES)`` seconds
+    is split into :data:`SUB_BUCKETS` equal-width buckets which keeps
+    the relative error of every bucket under ``1 / SUB_BUCKETS``.  The
+    bucket for a value is calculated from its binary exponent and
+    mantissa so recording a sample is a little arithmetic and two
+    increments of preallocated storage.
+
+    Like Prometheus' ``le`` buckets, each bucket includes its upper
+    bound.
+
+    The storage is laid out as one count per finite bucket, the
+    overflow count, and the sum of the recorded values.
+
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = array.array('d', [0.0] * (len(BUCKET_BOUNDS) + 2))
+        self.values = values
+
+    def record(self, seconds):
+        """
+        Record a single duration.
+
+        :param float seconds: the duration to record
+
+        """
+        mantissa, exponent = math.frexp(seconds)
+        octave = exponent - 1 - MIN_EXPONENT
+        if octave < 0 or mantissa <= 0.0:
+            index = 0
+        else:
+            # buckets include their upper bound so a value that lands
+            # exactly on a boundary belongs to the bucket below it
+            index = octave * SUB_BUCKETS + int(
+                math.ceil((mantissa * 2.0 - 1.0) * SUB_BUCKETS))
+            if index > len(BUCKET_BOUNDS):
+                index = len(BUCKET_BOUNDS)
+        values = self.values
+        values[index] += 1
+        values[-1] += seconds
+
+    @property
+    def count(self):
+        """Number of recorded values."""
+        return sum(self.values[:-1])
+
+    @property
+    def sum(self):
+        """Sum of the recorded values."""
+        return self.values[-1]
+
+    def quantile(self, q):
+        """
+        Estimate a quantile from the bucket counts.
+
+        :param float q: the quantile to estimate between 0 and 1
+        :return: the upper bound of the bucket that contains the
+            quantile or :data:`None` if nothing has been recorded
+        :rtype: float
+
+        Values in the overflow bucket are reported as
+        :data:`float('inf') <float>`.
+
+        """
+        counts = self.values[:-1]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        running = 0
+        for index, count in enumerate(counts):
+            running += count
+            if running >= rank and count:
+                if index < len(BUCKET_BOUNDS):
+                    return BUCKET_BOUNDS[index]
+                break
+        return float('inf')
+
+
+class Counter(object):
+    """
+    Monotonically increasing total.
+
+    :keyword values: optional storage for the counter.  This is
+        a mutable sequence of at least one float that is allocated when
+        omitted.
+
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = array.array('d', [0.0])
+        self.values = values
+
+    def increment(self, amount=1):
+        """
+        Add `amount` to the total.
+
+        :param amount: the non-negative amount to add
+
+        """
+        self.values[0] += amount
+
+    @property
+    def value(self):
+        """The current total."""
+        return self.values[0]
+
+
+class MetricsRegistry(object):
+    """
+    Holds named metrics and renders them in Prometheus format.
+
+    Histograms and counters are identified by a metric name and a
+    tuple of ``(label, value)`` pairs.  They are created the first time
+    that they are requested and kept for the life of the registry so
+    the number of distinct label values needs to be bounded.
+
+    """
+
+    def __init__(self):
+        super(MetricsRegistry, self).__init__()
+        self._histograms = {}
+        self._counters = {}
+        self._descriptions = {}
+
+    def describe(self, name, description):
+        """
+        Set the ``HELP`` text for a metric.
+
+        :param str name: the metric name
+        :param str description: the text to emit
+
+        """
+        self._descriptions[name] = description
+
+    def histogram(self, name, labels=()):
+        """
+        Retrieve a histogram, creating it if necessary.
+
+        :param str name: the metric name
+        :param tuple labels: ``(label, value)`` pairs that identify
+            the histogram
+        :rtype: LatencyHistogram
+
+        """
+        key = (name, labels)
+        try:
+            return self._histograms[key]
+        except KeyError:
+            histogram = self._create_histogram(name, labels)
+            self._histograms[key] = histogram
+            return histogram
+
+    def counter(self, name, labels=()):
+        """
+        Retrieve a counter, creating it if necessary.
+
+        :param str name: the metric name which should end with
+            ``_total``
+        :param tuple labels: ``(label, value)`` pairs that identify
+            the counter
+        :rtype: Counter
+
+        """
+        key = (name, labels)
+        try:
+            return self._counters[key]
+        except KeyError:
+            counter = self._create_counter(name, labels)
+            self._counters[key] = counter
+            return counter
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        :rtype: str
+
+        """
+        return self._render(self._histograms, self._counters)
+
+    def _render(self, histograms, counters):
+        lines = []
+        last_name = None
+        for name, labels in sorted(histograms):
+            histogram = histograms[name, labels]
+            if name != last_name:
+                if name in self._descriptions:
+                    lines.append('# HELP {} {}'.format(
+                        name, self._descriptions[name]))
+                lines.append('# TYPE {} histogram'.format(name))
+                last_name = name
+            label_text = ''.join('{}="{}",'.format(label, _escape(value))
+                                 for label, value in labels)
+            values = histogram.values
+            running = 0
+            for index, bound in enumerate(BUCKET_BOUNDS):
+                running += values[index]
+                lines.append('{}_bucket{{{}le="{!r}"}} {:.0f}'.format(
+                    name, label_text, bound, running))
+            running += values[len(BUCKET_BOUNDS)]
+            lines.append('{}_bucket{{{}le="+Inf"}} {:.0f}'.format(
+                name, label_text, running))
+            label_text = label_text.rstrip(',')
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append('{}_sum{} {!r}'.format(name, label_text, values[-1]))
+            lines.append('{}_count{} {:.0f}'.format(name, label_text,
+                                                    running))
+        for name, labels in sorted(counters):
+            if name != last_name:
+                if name in self._descriptions:
+                    lines.append('# HELP {} {}'.format(
+                        name, self._descriptions[name]))
+                lines.append('# TYPE {} counter'.format(name))
+                last_name = name
+            label_text = ','.join('{}="{}"'.format(label, _escape(value))
+                                  for label, value in labels)
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append('{}{} {!r}'.format(name, label_text,
+                                            counters[name, labels].value))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _create_histogram(self, name, labels):
+        return LatencyHistogram()
+
+    def _create_counter(self, name, labels):
+        return Counter()
+
+
+class SharedMetricsRegistry(MetricsRegistry):
+    """
+    Registry that aggregates histograms across forked processes.
+
+    :keyword int max_workers: the number of worker processes to reserve
+        space for.  This defaults to the number of CPUs.
+    :keyword int max_histograms: the number of distinct histograms and
+        counters to reserve space for
+
+    The histograms and counters are stored in an anonymous shared
+    memory map so the
+    registry **MUST** be created before calling
+    :func:`tornado.process.fork_processes`.  Each histogram has a
+    separate slot for each worker that is selected by
+    :func:`tornado.process.task_id` so workers record into their own
+    slot without locking.  :meth:`.render` sums the slots of every
+    histogram that any worker has created so whichever worker handles
+    the scrape reports the same host-level view.
+
+    The identity of each histogram is stored in a key table in the
+    shared memory.  Adding a histogram to the table is guarded by
+    a :func:`multiprocessing.Lock` which only happens the first time
+    a worker uses a histogram.  If the table or the worker slots are
+    exhausted, then a warning is logged and a private histogram is
+    returned instead.
+
+    This requires Python 3.
+
+    """
+
+    KEY_BYTES = 256
+    """Average number of bytes reserved for each metric's key."""
+
+    _HEADER = struct.Struct('=II')
+    _KEY_LENGTH = struct.Struct('=I')
+
+    def __init__(self, max_workers=None, max_histograms=256):
+        super(SharedMetricsRegistry, self).__init__()
+        self.max_workers = max_workers or process.cpu_count()
+        self.max_histograms = max_histograms
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._lock = multiprocessing.Lock()
+        self._stride = (len(BUCKET_BOUNDS) + 2) * 8
+        self._key_offset = self._HEADER.size
+        self._key_space = max_histograms * self.KEY_BYTES
+        self._data_offset = self._key_offset + self._key_space
+        self._data_offset += -self._data_offset % 8
+        self._memory = mmap.mmap(
+            -1, (self._data_offset +
+                 max_histograms * self.max_workers * self._stride))
+        self._keys = {}
+        self._scanned = 0
+
+    def render(self):
+        """
+        Render the sum of every worker's histograms.
+
+        :rtype: str
+
+        """
+        with self._lock:
+            self._scan_keys()
+        histograms, counters = {}, {}
+        for key, (index, kind) in self._keys.items():
+            if kind == 'counter':
+                metric = counters[key] = Counter()
+            else:
+                metric = histograms[key] = LatencyHistogram()
+            totals = metric.values
+            for worker in range(self.max_workers):
+                slot = self._slot(index, worker)
+                for offset in range(len(totals)):
+                    totals[offset] += slot[offset]
+        for key, histogram in self._histograms.items():
+            if key not in histograms:  # private fallback histograms
+                histograms[key] = histogram
+        for key, counter in self._counters.items():
+            if key not in counters:  # private fallback counters
+                counters[key] = counter
+        return self._render(histograms, counters)
+
+    def _create_histogram(self, name, labels):
+        slot = self._shared_slot(name, labels, 'histogram')
+        return LatencyHistogram(slot)
+
+    def _create_counter(self, name, labels):
+        slot = self._shared_slot(name, labels, 'counter')
+        return Counter(slot)
+
+    def _shared_slot(self, name, labels, kind):
+        worker = process.task_id() or 0
+        if worker >= self.max_workers:
+            self._logger.warning('worker %d exceeds max_workers=%d, %s will '
+                                 'not be shared', worker, self.max_workers,
+                                 name)
+            return None
+        with self._lock:
+            index = self._register((name, labels), kind)
+        if index is None:
+            self._logger.warning('shared metrics space exhausted, %s %r will '
+                                 'not be shared', name, labels)
+            return None
+        return self._slot(index, worker)
+
+    def _slot(self, index, worker):
+        offset = (self._data_offset +
+                  (index * self.max_workers + worker) * self._stride)
+        return memoryview(self._memory)[offset:offset + self._stride].cast(
+            'd')
+
+    def _register(self, key, kind):
+        self._scan_keys()
+        if key in self._keys:
+            return self._keys[key][0]
+
+        used, count = self._HEADER.unpack_from(self._memory, 0)
+        encoded = json.dumps([key[0], key[1], kind]).encode('utf-8')
+        size = self._KEY_LENGTH.size + len(encoded)
+        if count >= self.max_histograms or used + size > self._key_space:
+            return None
+        offset = self._key_offset + used
+        self._KEY_LENGTH.pack_into(self._memory, offset, len(encoded))
+        offset += self._KEY_LENGTH.size
+        self._memory[offset:offset + len(encoded)] = encoded
+        self._HEADER.pack_into(self._memory, 0, used + size, count + 1)
+        self._scan_keys()
+        return self._keys[key][0]
+
+    def _scan_keys(self):
+        used = self._HEADER.unpack_from(self._memory, 0)[0]
+        while self._scanned < used:
+            offset = self._key_offset + self._scanned
+            length, = self._KEY_LENGTH.unpack_from(self._memory, offset)
+            offset += self._KEY_LENGTH.size
+            name, labels, kind = json.loads(
+                self._memory[offset:offset + length].decode('utf-8'))
+            key = (name, tuple(tuple(pair) for pair in labels))
+            self._keys[key] = (len(self._keys), kind)
+            self._scanned += self._KEY_LENGTH.size + length
+
+
+class PrometheusHandler(web.RequestHandler):
+    """
+    Exposes a :class:`.MetricsRegistry` in Prometheus text format.
+
+    This handler is installed by
+    :meth:`divak.api.Recorder.enable_divak_metrics`.  It requires a
+    ``registry`` keyword in the handler's initialization arguments.
+
+    """
+
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.registry.render())
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
@@ -0,0 +1,443 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import weakref
+
+from tornado import ioloop, web
+
+import divak.tracing
+
+
+_MAX_PENDING = 10000
+_MAX_LABELS = 10000
+
+
+class StackSampler(object):
+    """
+    Samples the IOLoop thread's stack on behalf of slow requests.
+
+    :param float budget: requests that take at least this many seconds
+        have their samples kept
+    :keyword float interval: seconds between samples
+    :keyword route_for: callable that returns the route label for a
+        request handler.  The handler's class name is used if this is
+        omitted.
+    :keyword int thread_id: identifier of the thread to sample.  This
+        defaults to the thread that creates the sampler.
+    :keyword int max_depth: maximum number of frames in a sample
+    :keyword int max_stacks: maximum number of distinct stacks that
+        are kept for each route
+    :keyword int max_requests: maximum number of slow requests that
+        are kept for :meth:`.collapsed`'s `request_id` parameter
+
+    A daemon thread wakes up every `interval` seconds and walks the
+    sampled thread's current stack.  Only the code object of each
+    frame is read from the sampling thread so the sample is queued
+    along with the frames that might belong to a request handler.  The
+    frames are examined on the IOLoop thread when the next request
+    finishes.  If one of the frames is a method of
+    a :class:`tornado.web.RequestHandler`, then the stack is counted
+    against that handler's request.  Since the IOLoop thread is only
+    inside of a handler while the handler is running, the samples show
+    where the IOLoop spent time on behalf of the request and not the
+    time that the request spent waiting.
+
+    :meth:`.finish` is called by :class:`divak.api.Recorder` when each
+    request finishes.  The request's samples are merged into the
+    collapsed stacks of its route if it took at least `budget` seconds
+    and discarded otherwise.  Samples that are taken after the request
+    finishes, such as while the handler's ``on_finish`` runs, are
+    discarded so they cannot hold on to the handler.  Memory is bounded
+    by `max_stacks` per route, by `max_requests`, and by the number of
+    queued samples.
+
+    .. attribute:: slow_requests
+
+       :class:`collections.deque` of ``(request_id, route, duration,
+       stacks)`` tuples for the most recent slow requests.  `stacks`
+       is a :class:`collections.Counter` of collapsed stacks.
+
+    .. attribute:: truncated
+
+       Number of samples that were discarded because the route already
+       had `max_stacks` distinct stacks.
+
+    """
+
+    def __init__(self, budget, interval=0.01, route_for=None,
+                 thread_id=None, max_depth=64, max_stacks=1000,
+                 max_requests=100):
+        super(StackSampler, self).__init__()
+        self.budget = budget
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.slow_requests = collections.deque(maxlen=max_requests)
+        self.truncated = 0
+        self._route_for = route_for or _class_name
+        self._thread_id = thread_id or _get_ident()
+        self._labels = {}
+        self._samples = collections.deque(maxlen=_MAX_PENDING)
+        self._pending = {}
+        self._finished = weakref.WeakSet()
+        self._routes = {}
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Start the sampling thread."""
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='divak-stack-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the sampling thread."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def sample(self, frame):
+        """
+        Record a single sample.
+
+        :param frame: the innermost frame of the stack to record
+
+        This is called from the sampling thread.  It is public so that
+        samples can be recorded from other sources such as a signal
+        handler.
+
+        """
+        frames, stack = _walk_stack(frame, self._labels, self.max_depth)
+        if frames:
+            self._samples.append((frames, stack))
+
+    def finish(self, handler, duration):
+        """
+        Keep or discard the samples for a finished request.
+
+        :param tornado.web.RequestHandler handler: the handler that
+            processed the request
+        :param float duration: the request duration in seconds
+
+        """
+        self._assign_samples()
+        self._finished.add(handler)
+        stacks = self._pending.pop(handler, None)
+        if stacks is None or duration < self.budget:
+            return
+
+        route = self._route_for(handler)
+        request_id = getattr(handler.request, 'divak_request_id', None)
+        self.slow_requests.append((request_id, route, duration, stacks))
+        totals = self._routes.get(route)
+        if totals is None:
+            totals = self._routes[route] = collections.Counter()
+        for stack, count in stacks.items():
+            if stack in totals or len(totals) < self.max_stacks:
+                totals[stack] += count
+            else:
+                self.truncated += count
+
+    def collapsed(self, route=None, request_id=None):
+        """
+        Render the samples as collapsed stacks.
+
+        :keyword str route: only include this route
+        :keyword str request_id: only include the slow request with
+            this ID
+        :return: one ``frame;frame;frame count`` line per stack which
+            is the input format of ``flamegraph.pl`` and speedscope
+        :rtype: str
+
+        The route is the outermost frame of each stack unless `route`
+        or `request_id` is specified.
+
+        """
+        lines = []
+        if request_id is not None:
+            for slow_id, _, _, stacks in list(self.slow_requests):
+                if slow_id == request_id:
+                    lines.extend(_collapse(None, stacks))
+        elif route is not None:
+            lines.extend(_collapse(None, self._routes.get(route, {})))
+        else:
+            for name, stacks in sorted(self._routes.items()):
+                lines.extend(_collapse(name, stacks))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _assign_samples(self):
+        samples = self._samples
+        pending = self._pending
+        finished = self._finished
+        while samples:
+            frames, stack = samples.popleft()
+            handler = _find_handler(frames)
+            if handler is None or handler in finished:
+                continue
+            stacks = pending.get(handler)
+            if stacks is None:
+                if len(pending) >= _MAX_PENDING:
+                    continue
+                stacks = pending[handler] = collections.Counter()
+            stacks[stack] += 1
+
+    def _run(self):
+        current_frames = sys._current_frames
+        wait = self._stopping.wait
+        while not wait(self.interval):
+            frame = current_frames().get(self._thread_id)
+            if frame is not None:
+                self.sample(frame)
+            del frame
+
+
+class ProfileHandler(web.RequestHandler):
+    """
+    Exposes the samples from a :class:`.StackSampler`.
+
+    This handler is installed by
+    :meth:`divak.api.Recorder.enable_divak_profiler`.  It requires a
+    ``sampler`` keyword in the handler's initialization arguments.  The
+    optional ``route`` and ``request_id`` query parameters are passed
+    to :meth:`.StackSampler.collapsed`.
+
+    """
+
+    def initialize(self, sampler):
+        self.sampler = sampler
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(self.sampler.collapsed(
+            route=self.get_query_argument('route', None),
+            request_id=self.get_query_argument('request_id', None)))
+
+
+BlockingEvent = collections.namedtuple(
+    'BlockingEvent', ['duration', 'request_id', 'handler', 'stack'])
+"""
+Describes the IOLoop being blocked.
+
+``duration`` is how long the IOLoop had been blocked when the stack was
+captured.  ``request_id`` and ``handler`` identify the request handler
+that was running or are :data:`None` if the IOLoop was not running a
+request handler.  ``stack`` is the collapsed stack of the IOLoop thread.
+
+"""
+
+
+class LoopMonitor(object):
+    """
+    Detects when the IOLoop is blocked and by which request.
+
+    :keyword float threshold: seconds that the IOLoop has to be
+        blocked before it is reported
+    :keyword float interval: seconds between lag measurements
+    :keyword divak.metrics.MetricsRegistry registry: registry to record
+        the histograms in.  Histograms are not recorded if this is
+        omitted.
+    :keyword int thread_id: identifier of the thread that runs the
+        IOLoop.  This defaults to the thread that calls :meth:`.start`.
+    :keyword int max_events: number of recent :class:`.BlockingEvent`
+        instances to keep in :attr:`.events`
+    :keyword int max_depth: maximum number of frames in a captured
+        stack
+
+    A callback on the IOLoop reschedules itself every `interval`
+    seconds and records how late it ran in the :attr:`.LAG` histogram.
+    Lags of at least `threshold` are also recorded in the
+    :attr:`.BLOCKED` histogram so its ``_count`` is the number of
+    blocking events.  Since a blocked IOLoop cannot report on itself,
+    a watchdog thread checks when the callback last ran.  Once the
+    IOLoop is overdue by `threshold` seconds, the watchdog captures the
+    IOLoop thread's stack.  The request handler that was running is
+    found on the IOLoop thread as soon as the IOLoop runs again, then
+    a :class:`.BlockingEvent` is appended to :attr:`.events` and
+    a warning that includes the request ID and the stack is logged.
+    Each blocking episode is reported once.
+
+    .. attribute:: events
+
+       :class:`collections.deque` of the most recent
+       :class:`.BlockingEvent` instances.
+
+    """
+
+    LAG = 'divak_ioloop_lag_seconds'
+    """Name of the scheduling lag histogram."""
+
+    BLOCKED = 'divak_ioloop_blocked_seconds'
+    """Name of the histogram of lags that exceeded the threshold."""
+
+    def __init__(self, threshold=0.1, interval=0.05, registry=None,
+                 thread_id=None, max_events=100, max_depth=64):
+        super(LoopMonitor, self).__init__()
+        self.threshold = threshold
+        self.interval = interval
+        self.max_depth = max_depth
+        self.events = collections.deque(maxlen=max_events)
+        self._logger = logging.getLogger(__name__).getChild(
+            self.__class__.__name__)
+        self._registry = registry
+        self._lag = self._blocked = None
+        if registry is not None:
+            registry.describe(self.LAG, 'IOLoop scheduling lag.')
+            registry.describe(self.BLOCKED,
+                              'IOLoop scheduling lag over the threshold.')
+        self._thread_id = thread_id
+        self._labels = {}
+        self._io_loop = None
+        self._timeout = None
+        self._expected = None
+        self._heartbeat = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Start monitoring the current IOLoop."""
+        if self._thread is None:
+            if self._thread_id is None:
+                self._thread_id = _get_ident()
+            if self._registry is not None:
+                # looked up here since shared registries assign
+                # histograms to the worker process that creates them
+                self._lag = self._registry.histogram(self.LAG)
+                self._blocked = self._registry.histogram(self.BLOCKED)
+            self._io_loop = ioloop.IOLoop.current()
+            self._schedule(divak.tracing.monotonic())
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._watch,
+                                            name='divak-loop-monitor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop monitoring."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self, now):
+        self._heartbeat = now
+        self._expected = now + self.interval
+        self._timeout = self._io_loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        now = divak.tracing.monotonic()
+        lag = max(0.0, now - self._expected)
+        if self._lag is not None:
+            self._lag.record(lag)
+            if lag >= self.threshold:
+                self._blocked.record(lag)
+        self._schedule(now)
+
+    def _watch(self):
+        reported = None
+        current_frames = sys._current_frames
+        while not self._stopping.wait(self.threshold / 2.0):
+            heartbeat = self._heartbeat
+            blocked = (divak.tracing.monotonic() - heartbeat -
+                       self.interval)
+            if blocked < self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = current_frames().get(self._thread_id)
+            frames, stack = _walk_stack(frame, self._labels,
+                                        self.max_depth)
+            del frame
+            self._io_loop.add_callback(self._report, blocked, frames,
+                                       stack)
+
+    def _report(self, blocked, frames, stack):
+        handler = _find_handler(frames)
+        request_id = name = None
+        if handler is not None:
+            request_id = getattr(handler.request, 'divak_request_id', None)
+            name = handler.__class__.__name__
+        self.events.append(BlockingEvent(blocked, request_id, name, stack))
+        self._logger.warning(
+            'IOLoop blocked for at least %.3f seconds by %s request %s: %s',
+            blocked, name, request_id, stack)
+
+
+def _walk_stack(frame, labels, max_depth):
+    """
+    Collapse a stack that may belong to another thread.
+
+    :param frame: the innermost frame of the stack
+    :param dict labels: cache of frame labels by code object
+    :param int max_depth: maximum number of frames to include
+    :return: the frames that may be request handler methods and the
+        collapsed stack
+    :rtype: tuple
+
+    Only the code objects are read from the frames since the locals of
+    a running frame are not safe to read from another thread before
+    Python 3.13.  :func:`._find_handler` examines the returned frames
+    once it is safe to do so.
+
+    """
+    frames = []
+    names = []
+    depth = 0
+    while frame is not None and depth < max_depth:
+        code = frame.f_code
+        label = labels.get(code)
+        if label is None:
+            label = '{}:{}'.format(os.path.basename(code.co_filename),
+                                   code.co_name)
+            if len(labels) < _MAX_LABELS:
+                labels[code] = label
+        names.append(label)
+        if code.co_varnames[:1] == ('self',):
+            frames.append(frame)
+        frame = frame.f_back
+        depth += 1
+    names.reverse()
+    return tuple(frames), ';'.join(names)
+
+
+def _find_handler(frames):
+    """
+    Find the request handler that one of `frames` is a method of.
+
+    :param frames: frames from :func:`._walk_stack`, innermost first
+    :rtype: tornado.web.RequestHandler
+
+    This reads the locals of the frames so it must be called from the
+    thread that the frames belong to.
+
+    """
+    for frame in frames:
+        candidate = frame.f_locals.get('self')
+        if isinstance(candidate, web.RequestHandler):
+            return candidate
+    return None
+
+
+def _class_name(handler):
+    return handler.__class__.__name__
+
+
+def _collapse(prefix, stacks):
+    for stack, count in sorted(stacks.items()):
+        if prefix is not None:
+            stack = prefix + ';' + stack
+        yield '{} {}'.format(stack, count)
+
+
+try:
+    _get_ident = threading.get_ident
+except AttributeError:  # pragma: no cover -- python 2
+    import thread
+    _get_ident = thread.get_ident
@@ -0,0 +1,551 @@
+import collections
+import logging
+import mmap
+import os
+import pickle
+import struct
+
+from tornado import gen, ioloop
+
+
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+"""Discard the oldest queued observation to make room for a new one."""
+
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+"""Discard the incoming observation when the queue is full."""
+
+OVERFLOW_DISCARD = 'discard'
+"""
+Discard everything that is queued when the queue is full.
+
+The incoming observation is kept and starts a fresh queue.  This sheds
+a stale backlog in one step instead of trickling through it.
+
+"""
+
+_OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST,
+                      OVERFLOW_DISCARD)
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PartialReportError(Exception):
+    """
+    Raised by a reporter that delivered only part of a batch.
+
+    :param list observations: the observations that were not delivered
+    :param Exception error: the error that stopped the delivery
+
+    :class:`.SpoolingReporter` spools only :attr:`.observations` when
+    a reporter raises this so that the observations that were already
+    delivered are not sent again.
+
+    .. attribute:: observations
+
+       The observations that were not delivered.
+
+    .. attribute:: error
+
+       The error that stopped the delivery.
+
+    """
+
+    def __init__(self, observations, error):
+        super(PartialReportError, self).__init__(observations, error)
+        self.observations = observations
+        self.error = error
+
+    def __str__(self):
+        return '{} observations were not delivered: {}'.format(
+            len(self.observations), self.error)
+
+
+class ReportingPipeline(object):
+    """
+    Batches observations and delivers them to reporters.
+
+    :keyword int batch_size: maximum number of observations delivered
+        to reporters at once.  Reaching this many queued observations
+        triggers a flush.
+    :keyword float flush_interval: number of seconds between periodic
+        flushes of whatever is queued.
+    :keyword int max_queue_size: maximum number of observations to
+        hold while waiting for delivery.
+    :keyword str overflow_policy: what to do when an observation
+        arrives and the queue is full.  This is one of
+        :data:`OVERFLOW_DROP_OLDEST`, :data:`OVERFLOW_DROP_NEWEST`, or
+        :data:`OVERFLOW_DISCARD`.
+
+    :keyword tail_sampler: an object with a ``filter`` method that
+        is called with each batch before it is delivered and returns
+        the observations to deliver such as
+        :class:`divak.tracing.TailSampler`.
+
+    The request path calls :meth:`.add` to queue an observation.  That
+    is an append to a :class:`collections.deque` and a length check
+    so it is safe to call on every request.  Observations are delivered
+    from IOLoop callbacks when either `batch_size` observations are
+    queued or `flush_interval` seconds have elapsed.
+
+    Reporters are objects that implement a ``report`` method that is
+    called with a :class:`list` of observations.  The method may return
+    an awaitable.  Only one delivery is active at any time so a slow
+    reporter causes observations to queue up instead of requests to
+    slow down.  The `overflow_policy` bounds the memory consumed while
+    that happens and :attr:`.dropped` counts the casualties.
+
+    .. attribute:: dropped
+
+       Number of observations that were discarded because the queue
+       was full.
+
+    .. attribute:: reporters
+
+       :class:`list` of reporters that receive each batch.
+
+    .. attribute:: tail_sampler
+
+       The `tail_sampler` passed to the initializer.  This can be
+       changed at any time.
+
+    """
+
+    def __init__(self, batch_size=100, flush_interval=1.0,
+                 max_queue_size=10000, overflow_policy=OVERFLOW_DROP_OLDEST,
+                 tail_sampler=None):
+        super(ReportingPipeline, self).__init__()
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError('invalid overflow policy {!r}'.format(
+                overflow_policy))
+        if batch_size < 1 or max_queue_size < batch_size:
+            raise ValueError('max_queue_size must be at least batch_size')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.reporters = []
+        self.tail_sampler = tail_sampler
+        self._queue = collections.deque()
+        self._periodic = None
+        self._flush_scheduled = False
+        self._delivery = None
+
+    def add(self, observation):
+        """
+        Queue `observation` for delivery.
+
+        :param observation: the observation to deliver to reporters
+
+        """
+        queue = self._queue
+        if len(queue) >= self.max_queue_size:
+            policy = self.overflow_policy
+            if policy == OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                return
+            if policy == OVERFLOW_DISCARD:
+                self.dropped += len(queue)
+                queue.clear()
+            else:
+                self.dropped += 1
+                queue.popleft()
+
+        queue.append(observation)
+        if self._periodic is None:
+            self.start()
+        if len(queue) >= self.batch_size and not self._flush_scheduled:
+            self._flush_scheduled = True
+            ioloop.IOLoop.current().add_callback(self.flush)
+
+    def start(self):
+        """Start the periodic flush on the current IOLoop."""
+        if self._periodic is None:
+            self._periodic = ioloop.PeriodicCallback(
+                self.flush, self.flush_interval * 1000.0)
+            self._periodic.start()
+
+    def flush(self):
+        """
+        Deliver the next batch of observations.
+
+        :returns: a future that resolves when the reporters are done
+            with the batch or :data:`None` if there is nothing to do
+        :rtype: tornado.concurrent.Future
+
+        If a delivery is already active, then this does not start a
+        new one and the active delivery's future is returned instead.
+        Batches are passed through :attr:`.tail_sampler` and batches
+        that it empties are skipped.
+
+        """
+        self._flush_scheduled = False
+        if self._delivery is not None:
+            return self._delivery
+
+        queue = self._queue
+        batch = None
+        while queue and not batch:
+            batch = [queue.popleft()
+                     for _ in range(min(self.batch_size, len(queue)))]
+            if self.tail_sampler is not None:
+                batch = self.tail_sampler.filter(batch)
+        if not batch:
+            return None
+
+        future = self._deliver(batch)
+        if not future.done():
+            self._delivery = future
+        return future
+
+    @gen.coroutine
+    def stop(self):
+        """
+        Stop the periodic flush and deliver everything that is queued.
+
+        :returns: a future that resolves once the queue is empty
+
+        """
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        while True:
+            future = self.flush()
+            if future is None:
+                break
+            yield future
+
+    @gen.coroutine
+    def _deliver(self, batch):
+        try:
+            pending = []
+            for reporter in self.reporters:
+                try:
+                    result = reporter.report(batch)
+                    if result is not None:
+                        pending.append((reporter, gen.convert_yielded(result)))
+                except Exception:
+                    LOGGER.exception('reporter %r failed', reporter)
+            for reporter, future in pending:
+                try:
+                    yield future
+                except Exception:
+                    LOGGER.exception('reporter %r failed', reporter)
+        finally:
+            self._delivery = None
+            if (len(self._queue) >= self.batch_size and
+                    not self._flush_scheduled and self._periodic is not None):
+                self._flush_scheduled = True
+                ioloop.IOLoop.current().add_callback(self.flush)
+
+
+_SPOOL_MAGIC = b'DIVAKSP1'
+_SPOOL_HEADER = struct.Struct('=8sQQQ')
+_RECORD_LENGTH = struct.Struct('=I')
+_WRAP = 0xFFFFFFFF
+
+
+class RingFile(object):
+    """
+    Fixed-size ring of records in a memory-mapped file.
+
+    :param str path: the file to store records in.  It is created if
+        it does not exist.
+    :param int size: the size of the file in bytes
+
+    Records are appended sequentially after the most recent record and
+    wrap around to the beginning of the file when they reach the end.
+    When a new record does not fit, the oldest records are discarded
+    to make room and counted in :attr:`.dropped`.  The read and write
+    positions are stored in a header at the beginning of the file so
+    records that were not removed are read again when the file is
+    reopened.  The file is reinitialized if it has a different size or
+    an invalid header.
+
+    The records are written to the operating system's page cache so
+    they survive the process exiting but not necessarily the machine
+    crashing.
+
+    .. attribute:: count
+
+       Number of records in the file.
+
+    .. attribute:: dropped
+
+       Number of records that were discarded to make room.
+
+    """
+
+    def __init__(self, path, size):
+        super(RingFile, self).__init__()
+        if size < _SPOOL_HEADER.size + 2 * _RECORD_LENGTH.size:
+            raise ValueError('size is too small')
+        self.path = path
+        self.size = size
+        self.dropped = 0
+        self._first = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            existing = os.fstat(fd).st_size == size
+            if not existing:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, self._head, self._tail, self.count = _SPOOL_HEADER.unpack_from(
+            self._map, 0)
+        data = _SPOOL_HEADER.size
+        if (not existing or magic != _SPOOL_MAGIC or
+                not data <= self._head <= size or
+                not data <= self._tail <= size):
+            self._head = self._tail = data
+            self.count = 0
+            self._save()
+
+    @property
+    def capacity(self):
+        """Largest record that fits in the file."""
+        return self.size - _SPOOL_HEADER.size - _RECORD_LENGTH.size
+
+    def append(self, payload):
+        """
+        Append a record.
+
+        :param bytes payload: the record to append
+        :return: :data:`False` if the record is larger than
+            :attr:`.capacity`; :data:`True` otherwise
+        :rtype: bool
+
+        """
+        length = _RECORD_LENGTH.size + len(payload)
+        if len(payload) > self.capacity:
+            return False
+
+        data = _SPOOL_HEADER.size
+        head = self._head
+        position = head if head + length <= self.size else data
+        while self._overlaps(position, length):
+            self._remove()
+            self.dropped += 1
+        if not self.count:
+            self._tail = position
+        elif position != head and head + _RECORD_LENGTH.size <= self.size:
+            _RECORD_LENGTH.pack_into(self._map, head, _WRAP)
+
+        _RECORD_LENGTH.pack_into(self._map, position, len(payload))
+        start = position + _RECORD_LENGTH.size
+        self._map[start:start + len(payload)] = payload
+        self._head = position + length
+        self.count += 1
+        self._save()
+        return True
+
+    def peek(self):
+        """
+        Retrieve the oldest record without removing it.
+
+        :return: the sequence number and payload of the oldest record
+            or :data:`None` if the file is empty
+        :rtype: tuple
+
+        The sequence number is passed to :meth:`.remove`.
+
+        """
+        if not self.count:
+            return None
+        position, length = self._locate()
+        start = position + _RECORD_LENGTH.size
+        return self._first, self._map[start:start + length]
+
+    def remove(self, sequence):
+        """
+        Remove the oldest record if it is still `sequence`.
+
+        :param int sequence: the sequence number returned from
+            :meth:`.peek`
+
+        The record is not removed if it was already discarded to make
+        room for newer records.
+
+        """
+        if self.count and sequence == self._first:
+            self._remove()
+            self._save()
+
+    def close(self):
+        """Write the records to disk and close the file."""
+        self._map.flush()
+        self._map.close()
+
+    def _overlaps(self, position, length):
+        if not self.count:
+            return False
+        head, tail = self._head, self._tail
+        if position == head:
+            return head <= tail < head + length
+        return tail >= head or tail < position + length
+
+    def _locate(self):
+        position = self._tail
+        if position + _RECORD_LENGTH.size <= self.size:
+            length, = _RECORD_LENGTH.unpack_from(self._map, position)
+        else:
+            length = _WRAP
+        if length == _WRAP:
+            position = _SPOOL_HEADER.size
+            length, = _RECORD_LENGTH.unpack_from(self._map, position)
+        return position, length
+
+    def _remove(self):
+        position, length = self._locate()
+        self._tail = position + _RECORD_LENGTH.size + length
+        self.count -= 1
+        self._first += 1
+
+    def _save(self):
+        _SPOOL_HEADER.pack_into(self._map, 0, _SPOOL_MAGIC, self._head,
+                                self._tail, self.count)
+
+
+class SpoolingReporter(object):
+    """
+    Spools batches to disk while a reporter is failing.
+
+    :param reporter: the reporter to deliver batches to
+    :param str path: the spool file
+    :keyword int size: the size of the spool file in bytes
+    :keyword float replay_rate: maximum number of spooled batches to
+        deliver each second once `reporter` recovers
+    :keyword float retry_interval: seconds to wait before retrying a
+        spooled batch that `reporter` failed to deliver
+    :keyword encode: callable that converts a batch to :class:`bytes`.
+        Batches are pickled if this is omitted.
+    :keyword decode: callable that converts the output of `encode`
+        back into a batch
+
+    Add this to :meth:`divak.api.Recorder.add_divak_reporter` in place
+    of `reporter`.  Batches are passed to `reporter` until its
+    ``report`` method raises an exception.  The failed batch and every
+    batch after it are encoded and appended to a :class:`.RingFile`
+    instead so that a failed backend is not called for every batch.
+    A coroutine replays the spooled batches oldest first and removes
+    each one after `reporter` accepts it.  Once `reporter` accepts a
+    spooled batch, new batches are passed to it directly again while
+    the replay continues at `replay_rate`.  If the spool fills up, the
+    oldest batches are discarded and counted in :attr:`.dropped`.
+    Batches that are left in the spool file when the process exits are
+    replayed after the next batch is reported.
+
+    If `reporter` raises a :exc:`.PartialReportError`, then only the
+    observations that it did not deliver are spooled.  A spooled batch
+    that is partially delivered during the replay is replaced by the
+    remaining observations at the end of the spool.
+
+    Only failures that `reporter` surfaces by raising an exception or
+    by returning a future that fails are spooled.  Reporters that
+    handle delivery failures themselves, such as
+    :class:`~divak.zipkin.ZipkinReporter` without ``raise_errors`` or
+    :class:`~divak.statsd.StatsdReporter` which only aggregates when a
+    batch is reported, never trigger spooling.
+
+    Spooling runs in the :class:`~divak.reporting.ReportingPipeline`
+    delivery callback so it never adds latency to request handlers.
+
+    """
+
+    def __init__(self, reporter, path, size=64 * 1024 * 1024,
+                 replay_rate=10.0, retry_interval=5.0, encode=None,
+                 decode=None):
+        super(SpoolingReporter, self).__init__()
+        self.reporter = reporter
+        self.replay_rate = replay_rate
+        self.retry_interval = retry_interval
+        self.spool = RingFile(path, size)
+        self._encode = encode or _pickle
+        self._decode = decode or pickle.loads
+        self._failing = False
+        self._replay = None
+
+    @property
+    def dropped(self):
+        """Number of batches that were discarded."""
+        return self.spool.dropped
+
+    @gen.coroutine
+    def report(self, observations):
+        if not self._failing:
+            try:
+                result = self.reporter.report(observations)
+                if result is not None:
+                    yield result
+            except Exception as error:
+                LOGGER.warning('reporter %r failed, spooling to %s: %s',
+                               self.reporter, self.spool.path, error)
+                self._failing = True
+                if isinstance(error, PartialReportError):
+                    observations = error.observations
+            else:
+                self._start_replay()
+                return
+
+        self._append(observations)
+        self._start_replay()
+
+    def close(self):
+        """Write the spooled batches to disk and close the spool."""
+        self.spool.close()
+
+    @gen.coroutine
+    def _replay_spool(self):
+        try:
+            while self.spool.count:
+                sequence, payload = self.spool.peek()
+                try:
+                    observations = self._decode(payload)
+                except Exception:
+                    LOGGER.exception('discarding unreadable spooled batch')
+                    self.spool.remove(sequence)
+                    self.spool.dropped += 1
+                    continue
+
+                try:
+                    result = self.reporter.report(observations)
+                    if result is not None:
+                        yield result
+                except Exception as error:
+                    LOGGER.debug('reporter %r is still failing: %s',
+                                 self.reporter, error)
+                    self._failing = True
+                    if isinstance(error, PartialReportError):
+                        self.spool.remove(sequence)
+                        self._append(error.observations)
+                    yield gen.sleep(self.retry_interval)
+                    continue
+
+                self._failing = False
+                self.spool.remove(sequence)
+                yield gen.sleep(1.0 / self.replay_rate)
+        finally:
+            self._replay = None
+
+    def _append(self, observations):
+        try:
+            if not self.spool.append(self._encode(observations)):
+                LOGGER.warning('discarding batch that is too large for %s',
+                               self.spool.path)
+                self.spool.dropped += 1
+        except Exception:
+            LOGGER.exception('failed to spool batch')
+            self.spool.dropped += 1
+
+    def _start_replay(self):
+        if self._replay is None and self.spool.count:
+            future = self._replay_spool()
+            if not future.done():
+                self._replay = future
+
+
+def _pickle(observations):
+    return pickle.dumps(observations, 2)
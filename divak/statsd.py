@@ -0,0 +1,289 @@
+import collections
+import errno
+import logging
+import re
+import socket
+
+from tornado import ioloop
+
+import divak.metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+_UNSAFE_NAME = re.compile(r'[^A-Za-z0-9_\-]')
+_UNSAFE_TAG = re.compile(r'[,|#\s]')
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class StatsdReporter(object):
+    """
+    Aggregates spans in process and sends them to a StatsD agent.
+
+    :keyword str host: the host that the agent listens on
+    :keyword int port: the UDP port that the agent listens on
+    :keyword str prefix: string to prepend to every metric name
+    :keyword float flush_interval: seconds between sends to the agent
+    :keyword int mtu: maximum number of bytes in a datagram
+    :keyword bool dogstatsd: should tags be sent in the DogStatsD
+        format?  If this is :data:`False`, then the tag values are
+        appended to the metric name instead.
+    :keyword percentiles: the percentiles to send for each timer
+    :keyword int max_pending: maximum number of datagrams to hold while
+        the socket is not writable
+
+    Add this to :meth:`divak.api.Recorder.add_divak_reporter` to send
+    the following metrics for each batch of spans:
+
+    - ``requests`` counts requests by ``service``, ``route``,
+      ``method``, and ``status`` class
+    - ``request.duration`` is a timer labelled by ``service``,
+      ``route``, and ``status`` class
+    - ``response.bytes`` counts the response bytes by ``service`` and
+      ``route`` if stream accounting is enabled
+    - ``outbound.requests`` and ``outbound.duration`` describe the
+      outbound requests by ``service``, ``method``, and ``status``
+
+    Nothing is sent when spans are reported.  Counters are summed,
+    gauges keep their latest value, and timers are recorded in
+    a :class:`~divak.metrics.LatencyHistogram` until the next flush.
+    Every `flush_interval` seconds, each counter is sent as a count
+    and each timer as ``.count``, ``.mean``, ``.max``, and one ``.pNN``
+    gauge per percentile in milliseconds.  The lines are packed into as
+    few datagrams of at most `mtu` bytes as possible and sent from a
+    single non-blocking UDP socket.  If the socket is not writable,
+    then the remaining datagrams are sent when the IOLoop reports that
+    it is.  Datagrams that do not fit in `max_pending` or that the
+    socket rejects are counted in :attr:`.dropped`.
+
+    :meth:`.increment`, :meth:`.gauge`, and :meth:`.timing` can be
+    used to send application metrics through the same aggregation.
+
+    .. attribute:: dropped
+
+       Number of datagrams that were discarded.
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='',
+                 flush_interval=10.0, mtu=1432, dogstatsd=True,
+                 percentiles=(0.5, 0.95, 0.99), max_pending=1000):
+        super(StatsdReporter, self).__init__()
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.mtu = mtu
+        self.dogstatsd = dogstatsd
+        self.percentiles = tuple(percentiles)
+        self.max_pending = max_pending
+        self.dropped = 0
+        family, _, _, _, address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_DGRAM)[0]
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._socket.connect(address)
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._pending = collections.deque()
+        self._io_loop = None
+        self._periodic = None
+        self._waiting = False
+
+    def increment(self, name, value=1, tags=()):
+        """
+        Add to a counter.
+
+        :param str name: the metric name
+        :param int value: the amount to add
+        :param tuple tags: ``(name, value)`` pairs for the counter
+
+        """
+        key = (name, tags)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, tags=()):
+        """
+        Set a gauge.
+
+        :param str name: the metric name
+        :param float value: the current value
+        :param tuple tags: ``(name, value)`` pairs for the gauge
+
+        """
+        self._gauges[name, tags] = value
+
+    def timing(self, name, seconds, tags=()):
+        """
+        Record a duration.
+
+        :param str name: the metric name
+        :param float seconds: the duration in seconds
+        :param tuple tags: ``(name, value)`` pairs for the timer
+
+        """
+        key = (name, tags)
+        timer = self._timers.get(key)
+        if timer is None:
+            timer = self._timers[key] = [divak.metrics.LatencyHistogram(),
+                                         seconds]
+        timer[0].record(seconds)
+        if seconds > timer[1]:
+            timer[1] = seconds
+
+    def report(self, spans):
+        increment, timing = self.increment, self.timing
+        for span in spans:
+            service = span.service or 'unknown'
+            route = span.route or 'unknown'
+            status = _status_class(span.status)
+            increment('requests', 1, (('service', service),
+                                      ('route', route),
+                                      ('method', span.method or 'unknown'),
+                                      ('status', status)))
+            if span.duration is not None:
+                timing('request.duration', span.duration,
+                       (('service', service), ('route', route),
+                        ('status', status)))
+            if span.response_bytes is not None:
+                increment('response.bytes', span.response_bytes,
+                          (('service', service), ('route', route)))
+            for child in span.children or ():
+                tags = (('service', service), ('method', child.method),
+                        ('status', _status_class(child.status)))
+                increment('outbound.requests', 1, tags)
+                if child.duration is not None:
+                    timing('outbound.duration', child.duration, tags)
+        self.start()
+
+    def start(self):
+        """Start the periodic flush on the current IOLoop."""
+        if self._periodic is None:
+            self._io_loop = ioloop.IOLoop.current()
+            self._periodic = ioloop.PeriodicCallback(
+                self.flush, self.flush_interval * 1000.0)
+            self._periodic.start()
+
+    def flush(self):
+        """Send the aggregated metrics and reset them."""
+        lines = self._render()
+        if lines:
+            self._send(_pack(lines, self.mtu))
+
+    def close(self):
+        """Stop the periodic flush, send what is left, and close."""
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        self.flush()
+        if self._waiting:
+            self._io_loop.remove_handler(self._socket.fileno())
+            self._waiting = False
+        self.dropped += len(self._pending)
+        self._pending.clear()
+        self._socket.close()
+
+    def _render(self):
+        lines = []
+        format_line = self._format_line
+        for (name, tags), value in self._counters.items():
+            lines.append(format_line(name, value, 'c', tags))
+        for (name, tags), value in self._gauges.items():
+            lines.append(format_line(name, value, 'g', tags))
+        for (name, tags), (histogram, maximum) in self._timers.items():
+            count = histogram.count
+            lines.append(format_line(name + '.count', count, 'c', tags))
+            lines.append(format_line(name + '.mean',
+                                     histogram.sum / count * 1000.0, 'g',
+                                     tags))
+            lines.append(format_line(name + '.max', maximum * 1000.0, 'g',
+                                     tags))
+            for percentile in self.percentiles:
+                lines.append(format_line(
+                    '{}.p{}'.format(name, _percentile_suffix(percentile)),
+                    min(histogram.quantile(percentile), maximum) * 1000.0,
+                    'g', tags))
+        self._counters.clear()
+        self._gauges.clear()
+        self._timers.clear()
+        return lines
+
+    def _format_line(self, name, value, metric_type, tags):
+        name = self.prefix + name
+        suffix = ''
+        if self.dogstatsd:
+            if tags:
+                suffix = '|#' + ','.join(
+                    '{}:{}'.format(tag, _UNSAFE_TAG.sub('_', str(tag_value)))
+                    for tag, tag_value in tags)
+        else:
+            for _, tag_value in tags:
+                name += '.' + _UNSAFE_NAME.sub('_', str(tag_value))
+        return '{}:{}|{}{}'.format(name, _format_value(value), metric_type,
+                                   suffix).encode('utf-8')
+
+    def _send(self, datagrams):
+        pending = self._pending
+        pending.extend(datagrams)
+        overflow = len(pending) - self.max_pending
+        if overflow > 0:
+            self.dropped += overflow
+            for _ in range(overflow):
+                pending.popleft()
+        if not self._waiting:
+            self._drain()
+
+    def _drain(self, fd=None, events=None):
+        pending = self._pending
+        while pending:
+            try:
+                self._socket.send(pending[0])
+            except socket.error as error:
+                if error.args[0] in _WOULD_BLOCK:
+                    if not self._waiting:
+                        self._waiting = True
+                        self._io_loop.add_handler(
+                            self._socket.fileno(), self._drain,
+                            ioloop.IOLoop.WRITE)
+                    return
+                LOGGER.debug('failed to send to statsd agent: %s', error)
+                self.dropped += 1
+            pending.popleft()
+        if self._waiting:
+            self._waiting = False
+            self._io_loop.remove_handler(self._socket.fileno())
+
+
+def _pack(lines, mtu):
+    datagrams = []
+    current = []
+    size = 0
+    for line in lines:
+        length = len(line) + 1 if current else len(line)
+        if current and size + length > mtu:
+            datagrams.append(b'\n'.join(current))
+            current = []
+            length = len(line)
+            size = 0
+        current.append(line)
+        size += length
+    if current:
+        datagrams.append(b'\n'.join(current))
+    return datagrams
+
+
+def _status_class(status):
+    if not status:
+        return 'unknown'
+    return '{}xx'.format(min(status // 100, 5))
+
+
+def _percentile_suffix(percentile):
+    return '{:g}'.format(percentile * 100).replace('.', '_')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value.is_integer():
+            return '{:d}'.format(int(value))
+        return '{:.6f}'.format(value).rstrip('0').rstrip('.')
+    return '{:d}'.format(value)
@@ -1,5 +1,10 @@
+import collections
 import logging
 
+from tornado import gen, httpclient, httpserver, testing
+
+import divak.tracing
+
 
 class RecordingLogHandler(logging.Handler):
     """
@@ -22,3 +27,231 @@ class RecordingLogHandler(logging.Handler):
 
     def emit(self, record):
         self.records.append(record)
+
+
+class RingBufferLogHandler(logging.Handler):
+    """
+    Log handler that keeps the most recent log records.
+
+    :param int capacity: the maximum number of records to keep
+    :param level: the handler's level
+    :raises ValueError: if `capacity` is less than one
+
+    This is a bounded version of :class:`.RecordingLogHandler` for soak
+    and load tests.  Once `capacity` records are held, each new record
+    discards the oldest one.  The records are also indexed by their
+    ``divak_request_id`` and logger name so :meth:`.records_for_request`
+    and :meth:`.records_for_logger` do not scan every record.  Records
+    without a request ID are not indexed by request.
+
+    .. attribute:: records
+
+       :class:`collections.deque` of the most recent
+       :class:`logging.LogRecord` instances, oldest first.
+
+    .. attribute:: discarded
+
+       Number of records that were discarded to make room.
+
+    """
+
+    def __init__(self, capacity, level=logging.NOTSET):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        super(RingBufferLogHandler, self).__init__(level)
+        self.capacity = capacity
+        self.discarded = 0
+        self.records = collections.deque(maxlen=capacity)
+        self._by_request = {}
+        self._by_logger = {}
+
+    def emit(self, record):
+        records = self.records
+        if len(records) == self.capacity:
+            oldest = records[0]
+            _unindex(self._by_request,
+                     getattr(oldest, 'divak_request_id', None))
+            _unindex(self._by_logger, oldest.name)
+            self.discarded += 1
+        records.append(record)
+        request_id = getattr(record, 'divak_request_id', None)
+        if request_id:
+            _index(self._by_request, request_id, record)
+        _index(self._by_logger, record.name, record)
+
+    def records_for_request(self, request_id):
+        """
+        Retrieve the records that were logged for a request.
+
+        :param str request_id: the ``divak_request_id`` to look for
+        :rtype: list
+
+        """
+        with self.lock:
+            return list(self._by_request.get(request_id, ()))
+
+    def records_for_logger(self, name):
+        """
+        Retrieve the records that were logged by a logger.
+
+        :param str name: the name of the logger.  Records from child
+            loggers are not included.
+        :rtype: list
+
+        """
+        with self.lock:
+            return list(self._by_logger.get(name, ()))
+
+    def clear(self):
+        """Discard every record."""
+        with self.lock:
+            self.records.clear()
+            self._by_request.clear()
+            self._by_logger.clear()
+
+
+class LoadResult(object):
+    """
+    Outcome of :func:`.generate_load`.
+
+    .. attribute:: requests
+
+       Number of requests that were sent.
+
+    .. attribute:: duration
+
+       Seconds from the first request until the last response.
+
+    .. attribute:: latencies
+
+       Sorted :class:`list` of the latency of each request in seconds.
+
+    .. attribute:: statuses
+
+       :class:`collections.Counter` of response status codes.  Requests
+       that did not receive a response are counted as 599.
+
+    """
+
+    def __init__(self, duration, latencies, statuses):
+        super(LoadResult, self).__init__()
+        self.requests = len(latencies)
+        self.duration = duration
+        self.latencies = sorted(latencies)
+        self.statuses = statuses
+
+    @property
+    def throughput(self):
+        """Requests per second."""
+        if not self.duration:
+            return 0.0
+        return self.requests / self.duration
+
+    @property
+    def errors(self):
+        """Number of requests that failed with a 5xx status."""
+        return sum(count for status, count in self.statuses.items()
+                   if status >= 500)
+
+    def percentile(self, q):
+        """
+        Retrieve a latency percentile.
+
+        :param float q: the percentile between 0 and 1
+        :return: the smallest latency that `q` of the requests did
+            not exceed or :data:`None` if no requests were sent
+        :rtype: float
+
+        """
+        if not self.latencies:
+            return None
+        index = max(0, int(q * len(self.latencies) + 0.5) - 1)
+        return self.latencies[min(index, len(self.latencies) - 1)]
+
+    def __repr__(self):
+        return '<{} {} requests {:.1f}/s p50={} p99={} errors={}>'.format(
+            self.__class__.__name__, self.requests, self.throughput,
+            self.percentile(0.5), self.percentile(0.99), self.errors)
+
+
+@gen.coroutine
+def generate_load(application, path='/', requests=1000, concurrency=10,
+                  **kwargs):
+    """
+    Send concurrent requests to an application in this process.
+
+    :param tornado.web.Application application: the application to
+        send requests to.  This is usually a :class:`divak.api.Recorder`.
+    :keyword str path: the path to request
+    :keyword int requests: the total number of requests to send
+    :keyword int concurrency: the number of requests to have in flight
+        at a time
+    :param kwargs: additional keyword parameters are passed to
+        :class:`~tornado.httpclient.HTTPRequest`
+    :rtype: LoadResult
+
+    This is a coroutine that serves `application` from an unused
+    localhost port on the current IOLoop and sends `requests` requests
+    to it from `concurrency` workers that each send their next request
+    as soon as the previous one finishes.  Since the client and server
+    share the IOLoop, the throughput is a lower bound that is useful
+    for comparing configurations and for asserting on in ordinary
+    tests::
+
+       @testing.gen_test(timeout=30)
+       def test_that_logging_is_cheap(self):
+           result = yield divak.testing.generate_load(
+               self.application, '/orders', requests=2000)
+           self.assertEqual(result.errors, 0)
+           self.assertLess(result.percentile(0.99), 0.05)
+
+    """
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(application)
+    server.add_sockets([sock])
+    client = httpclient.AsyncHTTPClient(force_instance=True,
+                                        max_clients=concurrency)
+    url = 'http://127.0.0.1:{}{}'.format(port, path)
+    latencies = []
+    statuses = collections.Counter()
+    remaining = [requests]
+
+    @gen.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = divak.tracing.monotonic()
+            try:
+                response = yield client.fetch(url, raise_error=False,
+                                              **kwargs)
+                status = response.code
+            except Exception:
+                status = 599
+            latencies.append(divak.tracing.monotonic() - start)
+            statuses[status] += 1
+
+    try:
+        start = divak.tracing.monotonic()
+        yield [worker() for _ in range(min(concurrency, requests))]
+        duration = divak.tracing.monotonic() - start
+    finally:
+        client.close()
+        server.stop()
+        yield server.close_all_connections()
+
+    raise gen.Return(LoadResult(duration, latencies, statuses))
+
+
+def _index(index, key, record):
+    records = index.get(key)
+    if records is None:
+        records = index[key] = collections.deque()
+    records.append(record)
+
+
+def _unindex(index, key):
+    records = index.get(key)
+    if records:
+        records.popleft()
+        if not records:
+            del index[key]
@@ -0,0 +1,429 @@
+import random
+import re
+import sys
+
+import divak.metrics
+
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover -- python 2
+    from time import time as monotonic  # noqa: F401
+
+try:
+    intern = sys.intern
+except AttributeError:  # pragma: no cover -- python 2
+    intern = intern  # noqa: F821
+
+
+class Span(object):
+    """
+    Timing information for a single request.
+
+    :param float start: monotonic timestamp of when the request
+        started
+
+    Spans are created by :class:`divak.internals.RequestTransform`
+    and attached to the request as ``divak_span``.  The timestamps are
+    values from :func:`time.monotonic` that are filled in as the
+    request moves through processing.  A timestamp is :data:`None`
+    until the corresponding phase is reached.
+
+    .. attribute:: start
+
+       when the transform was created for the request
+
+    .. attribute:: prepare_start
+
+       when :meth:`divak.api.Logger.prepare` started
+
+    .. attribute:: prepare_end
+
+       when :meth:`divak.api.Logger.prepare` finished including the
+       super class implementation
+
+    .. attribute:: first_byte
+
+       when the first chunk of the response was transformed
+
+    .. attribute:: finish
+
+       when the request was logged by :class:`divak.api.Recorder`
+
+    The remaining attributes describe the request and are set by
+    :class:`divak.api.Recorder` when the request finishes: ``service``,
+    ``route``, ``request_id``, ``method``, ``uri``, and ``status``.
+    ``service``, ``route``, and ``method`` refer to shared string
+    instances instead of per-request copies.  If the request
+    is part of a distributed trace, then ``trace_id``, ``span_id``, and
+    ``parent_id`` are set as well.  If stream accounting is enabled,
+    then ``response_bytes``, ``chunks``, and ``max_chunk_gap`` are set
+    from the :class:`divak.internals.StreamTransform` for the request.
+
+    .. attribute:: children
+
+       :class:`list` of :class:`.ClientSpan` instances for the outbound
+       requests that were made while processing the request or
+       :data:`None` if there were not any
+
+    """
+
+    __slots__ = ('service', 'route', 'request_id', 'method', 'uri', 'status',
+                 'start', 'prepare_start', 'prepare_end', 'first_byte',
+                 'finish', 'children', 'trace_id', 'span_id', 'parent_id',
+                 'response_bytes', 'chunks', 'max_chunk_gap')
+
+    def __init__(self, start):
+        self.start = start
+        self.prepare_start = None
+        self.prepare_end = None
+        self.first_byte = None
+        self.finish = None
+        self.service = None
+        self.route = None
+        self.request_id = None
+        self.method = None
+        self.uri = None
+        self.status = None
+        self.children = None
+        self.trace_id = None
+        self.span_id = None
+        self.parent_id = None
+        self.response_bytes = None
+        self.chunks = None
+        self.max_chunk_gap = None
+
+    @property
+    def duration(self):
+        """Seconds between start and finish or :data:`None`."""
+        if self.finish is None:
+            return None
+        return self.finish - self.start
+
+    def add_child(self, child):
+        """
+        Add a span for an outbound request.
+
+        :param ClientSpan child: the span to add
+
+        """
+        if self.children is None:
+            self.children = []
+        self.children.append(child)
+
+    def __repr__(self):
+        return '<{} {} {} {} {}>'.format(
+            self.__class__.__name__, self.method, self.uri, self.status,
+            self.duration)
+
+
+class ClientSpan(object):
+    """
+    Timing information for a single outbound HTTP request.
+
+    :param str method: the HTTP method of the request
+    :param str url: the requested URL
+    :param float start: monotonic timestamp of when the request was
+        started
+    :keyword str span_id: the ID of the span
+
+    Client spans are created by :class:`divak.client.HTTPClient` and
+    added to the :class:`.Span` of the request that made the call.
+    The client sends :attr:`span_id` to the called service as the
+    parent of its span.
+    Durations are in seconds and are :data:`None` when the HTTP
+    client does not provide them.
+
+    .. attribute:: span_id
+
+       the 16 character ID of the span or :data:`None` if it was not
+       assigned one
+
+    .. attribute:: status
+
+       the HTTP status code of the response or 599 if a response was
+       not received
+
+    .. attribute:: finish
+
+       monotonic timestamp of when the response was received
+
+    .. attribute:: queue
+
+       time spent waiting for a connection slot in the client's
+       ``max_clients`` pool
+
+    .. attribute:: namelookup
+
+       time from the start of the request until name resolution
+       finished
+
+    .. attribute:: connect
+
+       time from the start of the request until the connection was
+       established
+
+    .. attribute:: request_time
+
+       time from the start of the request until the response was
+       received excluding :attr:`queue`
+
+    .. attribute:: reused
+
+       :data:`True` if an existing connection was reused, :data:`False`
+       if a new connection was established, or :data:`None` if the
+       client does not say
+
+    """
+
+    __slots__ = ('method', 'url', 'span_id', 'status', 'start', 'finish',
+                 'queue', 'namelookup', 'connect', 'request_time', 'reused')
+
+    def __init__(self, method, url, start, span_id=None):
+        self.method = method
+        self.url = url
+        self.start = start
+        self.span_id = span_id
+        self.status = None
+        self.finish = None
+        self.queue = None
+        self.namelookup = None
+        self.connect = None
+        self.request_time = None
+        self.reused = None
+
+    @property
+    def duration(self):
+        """Seconds between start and finish or :data:`None`."""
+        if self.finish is None:
+            return None
+        return self.finish - self.start
+
+    def __repr__(self):
+        return '<{} {} {} {} {}>'.format(
+            self.__class__.__name__, self.method, self.url, self.status,
+            self.duration)
+
+
+class ProbabilisticSampler(object):
+    """
+    Samples a fixed fraction of requests.
+
+    :param float probability: the probability that a request is
+        sampled expressed as a value between 0 and 1
+
+    """
+
+    def __init__(self, probability):
+        super(ProbabilisticSampler, self).__init__()
+        if not 0.0 <= probability <= 1.0:
+            raise ValueError('probability must be between 0 and 1')
+        self.probability = probability
+        self._random = random.random
+
+    def should_sample(self, request):
+        """
+        Decide whether `request` is sampled.
+
+        :param tornado.httputil.HTTPServerRequest request: the request
+            to make a decision about
+        :rtype: bool
+
+        """
+        return self._random() < self.probability
+
+
+class RateLimitingSampler(object):
+    """
+    Samples at most a fixed number of requests per second.
+
+    :param float per_second: the number of requests to sample each
+        second
+
+    This is a token bucket that holds up to `per_second` tokens and is
+    refilled continuously.  Bursts of up to `per_second` requests are
+    sampled after a quiet period.  The bucket always holds at least one
+    token so rates below one per second sample a request every
+    ``1 / per_second`` seconds.
+
+    """
+
+    def __init__(self, per_second):
+        super(RateLimitingSampler, self).__init__()
+        self.per_second = float(per_second)
+        self._capacity = max(1.0, self.per_second)
+        self._tokens = self._capacity
+        self._last = monotonic()
+
+    def should_sample(self, request):
+        """
+        Decide whether `request` is sampled.
+
+        :param tornado.httputil.HTTPServerRequest request: the request
+            to make a decision about
+        :rtype: bool
+
+        """
+        now = monotonic()
+        tokens = min(self._capacity,
+                     self._tokens + (now - self._last) * self.per_second)
+        self._last = now
+        if tokens >= 1.0:
+            self._tokens = tokens - 1.0
+            return True
+        self._tokens = tokens
+        return False
+
+
+class RouteSampler(object):
+    """
+    Delegates the sampling decision based on the request path.
+
+    :param routes: sequence of ``(pattern, sampler)`` pairs.  The
+        pattern is a regular expression that is matched against the
+        entire request path in the same manner as
+        :class:`tornado.web.URLSpec` patterns.
+    :param default: sampler to use when none of the patterns match.
+        If this is unspecified, then unmatched requests are not
+        sampled.
+
+    The patterns are tried in order and the first match wins.
+
+    """
+
+    def __init__(self, routes, default=None):
+        super(RouteSampler, self).__init__()
+        self._routes = []
+        for pattern, sampler in routes:
+            if not pattern.endswith('$'):
+                pattern += '$'
+            self._routes.append((re.compile(pattern).match, sampler))
+        self._default = default
+
+    def should_sample(self, request):
+        """
+        Decide whether `request` is sampled.
+
+        :param tornado.httputil.HTTPServerRequest request: the request
+            to make a decision about
+        :rtype: bool
+
+        """
+        path = request.path
+        for match, sampler in self._routes:
+            if match(path) is not None:
+                return sampler.should_sample(request)
+        if self._default is None:
+            return False
+        return self._default.should_sample(request)
+
+
+class TailSampler(object):
+    """
+    Chooses which finished spans are delivered to reporters.
+
+    :keyword float percentile: spans that took at least this quantile
+        of the recent request durations are kept
+    :keyword float probability: fraction of the remaining spans that
+        are kept at random
+    :keyword float max_per_second: the retention budget.  No more than
+        this many spans are kept each second regardless of why they
+        were selected.
+    :keyword int min_samples: number of durations that must be
+        observed before the percentile is used
+    :keyword int decay_after: the sketch is halved after this many
+        durations so that the percentile follows recent traffic
+
+    Head-based sampling decides before the request is processed so it
+    drops slow and failed requests at the same rate as every other
+    request.  A tail sampler is installed with
+    :meth:`divak.api.Recorder.set_divak_tail_sampler` and is called by
+    the :class:`divak.reporting.ReportingPipeline` when a batch is
+    flushed so it does not add work to the request path.  It keeps
+    every span that failed with a server error (including failed
+    :class:`.ClientSpan` children), every span that is slower than the
+    current `percentile`, and `probability` of the rest.
+
+    The percentile is estimated from a
+    :class:`divak.metrics.LatencyHistogram` of the observed durations
+    so the sketch is a fixed size.  The retention budget is enforced by
+    a :class:`.RateLimitingSampler`.
+
+    .. attribute:: dropped
+
+       Number of spans that were selected but discarded because the
+       retention budget was exhausted.
+
+    """
+
+    def __init__(self, percentile=0.99, probability=0.01,
+                 max_per_second=100.0, min_samples=100, decay_after=10000):
+        super(TailSampler, self).__init__()
+        if not 0.0 < percentile < 1.0:
+            raise ValueError('percentile must be between 0 and 1')
+        self.percentile = percentile
+        self.probability = probability
+        self.min_samples = min_samples
+        self.decay_after = decay_after
+        self.dropped = 0
+        self._budget = RateLimitingSampler(max_per_second)
+        self._sketch = divak.metrics.LatencyHistogram()
+        self._observed = 0
+        self._since_decay = 0
+        self._random = random.random
+
+    @property
+    def threshold(self):
+        """
+        Duration that makes a span slow or :data:`None`.
+
+        This is :data:`None` until `min_samples` durations have been
+        observed.
+
+        """
+        if self._observed < self.min_samples:
+            return None
+        return self._sketch.quantile(self.percentile)
+
+    def filter(self, spans):
+        """
+        Select the spans to deliver.
+
+        :param list spans: the finished spans
+        :return: the spans to keep
+        :rtype: list
+
+        """
+        threshold = self.threshold
+        record = self._sketch.record
+        kept = []
+        for span in spans:
+            duration = span.duration
+            if duration is None:
+                continue
+            record(duration)
+            if not (_failed(span) or
+                    (threshold is not None and duration >= threshold) or
+                    self._random() < self.probability):
+                continue
+            if self._budget.should_sample(span):
+                kept.append(span)
+            else:
+                self.dropped += 1
+
+        self._observed += len(spans)
+        self._since_decay += len(spans)
+        if self._since_decay >= self.decay_after:
+            values = self._sketch.values
+            for index in range(len(values)):
+                values[index] *= 0.5
+            self._since_decay = 0
+        return kept
+
+
+def _failed(span):
+    if span.status is not None and span.status >= 500:
+        return True
+    for child in span.children or ():
+        if child.status is not None and child.status >= 500:
+            return True
+    return False
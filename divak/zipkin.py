@@ -0,0 +1,301 @@
+import collections
+import json.encoder
+import logging
+import random
+import time
+
+from tornado import gen, httpclient
+
+import divak.api
+import divak.reporting
+import divak.tracing
+
+
+LOGGER = logging.getLogger(__name__)
+
+_quote = json.encoder.encode_basestring_ascii
+
+_SERVER_SPAN = ('{"traceId":"%s","id":"%s",%s"timestamp":%.0f,'
+                '"duration":%.0f,%s"http.path":%s,"http.status_code":"%d"%s}}')
+_SERVER_CONSTANTS = ('"kind":"SERVER","name":%s,"localEndpoint":%s,'
+                     '"tags":{"http.method":%s,"http.route":%s,')
+_CLIENT_SPAN = ('{"traceId":"%s","id":"%s","parentId":"%s","kind":"CLIENT",'
+                '"name":%s,"timestamp":%.0f,"duration":%.0f,'
+                '"localEndpoint":%s,'
+                '"tags":{"http.method":%s,"http.url":%s,'
+                '"http.status_code":"%d"%s}}')
+
+
+class ZipkinReporter(object):
+    """
+    Sends spans to a Zipkin collector.
+
+    :keyword str url: the collector's v2 span endpoint
+    :keyword int max_connections: maximum number of concurrent requests
+        to the collector
+    :keyword int max_spans: maximum number of spans in each request
+    :keyword int max_pending: maximum number of requests to hold while
+        the collector is slow or unavailable
+    :keyword int max_retries: number of times to retry a failed request
+    :keyword float backoff: seconds to wait before the first retry
+    :keyword float max_backoff: maximum seconds to wait between retries
+    :keyword float request_timeout: seconds to wait for the collector
+        to respond
+    :keyword tornado.httpclient.AsyncHTTPClient http_client: the client
+        to send requests with.  A new client limited to
+        `max_connections` is created if this is omitted.
+    :keyword bool raise_errors: should reporting a batch wait for the
+        collector and raise an exception if it is unavailable?
+
+    Add this to :meth:`divak.api.Recorder.add_divak_reporter` to send
+    each span in the Zipkin v2 JSON format.  The span's ``service`` is
+    the local endpoint's service name, the name is the lower-case
+    method and the route, and the request ID, method, route, path, and
+    status code are sent as tags.  Each :class:`~divak.tracing.ClientSpan`
+    is sent as a ``CLIENT`` span whose parent is the request's span
+    using the ID that was sent to the called service.
+    Spans that were not joined to a trace by a propagator such as
+    :class:`~divak.api.TraceContextPropagator` are sent as the root of
+    a new trace.  Zipkin expects wall clock timestamps so the monotonic
+    span timestamps are converted using the offset between the clocks
+    when the batch is reported.
+
+    Reporting a batch encodes it into one or more request bodies of at
+    most `max_spans` spans and returns without waiting for the
+    collector so the :class:`~divak.reporting.ReportingPipeline` is not
+    held up.  A span is always sent in the same body as its children
+    so a span with more than `max_spans` children is sent in a larger
+    body of its own.  At most `max_connections` requests are in flight at once
+    and the rest wait in a queue of `max_pending` bodies that discards
+    the oldest body when it is full.  Requests that fail with
+    a connection error, a 429, or a 5xx response are retried up to
+    `max_retries` times after a random delay of up to `backoff` seconds
+    doubled for each attempt and capped at `max_backoff` seconds.
+    Spans that are discarded are counted in :attr:`.dropped`.
+
+    If `raise_errors` is :data:`True`, then reporting a batch returns
+    a future that sends the request bodies one after another instead
+    and resolves once the collector accepts all of them.  If a body
+    still fails after `max_retries` retries, then the future fails and
+    the spans are not counted as dropped.  The future fails with the
+    last error if nothing was delivered and with
+    a :exc:`~divak.reporting.PartialReportError` that holds the spans
+    that were not delivered otherwise.  This makes the reporter
+    suitable for wrapping in a :class:`~divak.reporting.SpoolingReporter`
+    which holds on to the undelivered spans until the collector is
+    available.  Bodies that
+    the collector rejects with a client error other than 429 are
+    discarded either way since sending them again will not help.
+
+    .. attribute:: dropped
+
+       Number of spans that were discarded.
+
+    .. attribute:: sent
+
+       Number of spans that the collector accepted.
+
+    """
+
+    def __init__(self, url='http://127.0.0.1:9411/api/v2/spans',
+                 max_connections=2, max_spans=1000, max_pending=100,
+                 max_retries=5, backoff=0.5, max_backoff=30.0,
+                 request_timeout=10.0, http_client=None,
+                 raise_errors=False):
+        super(ZipkinReporter, self).__init__()
+        self.url = url
+        self.max_connections = max_connections
+        self.max_spans = max_spans
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.raise_errors = raise_errors
+        self.dropped = 0
+        self.sent = 0
+        self._owns_client = http_client is None
+        if http_client is None:
+            http_client = httpclient.AsyncHTTPClient(
+                force_instance=True, max_clients=max_connections)
+        self._http_client = http_client
+        self._pending = collections.deque()
+        self._senders = set()
+        self._new_trace_id = divak.api.RandomIdFactory(id_bytes=16)
+        self._new_span_id = divak.api.RandomIdFactory(id_bytes=8)
+        self._constants = {}
+        self._endpoints = {}
+
+    def report(self, spans):
+        offset = time.time() - divak.tracing.monotonic()
+        max_spans = self.max_spans
+        batches = []
+        encoded = []
+        first = 0
+        for index, span in enumerate(spans):
+            if span.finish is None:
+                continue
+            size = len(encoded)
+            self.encode(span, offset, encoded)
+            if size and len(encoded) > max_spans:
+                # keep each span in the same body as its children
+                batches.append((encoded[:size], first))
+                encoded = encoded[size:]
+                first = index
+        if encoded:
+            batches.append((encoded, first))
+
+        if self.raise_errors:
+            return self._send_batches(spans, batches)
+        for batch, _ in batches:
+            self._enqueue(batch)
+        self._start_senders()
+
+    def encode(self, span, offset, encoded):
+        """
+        Append the Zipkin v2 JSON for `span` and its children.
+
+        :param divak.tracing.Span span: the span to encode
+        :param float offset: seconds to add to the monotonic timestamps
+            to convert them to wall clock time
+        :param list encoded: the JSON objects are appended to this list
+            as :class:`str` instances
+
+        """
+        trace_id = span.trace_id
+        if trace_id is None:
+            # root spans conventionally reuse the low 64 bits of the
+            # trace ID which saves generating a second identifier
+            trace_id = self._new_trace_id()
+            span_id, parent = trace_id[16:], ''
+        else:
+            span_id, parent = span.span_id, ''
+            if span.parent_id is not None:
+                parent = '"parentId":"%s",' % span.parent_id
+
+        key = (span.service, span.method, span.route)
+        constants = self._constants.get(key)
+        if constants is None:
+            constants = self._constants[key] = self._server_constants(
+                span.service, span.method, span.route)
+        extra = ''
+        if span.request_id is not None:
+            extra = ',"divak.request_id":' + _quote(span.request_id)
+        status = span.status or 0
+        if status >= 500:
+            extra += ',"error":"%d"' % status
+        uri = span.uri or ''
+        if '?' in uri:
+            uri = uri.partition('?')[0]
+
+        start = span.start
+        encoded.append(_SERVER_SPAN % (
+            trace_id, span_id, parent, (start + offset) * 1e6,
+            max(1, (span.finish - start) * 1e6), constants, _quote(uri),
+            status, extra))
+
+        if span.children:
+            self._encode_children(span, trace_id, span_id, offset, encoded)
+
+    def close(self):
+        """Close the HTTP client if the reporter created it."""
+        if self._owns_client:
+            self._http_client.close()
+
+    def _server_constants(self, service, method, route):
+        method = method or 'unknown'
+        route = route or ''
+        name = '{} {}'.format(method.lower(), route).strip()
+        return _SERVER_CONSTANTS % (
+            _quote(name), self._endpoint(service), _quote(method),
+            _quote(route))
+
+    def _endpoint(self, service):
+        endpoint = self._endpoints.get(service)
+        if endpoint is None:
+            endpoint = self._endpoints[service] = (
+                '{"serviceName":%s}' % _quote(service or 'unknown'))
+        return endpoint
+
+    def _encode_children(self, span, trace_id, span_id, offset, encoded):
+        endpoint = self._endpoint(span.service)
+        for child in span.children:
+            if child.finish is None:
+                continue
+            status = child.status or 0
+            encoded.append(_CLIENT_SPAN % (
+                trace_id, child.span_id or self._new_span_id(), span_id,
+                _quote(child.method.lower()), (child.start + offset) * 1e6,
+                max(1, (child.finish - child.start) * 1e6), endpoint,
+                _quote(child.method), _quote(child.url), status,
+                ',"error":"%d"' % status if status >= 500 else ''))
+
+    def _enqueue(self, encoded):
+        pending = self._pending
+        if len(pending) >= self.max_pending:
+            self.dropped += pending.popleft()[1]
+        pending.append((self._encode_body(encoded), len(encoded)))
+
+    @staticmethod
+    def _encode_body(encoded):
+        return ('[' + ','.join(encoded) + ']').encode('utf-8')
+
+    def _start_senders(self):
+        while self._pending and len(self._senders) < self.max_connections:
+            sender = self._send_pending()
+            if not sender.done():
+                self._senders.add(sender)
+                sender.add_done_callback(self._senders.discard)
+
+    @gen.coroutine
+    def _send_pending(self):
+        while self._pending:
+            body, count = self._pending.popleft()
+            try:
+                yield self._send(body, count)
+            except Exception:
+                LOGGER.exception('failed to send spans to %s', self.url)
+                self.dropped += count
+
+    @gen.coroutine
+    def _send_batches(self, spans, batches):
+        for index, (batch, first) in enumerate(batches):
+            try:
+                yield self._send(self._encode_body(batch), len(batch))
+            except Exception as error:
+                if not index:
+                    raise
+                raise divak.reporting.PartialReportError(spans[first:], error)
+
+    @gen.coroutine
+    def _send(self, body, count):
+        request = httpclient.HTTPRequest(
+            self.url, method='POST', body=body,
+            headers={'Content-Type': 'application/json'},
+            request_timeout=self.request_timeout)
+        attempt = 0
+        while True:
+            try:
+                yield self._http_client.fetch(request)
+            except httpclient.HTTPError as error:
+                retry = error.code in (429, 599) or error.code >= 500
+                failure = error
+            except (IOError, OSError) as error:
+                retry, failure = True, error
+            else:
+                self.sent += count
+                return
+
+            if retry and attempt >= self.max_retries and self.raise_errors:
+                raise failure
+            if not retry or attempt >= self.max_retries:
+                LOGGER.warning('discarding %d spans after %d attempts: %s',
+                               count, attempt + 1, failure)
+                self.dropped += count
+                return
+            delay = random.uniform(
+                0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            attempt += 1
+            LOGGER.debug('retrying %d spans in %.3f seconds: %s', count,
+                         delay, failure)
+            yield gen.sleep(delay)
@@ -36,3 +36,16 @@ class Application(api.Recorder, web.Application):
             handlers = [web.url('/trace', TracedHandler)]
         super(Application, self).__init__(handlers, *args, **kwargs)
         self.set_divak_service('test-application')
+
+
+class CollectingReporter(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def report(self, observations):
+        self.batches.append(observations)
+
+    @property
+    def observations(self):
+        return [obs for batch in self.batches for obs in batch]
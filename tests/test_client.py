@@ -0,0 +1,190 @@
+import json
+import unittest
+
+from tornado import concurrent, gen, httpclient, testing, web
+import mock
+
+import divak.api
+import divak.client
+import divak.internals
+import divak.tracing
+import tests.application
+
+
+class EchoHandler(web.RequestHandler):
+
+    def get(self):
+        self.write({'request_id': self.request.headers.get('Request-Id'),
+                    'sampled': self.request.headers.get('Trace-Sampled')})
+
+
+class TraceparentHandler(web.RequestHandler):
+
+    def get(self):
+        self.write({'traceparent': self.request.headers.get('traceparent')})
+
+
+class SlowHandler(web.RequestHandler):
+
+    @gen.coroutine
+    def get(self):
+        yield gen.sleep(0.05)
+        self.write('done')
+
+
+class FanOutHandler(web.RequestHandler):
+
+    @gen.coroutine
+    def get(self):
+        client = divak.client.HTTPClient(self.application,
+                                         self.application.http_client)
+        url = '{}://{}{}'.format(self.request.protocol, self.request.host,
+                                 self.get_query_argument('path', '/echo'))
+        count = int(self.get_query_argument('count', '1'))
+        responses = yield [client.fetch(url, raise_error=False)
+                           for _ in range(count)]
+        self.application.spans.append(self.request.divak_span)
+        self.write(responses[0].body)
+
+
+class HTTPClientTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/echo', EchoHandler), web.url('/slow', SlowHandler),
+             web.url('/fanout', FanOutHandler),
+             web.url('/traceparent', TraceparentHandler)])
+        app.add_divak_propagator(divak.api.RequestIdPropagator())
+        app.add_divak_propagator(divak.api.SamplingPropagator(
+            divak.tracing.ProbabilisticSampler(1.0)))
+        app.add_divak_propagator(divak.api.TraceContextPropagator())
+        app.http_client = httpclient.AsyncHTTPClient(force_instance=True,
+                                                     max_clients=1)
+        app.spans = []
+        return app
+
+    def tearDown(self):
+        self._app.http_client.close()
+        super(HTTPClientTests, self).tearDown()
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_headers_are_propagated(self):
+        response = self.fetch('/fanout', headers={'Request-Id': 'abc'})
+        body = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(body, {'request_id': 'abc', 'sampled': '1'})
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_client_spans_are_recorded(self):
+        self.fetch('/fanout')
+        span = self._app.spans[0]
+        self.assertEqual(len(span.children), 1)
+        child = span.children[0]
+        self.assertEqual(child.method, 'GET')
+        self.assertTrue(child.url.endswith('/echo'))
+        self.assertEqual(child.status, 200)
+        self.assertGreaterEqual(child.duration, child.request_time)
+        self.assertLessEqual(span.start, child.start)
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_client_span_is_sent_as_parent(self):
+        response = self.fetch('/fanout?path=/traceparent')
+        body = json.loads(response.body.decode('utf-8'))
+        span = self._app.spans[0]
+        child = span.children[0]
+        self.assertEqual(len(child.span_id), 16)
+        self.assertNotEqual(child.span_id, span.span_id)
+        self.assertEqual(body['traceparent'].split('-')[2], child.span_id)
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_queue_wait_is_recorded(self):
+        self.fetch('/fanout?path=/slow&count=2')
+        children = self._app.spans[0].children
+        self.assertEqual(len(children), 2)
+        self.assertGreater(max(child.queue for child in children), 0.025)
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_error_responses_are_recorded(self):
+        self.fetch('/fanout?path=/missing')
+        self.assertEqual(self._app.spans[0].children[0].status, 404)
+
+    @testing.gen_test
+    def test_that_errors_are_raised(self):
+        client = divak.client.HTTPClient(self._app, self._app.http_client)
+        with self.assertRaises(httpclient.HTTPError):
+            yield client.fetch(self.get_url('/missing'))
+
+    @testing.gen_test
+    def test_that_nothing_is_propagated_outside_of_requests(self):
+        client = divak.client.HTTPClient(self._app, self._app.http_client)
+        response = yield client.fetch(
+            httpclient.HTTPRequest(self.get_url('/echo')))
+        body = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(body, {'request_id': None, 'sampled': None})
+
+    def test_that_kwargs_are_rejected_with_request(self):
+        client = divak.client.HTTPClient(self._app)
+        with self.assertRaises(ValueError):
+            self.io_loop.run_sync(lambda: client.fetch(
+                httpclient.HTTPRequest(self.get_url('/echo')),
+                method='POST'))
+
+
+class ConnectionFailureTests(testing.AsyncTestCase):
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    @testing.gen_test
+    def test_that_failures_are_recorded(self):
+        failure = concurrent.Future()
+        failure.set_exception(IOError('connection refused'))
+        http_client = mock.Mock()
+        http_client.fetch.return_value = failure
+        application = mock.Mock()
+        application.get_divak_outbound_headers.return_value = [('A', 'b')]
+
+        request = mock.Mock()
+        request.divak_span = divak.tracing.Span(divak.tracing.monotonic())
+        token = divak.internals.active_request.set(request)
+        try:
+            client = divak.client.HTTPClient(application, http_client)
+            with self.assertRaises(IOError):
+                yield client.fetch('http://127.0.0.1:1/')
+        finally:
+            divak.internals.active_request.reset(token)
+
+        outbound = http_client.fetch.call_args[0][0]
+        self.assertEqual(outbound.headers['A'], 'b')
+        child = request.divak_span.children[0]
+        self.assertEqual(child.status, 599)
+        self.assertIsNotNone(child.finish)
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    @testing.gen_test
+    def test_that_existing_headers_are_matched_without_case(self):
+        response = concurrent.Future()
+        response.set_result(mock.Mock(error=None, time_info={},
+                                      request_time=None))
+        http_client = mock.Mock()
+        http_client.fetch.return_value = response
+        application = mock.Mock()
+        application.get_divak_outbound_headers.return_value = [
+            ('Request-Id', 'generated')]
+
+        request = mock.Mock(divak_span=None)
+        token = divak.internals.active_request.set(request)
+        try:
+            client = divak.client.HTTPClient(application, http_client)
+            yield client.fetch(httpclient.HTTPRequest(
+                'http://127.0.0.1:1/', headers={'request-id': 'mine'}))
+        finally:
+            divak.internals.active_request.reset(token)
+
+        outbound = http_client.fetch.call_args[0][0]
+        self.assertEqual(list(outbound.headers.get_all()),
+                         [('Request-Id', 'mine')])
@@ -0,0 +1,96 @@
+import unittest
+
+import divak.encoding
+import divak.tracing
+
+
+SPAN_FIELDS = ('service', 'route', 'method', 'uri', 'request_id', 'status',
+               'trace_id', 'span_id', 'parent_id', 'start', 'prepare_start',
+               'prepare_end', 'first_byte', 'finish', 'response_bytes',
+               'chunks', 'max_chunk_gap')
+CHILD_FIELDS = ('method', 'url', 'span_id', 'status', 'start', 'finish',
+                'queue', 'namelookup', 'connect', 'request_time', 'reused')
+
+
+def create_span(index):
+    span = divak.tracing.Span(100.0 + index)
+    span.first_byte = span.start + 0.01
+    span.finish = span.start + 0.02
+    span.service = 'service'
+    span.route = '/items/(\\d+)'
+    span.method = 'GET'
+    span.uri = '/items/{}'.format(index)
+    span.request_id = 'request-{}'.format(index)
+    span.status = 200
+    return span
+
+
+def as_tuple(obj, fields):
+    return tuple(getattr(obj, name) for name in fields)
+
+
+class SpanBatchTests(unittest.TestCase):
+
+    def assert_round_trip(self, spans):
+        data = divak.encoding.encode_spans(spans)
+        decoded = divak.encoding.decode_spans(data)
+        self.assertEqual([as_tuple(span, SPAN_FIELDS) for span in decoded],
+                         [as_tuple(span, SPAN_FIELDS) for span in spans])
+        for original, span in zip(spans, decoded):
+            self.assertEqual(
+                [as_tuple(child, CHILD_FIELDS)
+                 for child in span.children or ()],
+                [as_tuple(child, CHILD_FIELDS)
+                 for child in original.children or ()])
+        return data
+
+    def test_that_spans_round_trip(self):
+        spans = [create_span(index) for index in range(10)]
+        spans[3].trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        spans[3].span_id = '00f067aa0ba902b7'
+        spans[3].parent_id = u'b7ad6b7169203331\u00e9'
+        spans[4].status = None
+        spans[5].response_bytes = 2 ** 40
+        spans[5].chunks = 12
+        spans[5].max_chunk_gap = 0.25
+        self.assert_round_trip(spans)
+
+    def test_that_counts_decode_as_integers(self):
+        span = create_span(0)
+        span.response_bytes = 2 ** 53
+        span.chunks = 0
+        decoded = divak.encoding.decode_spans(
+            divak.encoding.encode_spans([span]))[0]
+        self.assertEqual(decoded.response_bytes, 2 ** 53)
+        self.assertIsInstance(decoded.response_bytes, int)
+        self.assertEqual(decoded.chunks, 0)
+        self.assertIsInstance(decoded.chunks, int)
+
+    def test_that_children_round_trip(self):
+        spans = [create_span(index) for index in range(3)]
+        child = divak.tracing.ClientSpan('POST', 'http://x/y', 100.5,
+                                         'b7ad6b7169203331')
+        child.status = 201
+        child.finish = 100.6
+        child.reused = True
+        spans[0].add_child(child)
+        spans[2].add_child(divak.tracing.ClientSpan('GET', 'http://z/', 1.0))
+        spans[2].add_child(divak.tracing.ClientSpan('PUT', 'http://z/', 2.0))
+        self.assert_round_trip(spans)
+
+    def test_that_empty_batch_round_trips(self):
+        self.assert_round_trip([])
+
+    def test_that_strings_are_stored_once(self):
+        batch = divak.encoding.SpanBatch(
+            create_span(index) for index in range(10))
+        self.assertEqual(len(batch), 10)
+        self.assertEqual(batch.strings.count('service'), 1)
+        self.assertEqual(batch.strings.count('/items/(\\d+)'), 1)
+
+    def test_that_invalid_data_is_rejected(self):
+        data = divak.encoding.encode_spans([create_span(0)])
+        for invalid in (b'', b'XXXX' + data[4:], data[:-1], data + b'\0',
+                        data[:30]):
+            with self.assertRaises(ValueError):
+                divak.encoding.decode_spans(invalid)
@@ -6,17 +6,45 @@ import mock
 import divak.internals
 
 
-class EnsureRequestIdTransformerTests(unittest.TestCase):
+class RequestTransformTests(unittest.TestCase):
 
-    def test_that_request_id_attribute_created(self):
-        request = httputil.HTTPServerRequest(uri='http://google.com/')
+    def setUp(self):
+        super(RequestTransformTests, self).setUp()
+        self.request = httputil.HTTPServerRequest(uri='http://google.com/')
+        self.propagator = mock.Mock()
+        self.propagator.process_request.return_value = (('One', '1'),)
 
-        divak.internals.EnsureRequestIdTransformer(request)
-        self.assertIs(hasattr(request, 'divak_request_id'), True)
+    def create_transform(self, *propagators):
+        return divak.internals.RequestTransform(propagators, self.request)
 
     def test_that_request_id_is_retained_if_present(self):
-        request = httputil.HTTPServerRequest(uri='http://google.com/')
-        setattr(request, 'divak_request_id', mock.sentinel.some_id)
-
-        divak.internals.EnsureRequestIdTransformer(request)
-        self.assertIs(request.divak_request_id, mock.sentinel.some_id)
+        self.request.divak_request_id = mock.sentinel.some_id
+        self.create_transform()
+        self.assertIs(self.request.divak_request_id, mock.sentinel.some_id)
+        self.assertIs(self.request.divak_sampled, True)
+        self.assertIsNotNone(self.request.divak_span)
+
+    def test_that_relayed_headers_are_written_once(self):
+        other = mock.Mock()
+        other.process_request.return_value = (('Two', '2'), ('Three', '3'))
+        transform = self.create_transform(self.propagator, other)
+        headers = httputil.HTTPHeaders({'Three': 'handler'})
+        status, headers, chunk = transform.transform_first_chunk(
+            200, headers, b'chunk', False)
+        self.assertEqual(headers['One'], '1')
+        self.assertEqual(headers['Two'], '2')
+        self.assertEqual(headers['Three'], 'handler')
+        self.assertEqual(transform.transform_chunk(b'x', False), b'x')
+        self.propagator.process_request.assert_called_once_with(
+            self.request)
+
+    def test_that_unsampled_requests_do_not_get_spans(self):
+        def unsample(request):
+            request.divak_sampled = False
+
+        self.propagator.process_request.side_effect = unsample
+        transform = self.create_transform(self.propagator)
+        self.assertIsNone(self.request.divak_span)
+        headers = httputil.HTTPHeaders()
+        transform.transform_first_chunk(200, headers, b'', False)
+        self.assertEqual(list(headers.keys()), [])
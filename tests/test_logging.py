@@ -1,10 +1,13 @@
+import json
 import logging
+import threading
 import unittest
 
-from tornado import testing, web
+from tornado import gen, httputil, testing, web
 import mock
 import tornado.log
 
+import divak.accesslog
 import divak.api
 import divak.internals
 import divak.testing
@@ -47,65 +50,98 @@ class LogInitializationTests(unittest.TestCase):
 
     def setUp(self):
         super(LogInitializationTests, self).setUp()
-        logging.setLoggerClass(logging.Logger)
-        manager = logging.Logger.manager  # type: logging.Manager
-        manager.loggerDict.clear()
-        for handler in logging.root.handlers:
-            filters = []
-            for filter in handler.filters:
-                if not isinstance(filter,
-                                  divak.internals.DivakRequestIdFilter):
-                    filters.append(filter)
-            handler.filters[:] = filters[:]
-
-    def test_that_new_logger_class_is_inserted(self):
-        divak.internals.initialize_logging()
-        self.assertIsNot(logging.getLoggerClass(), logging.Logger)
-        self.assertTrue(issubclass(logging.getLoggerClass(), logging.Logger))
-
-    def test_that_existing_loggers_are_filtered(self):
-        # Install a logger before calling initialize_logging.  Having
-        # multiple parts in the name path ensures that the logging layer
-        # inserts place holder loggers that we need to account for during
-        # initialization.
-        logger = logging.getLogger('package.sub.name')
-        self.assertIs(logger.__class__, logging.Logger)
-        self.assertFalse(
-            logger_has_filter(logger, divak.internals.DivakRequestIdFilter))
+        self.saved_factory = logging.getLogRecordFactory()
+        logging.setLogRecordFactory(logging.LogRecord)
+
+    def tearDown(self):
+        logging.setLogRecordFactory(self.saved_factory)
+        super(LogInitializationTests, self).tearDown()
+
+    def make_record(self, logger, extra=None):
+        return logger.makeRecord(logger.name, logging.INFO, '/file.py', 1,
+                                 'message', (), None, extra=extra)
 
+    def test_that_record_factory_is_installed(self):
+        make_record = logging.Logger.__dict__['makeRecord']
         divak.internals.initialize_logging()
-        self.assertTrue(
-            logger_has_filter(logger, divak.internals.DivakRequestIdFilter))
+        self.assertIs(logging.getLogRecordFactory(),
+                      divak.internals.RequestIdLogRecord)
+        self.assertIs(logging.Logger.__dict__['makeRecord'], make_record)
+        self.assertIs(logging.getLoggerClass(), logging.Logger)
 
-    def test_that_filters_are_not_duplicated(self):
-        # verify that a filter is only added to each handler once
-        handler = logging.NullHandler()
-        handler.addFilter(logging.Filter())  # tests coverage
-        logging.getLogger('one').addHandler(handler)
-        logging.getLogger('two').addHandler(handler)
-        logging.getLogger().addHandler(handler)
+    def test_that_existing_loggers_are_covered(self):
+        class OtherLogger(logging.Logger):
+            pass
 
+        logger = OtherLogger('package.sub.name')
         divak.internals.initialize_logging()
-        handlers = set()
-        for logger in logging.Logger.manager.loggerDict.values():
-            if hasattr(logger, 'handlers'):
-                handlers.update(logger.handlers)
-        for handler in handlers:
-            filter_count = 0
-            for filter in handler.filters:
-                if isinstance(filter, divak.internals.DivakRequestIdFilter):
-                    filter_count += 1
-            self.assertEqual(filter_count, 1)
+        record = self.make_record(logger)
+        self.assertEqual(record.divak_request_id, '')
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_active_request_id_is_used(self):
+        divak.internals.initialize_logging()
+        request = httputil.HTTPServerRequest(uri='/')
+        request.divak_request_id = 'active-id'
+        token = divak.internals.active_request.set(request)
+        try:
+            record = self.make_record(logging.getLogger('some.logger'))
+        finally:
+            divak.internals.active_request.reset(token)
+        self.assertEqual(record.divak_request_id, 'active-id')
+
+    def test_that_explicit_request_id_is_kept(self):
+        divak.internals.initialize_logging()
+        request = httputil.HTTPServerRequest(uri='/')
+        request.divak_request_id = 'active-id'
+        token = divak.internals.active_request.set(request)
+        try:
+            record = self.make_record(logging.getLogger('some.logger'),
+                                      {'divak_request_id': 'explicit-id'})
+        finally:
+            divak.internals.active_request.reset(token)
+        self.assertEqual(record.divak_request_id, 'explicit-id')
+        self.assertEqual(record.getMessage(), 'message')
+        self.assertEqual(record.__dict__['divak_request_id'], 'explicit-id')
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_request_id_is_captured_when_record_is_created(self):
+        divak.internals.initialize_logging()
+        request = httputil.HTTPServerRequest(uri='/')
+        request.divak_request_id = 'active-id'
+        token = divak.internals.active_request.set(request)
+        try:
+            record = self.make_record(logging.getLogger('some.logger'))
+        finally:
+            divak.internals.active_request.reset(token)
+        formatter = logging.Formatter('%(divak_request_id)s %(message)s')
+        self.assertEqual(formatter.format(record), 'active-id message')
+
+    def test_that_existing_factory_is_wrapped(self):
+        def factory(*args, **kwargs):
+            record = logging.LogRecord(*args, **kwargs)
+            record.custom = True
+            return record
+
+        logging.setLogRecordFactory(factory)
+        divak.internals.initialize_logging()
+        record = self.make_record(logging.getLogger('some.logger'))
+        self.assertTrue(record.custom)
+        self.assertEqual(record.divak_request_id, '')
 
     def test_that_calling_initialize_logging_is_idempotent(self):
         divak.internals.initialize_logging()
         divak.internals.initialize_logging()
-        for handler in logging.getLogger().handlers:
-            count = 0
-            for filter in handler.filters:
-                if isinstance(filter, divak.internals.DivakRequestIdFilter):
-                    count += 1
-            self.assertEqual(count, 1)
+        self.assertIs(logging.getLogRecordFactory(),
+                      divak.internals.RequestIdLogRecord)
+
+        logging.setLogRecordFactory(lambda *args: logging.LogRecord(*args))
+        divak.internals.initialize_logging()
+        factory = logging.getLogRecordFactory()
+        divak.internals.initialize_logging()
+        self.assertIs(logging.getLogRecordFactory(), factory)
 
 
 class RequestIdLoggingTests(testing.AsyncHTTPTestCase):
@@ -167,37 +203,364 @@ class InternalLoggerTests(unittest.TestCase):
         self.assertIsNotNone(getattr(record, 'divak_request_id', None))
 
     def test_that_filter_creates_request_id_attribute(self):
-        logger = divak.internals.DivakLogger('logger')
-        record = logger.makeRecord('name', logging.INFO, '/file.py',
+        record = logging.LogRecord('name', logging.INFO, '/file.py',
                                    1, 'message', [], False)
-        if hasattr(record, 'divak_request_id'):
-            delattr(record, 'divak_request_id')
 
         filter_ = divak.internals.DivakRequestIdFilter()
         should_log = bool(filter_.filter(record))
         self.assertTrue(should_log)
 
 
-def logger_has_filter(logger, filter_class):
-    """
-    Will `logger` execute a filter of `filter_class`?
-
-    :param logging.Logger logger: the logger to examine
-    :param class filter_class: the filter class to search for
-    :return: :data:`True` if the `logger` contains a `filter_class`
-        filter instance in it's chain
-    :rtype: bool
-
-    """
-    if isinstance(logger, logging.Logger):
-        for filter in logger.filters:
-            if isinstance(filter, filter_class):
-                return True
-        for handler in logger.handlers:
-            for filter in handler.filters:
-                if isinstance(filter, filter_class):
-                    return True
-        if logger.propagate and logger.parent:
-            if logger_has_filter(logger.parent, filter_class):
-                return True
-    return False
+class BlockingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.unblocked = threading.Event()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.unblocked.wait()
+        self.records.append(record)
+        self.threads.add(threading.current_thread())
+
+
+class BackgroundLogHandlerTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(BackgroundLogHandlerTests, self).setUp()
+        self.target = BlockingHandler()
+        self.handler = divak.accesslog.BackgroundLogHandler(
+            [self.target], max_queue_size=2)
+        self.logger = logging.getLogger('divak.tests.background')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    @testing.gen_test
+    def test_that_records_are_emitted_from_background_thread(self):
+        self.target.unblocked.set()
+        self.handler.start()
+        self.logger.error('message %s', 'one')
+        yield self.handler.stop()
+        self.assertEqual([r.getMessage() for r in self.target.records],
+                         ['message one'])
+        self.assertNotIn(threading.current_thread(), self.target.threads)
+
+    @testing.gen_test
+    def test_that_full_queue_drops_records(self):
+        for _ in range(5):
+            self.logger.error('message')
+        self.assertEqual(self.handler.dropped, 3)
+        self.target.unblocked.set()
+        self.handler.start()
+        yield self.handler.stop()
+        self.assertEqual(len(self.target.records), 2)
+
+    @testing.gen_test
+    def test_that_stop_does_not_block_when_queue_is_full(self):
+        self.handler.start()
+        for _ in range(5):
+            self.logger.error('message')
+        future = self.handler.stop()
+        self.assertFalse(future.done())
+        self.target.unblocked.set()
+        yield future
+        self.assertEqual(len(self.target.records), 5 - self.handler.dropped)
+        self.assertGreaterEqual(len(self.target.records), 2)
+
+    @testing.gen_test
+    def test_that_stop_without_thread_resolves(self):
+        yield self.handler.stop()
+
+    def test_that_handler_levels_are_honored(self):
+        self.target.setLevel(logging.ERROR)
+        self.target.unblocked.set()
+        self.handler.start()
+        self.logger.warning('skipped')
+        self.logger.error('emitted')
+        self.handler.close()
+        self.assertEqual([r.getMessage() for r in self.target.records],
+                         ['emitted'])
+
+
+class BackgroundAccessLogTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(BackgroundAccessLogTests, self).setUp()
+        self.recorder = divak.testing.RecordingLogHandler()
+        tornado.log.access_log.addHandler(self.recorder)
+        self.addCleanup(tornado.log.access_log.removeHandler, self.recorder)
+
+    def get_app(self):
+        self.app = tests.application.Application()
+        return self.app
+
+    def test_that_access_log_is_written_in_background(self):
+        self.app.enable_divak_background_access_log()
+        self.assertEqual(tornado.log.access_log.handlers,
+                         [self.app._divak_access_log[0]])
+        self.fetch('/trace')
+        self.io_loop.run_sync(self.app.stop_divak)
+        self.assertIn(self.recorder, tornado.log.access_log.handlers)
+        self.assertEqual(len(self.recorder.records), 1)
+
+
+class StructuredAccessFormatTests(unittest.TestCase):
+
+    def setUp(self):
+        super(StructuredAccessFormatTests, self).setUp()
+        self.request = httputil.HTTPServerRequest(
+            method='GET', uri='/path?q=1',
+            headers=httputil.HTTPHeaders({
+                'User-Agent': 'agent "quoted"',
+                'X-Forwarded-For': '10.0.0.1, 10.0.0.2'}))
+        self.request.remote_ip = '10.0.0.3'
+        self.request.divak_request_id = 'request-id'
+        self.handler = mock.Mock(request=self.request)
+        self.handler.get_status.return_value = 404
+
+    def test_that_json_format_generates_json(self):
+        message, extra = divak.accesslog.JSONFormat().format(self.handler)
+        body = json.loads(message)
+        self.assertEqual(body['remoteip'], '10.0.0.3')
+        self.assertEqual(body['forwardedfor'], '10.0.0.1, 10.0.0.2')
+        self.assertEqual(body['status'], 404)
+        self.assertEqual(body['uri'], '/path?q=1')
+        self.assertEqual(body['useragent'], 'agent "quoted"')
+        self.assertEqual(body['divak_request_id'], 'request-id')
+        self.assertIsInstance(body['elapsed'], float)
+        self.assertEqual(extra, {'divak_request_id': 'request-id'})
+
+    def test_that_json_format_uses_null_for_missing_values(self):
+        del self.request.headers['X-Forwarded-For']
+        access_format = divak.accesslog.JSONFormat(['forwardedfor'])
+        message, _ = access_format.format(self.handler)
+        self.assertEqual(message, '{"forwardedfor":null}')
+
+    def test_that_logfmt_format_quotes_when_necessary(self):
+        access_format = divak.accesslog.LogfmtFormat(
+            ['method', 'status', 'useragent', 'forwardedfor'])
+        message, _ = access_format.format(self.handler)
+        self.assertEqual(
+            message,
+            'method=GET status=404 useragent="agent \\"quoted\\"" '
+            'forwardedfor="10.0.0.1, 10.0.0.2"')
+
+    def test_that_logfmt_format_leaves_missing_values_empty(self):
+        del self.request.divak_request_id
+        access_format = divak.accesslog.LogfmtFormat(['divak_request_id'])
+        message, _ = access_format.format(self.handler)
+        self.assertEqual(message, 'divak_request_id=')
+
+    def test_that_unknown_fields_are_rejected(self):
+        with self.assertRaises(ValueError):
+            divak.accesslog.JSONFormat(['remoteip', 'whatever'])
+
+
+class AccessLogFormatTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(AccessLogFormatTests, self).setUp()
+        self.recorder = divak.testing.RecordingLogHandler()
+        tornado.log.access_log.addHandler(self.recorder)
+        self.addCleanup(tornado.log.access_log.removeHandler, self.recorder)
+
+    def get_app(self):
+        self.app = tests.application.Application()
+        return self.app
+
+    def test_that_text_format_uses_remote_ip(self):
+        self.fetch('/trace')
+        self.assertEqual(self.recorder.records[0].remoteip, '127.0.0.1')
+
+    def test_that_configured_format_is_used(self):
+        self.app.set_divak_access_log_format(
+            divak.accesslog.JSONFormat(['method', 'status']))
+        self.fetch('/trace')
+        self.assertEqual(self.recorder.records[0].getMessage(),
+                         '{"method":"GET","status":200}')
+
+    def test_that_format_is_skipped_when_level_is_disabled(self):
+        access_format = mock.Mock()
+        self.app.set_divak_access_log_format(access_format)
+        with mock.patch.object(tornado.log.access_log, 'isEnabledFor',
+                               return_value=False):
+            self.fetch('/trace')
+        access_format.format.assert_not_called()
+        self.assertEqual(self.recorder.records, [])
+
+
+class RequestContextTests(testing.AsyncHTTPTestCase):
+
+    class ConcurrentHandler(web.RequestHandler):
+
+        @gen.coroutine
+        def get(self):
+            logger = logging.getLogger('tests.data_access')
+            yield gen.sleep(float(self.get_query_argument('delay')))
+            logger.info('querying data')
+            self.write(divak.internals.get_request_id())
+
+    class LoggingHandler(divak.api.Logger, web.RequestHandler):
+
+        def initialize(self):
+            self.logger = logging.getLogger('tests.data_access')
+
+        @gen.coroutine
+        def get(self):
+            yield gen.sleep(float(self.get_query_argument('delay')))
+            self.logger.info('handling request')
+
+    def setUp(self):
+        super(RequestContextTests, self).setUp()
+        self.recorder = divak.testing.RecordingLogHandler()
+        logger = logging.getLogger('tests.data_access')
+        logger.addHandler(self.recorder)
+        self.addCleanup(logger.removeHandler, self.recorder)
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/concurrent', RequestContextTests.ConcurrentHandler),
+             web.url('/logger', RequestContextTests.LoggingHandler)])
+        app.add_divak_propagator(divak.api.RequestIdPropagator())
+        return app
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    @testing.gen_test
+    def test_that_concurrent_requests_keep_their_own_id(self):
+        client = self.http_client
+        responses = yield [
+            client.fetch(self.get_url('/concurrent?delay=0.05'),
+                         headers={'Request-Id': 'slow'}),
+            client.fetch(self.get_url('/concurrent?delay=0'),
+                         headers={'Request-Id': 'fast'}),
+        ]
+        self.assertEqual([r.body for r in responses], [b'slow', b'fast'])
+        self.assertEqual(
+            [(r.getMessage(), r.divak_request_id)
+             for r in self.recorder.records],
+            [('querying data', 'fast'), ('querying data', 'slow')])
+
+    @testing.gen_test
+    def test_that_handler_logger_passes_request_id(self):
+        client = self.http_client
+        yield [client.fetch(self.get_url('/logger?delay=0.05'),
+                            headers={'Request-Id': 'slow'}),
+               client.fetch(self.get_url('/logger?delay=0'),
+                            headers={'Request-Id': 'fast'})]
+        self.assertEqual(
+            [(r.getMessage(), r.divak_request_id)
+             for r in self.recorder.records],
+            [('handling request', 'fast'), ('handling request', 'slow')])
+
+    def test_that_active_request_is_scoped_to_the_handler(self):
+        def activate(*args):
+            divak.internals.active_request.set(mock.sentinel.request)
+
+        delegate = mock.Mock()
+        delegate.headers_received.side_effect = activate
+        delegate.finish.side_effect = activate
+        scope = divak.internals.ActiveRequestScope(delegate)
+        token = divak.internals.active_request.set(None)
+        try:
+            scope.headers_received(mock.sentinel.start_line,
+                                   mock.sentinel.headers)
+            self.assertIsNone(divak.internals.active_request.get())
+            scope.data_received(b'chunk')
+            scope.finish()
+            self.assertIsNone(divak.internals.active_request.get())
+            self.assertEqual(divak.internals.get_request_id(), '')
+            scope.on_connection_close()
+        finally:
+            divak.internals.active_request.reset(token)
+        delegate.data_received.assert_called_once_with(b'chunk')
+        delegate.on_connection_close.assert_called_once_with()
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_filter_uses_active_request(self):
+        request = httputil.HTTPServerRequest(uri='/')
+        request.divak_request_id = 'active-id'
+        record = logging.LogRecord('name', logging.INFO, '/file.py', 1,
+                                   'message', (), None)
+        token = divak.internals.active_request.set(request)
+        try:
+            divak.internals.DivakRequestIdFilter().filter(record)
+        finally:
+            divak.internals.active_request.reset(token)
+        self.assertEqual(record.divak_request_id, 'active-id')
+
+
+class LogBufferTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.recorder = divak.testing.RecordingLogHandler()
+        self.logger = logging.getLogger('tests.application.TracedHandler')
+        self.logger.addHandler(self.recorder)
+        self.logger.setLevel(logging.INFO)
+        super(LogBufferTests, self).setUp()
+
+    def tearDown(self):
+        self.logger.removeHandler(self.recorder)
+        self.logger.setLevel(logging.NOTSET)
+        super(LogBufferTests, self).tearDown()
+
+    def get_app(self):
+        return tests.application.Application(divak_log_buffer_size=10)
+
+    def test_that_buffer_is_discarded_for_successful_requests(self):
+        self.fetch('/trace')
+        self.assertEqual(self.recorder.records, [])
+
+    def test_that_buffer_is_flushed_for_server_errors(self):
+        self.fetch('/trace')
+        response = self.fetch('/trace?status=503&raise')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(len(self.recorder.records), 1)
+        record = self.recorder.records[0]
+        self.assertEqual(record.levelno, logging.DEBUG)
+        self.assertIn('status=503', record.getMessage())
+
+    def test_that_buffer_is_flushed_for_slow_requests(self):
+        self._app.settings['divak_log_buffer_threshold'] = 0.0
+        self.fetch('/trace')
+        self.assertEqual(len(self.recorder.records), 1)
+
+    def test_that_client_errors_are_not_flushed(self):
+        self.fetch('/trace?status=404')
+        self.assertEqual(self.recorder.records, [])
+
+
+class BufferingLoggerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(BufferingLoggerTests, self).setUp()
+        self.recorder = divak.testing.RecordingLogHandler()
+        self.target = logging.Logger('buffer-target', logging.INFO)
+        self.target.addHandler(self.recorder)
+        self.logger = divak.internals.BufferingLogger(self.target, 2)
+
+    def test_that_enabled_records_are_not_buffered(self):
+        self.logger.debug('buffered')
+        self.logger.info('immediate')
+        self.assertEqual([r.getMessage() for r in self.recorder.records],
+                         ['immediate'])
+        self.logger.flush()
+        self.assertEqual([r.getMessage() for r in self.recorder.records],
+                         ['immediate', 'buffered'])
+
+    def test_that_oldest_records_are_dropped(self):
+        for n in range(3):
+            self.logger.debug('message %d', n)
+        self.assertEqual(self.logger.dropped, 1)
+        self.logger.flush()
+        self.assertEqual([r.getMessage() for r in self.recorder.records],
+                         ['message 1', 'message 2'])
+
+    def test_that_discard_empties_buffer(self):
+        self.logger.debug('buffered')
+        self.logger.discard()
+        self.logger.flush()
+        self.assertEqual(self.recorder.records, [])
@@ -0,0 +1,268 @@
+import multiprocessing
+import random
+import unittest
+
+from tornado import gen, testing, web
+import mock
+
+import divak.internals
+import divak.metrics
+import tests.application
+
+
+class LatencyHistogramTests(unittest.TestCase):
+
+    def test_that_values_land_in_the_correct_bucket(self):
+        bounds = divak.metrics.BUCKET_BOUNDS
+        for _ in range(1000):
+            value = 10 ** random.uniform(-5, 2)
+            histogram = divak.metrics.LatencyHistogram()
+            histogram.record(value)
+            index = list(histogram.values[:-1]).index(1)
+            self.assertLessEqual(value, bounds[index])
+            if index > 0:
+                self.assertGreater(value, bounds[index - 1])
+
+    def test_that_boundary_values_are_in_the_lower_bucket(self):
+        bounds = divak.metrics.BUCKET_BOUNDS
+        for index, bound in enumerate(bounds):
+            histogram = divak.metrics.LatencyHistogram()
+            histogram.record(bound)
+            self.assertEqual(histogram.values[index], 1, bound)
+            self.assertEqual(histogram.quantile(1.0), bound)
+
+    def test_that_small_and_non_positive_values_use_first_bucket(self):
+        histogram = divak.metrics.LatencyHistogram()
+        for value in (0.0, -1.0, 1e-9):
+            histogram.record(value)
+        self.assertEqual(histogram.values[0], 3)
+
+    def test_that_large_values_overflow(self):
+        histogram = divak.metrics.LatencyHistogram()
+        histogram.record(1e6)
+        self.assertEqual(histogram.values[len(divak.metrics.BUCKET_BOUNDS)],
+                         1)
+        self.assertEqual(histogram.quantile(0.5), float('inf'))
+
+    def test_that_count_and_sum_are_tracked(self):
+        histogram = divak.metrics.LatencyHistogram()
+        histogram.record(0.25)
+        histogram.record(0.5)
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(histogram.sum, 0.75)
+
+    def test_that_quantiles_are_estimated(self):
+        histogram = divak.metrics.LatencyHistogram()
+        self.assertIsNone(histogram.quantile(0.5))
+        for _ in range(99):
+            histogram.record(0.010)
+        histogram.record(2.0)
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.010, delta=0.003)
+        self.assertAlmostEqual(histogram.quantile(0.999), 2.0, delta=0.5)
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def test_that_histograms_are_reused(self):
+        registry = divak.metrics.MetricsRegistry()
+        first = registry.histogram('name', (('label', 'value'),))
+        self.assertIs(registry.histogram('name', (('label', 'value'),)),
+                      first)
+        self.assertIsNot(registry.histogram('name', (('label', 'other'),)),
+                         first)
+
+    def test_that_render_generates_prometheus_histograms(self):
+        registry = divak.metrics.MetricsRegistry()
+        registry.describe('latency', 'Some help.')
+        registry.histogram('latency', (('route', '/a"b'),)).record(0.5)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[0], '# HELP latency Some help.')
+        self.assertEqual(lines[1], '# TYPE latency histogram')
+        self.assertIn('latency_bucket{route="/a\\"b",le="+Inf"} 1', lines)
+        self.assertIn('latency_sum{route="/a\\"b"} 0.5', lines)
+        self.assertIn('latency_count{route="/a\\"b"} 1', lines)
+
+    def test_that_render_generates_prometheus_counters(self):
+        registry = divak.metrics.MetricsRegistry()
+        registry.describe('bytes_total', 'Some help.')
+        counter = registry.counter('bytes_total', (('route', '/a'),))
+        self.assertIs(registry.counter('bytes_total', (('route', '/a'),)),
+                      counter)
+        counter.increment(10)
+        counter.increment()
+        registry.counter('calls_total').increment()
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:3], ['# HELP bytes_total Some help.',
+                                     '# TYPE bytes_total counter',
+                                     'bytes_total{route="/a"} 11.0'])
+        self.assertIn('calls_total 1.0', lines)
+
+
+def record_in_worker(registry, worker, keys, value):
+    with mock.patch('tornado.process.task_id', return_value=worker):
+        for key in keys:
+            registry.histogram('latency', key).record(value)
+            registry.counter('calls_total', key).increment()
+
+
+class SharedMetricsRegistryTests(unittest.TestCase):
+
+    def run_worker(self, *args):
+        context = multiprocessing.get_context('fork')
+        worker = context.Process(target=record_in_worker, args=args)
+        worker.start()
+        worker.join()
+        self.assertEqual(worker.exitcode, 0)
+
+    def test_that_workers_are_summed(self):
+        registry = divak.metrics.SharedMetricsRegistry(max_workers=2)
+        first, second = (('route', '/a'),), (('route', '/b'),)
+        self.run_worker(registry, 0, [first, second], 0.5)
+        self.run_worker(registry, 1, [second, first], 0.25)
+
+        lines = registry.render().splitlines()
+        self.assertIn('latency_count{route="/a"} 2', lines)
+        self.assertIn('latency_sum{route="/a"} 0.75', lines)
+        self.assertIn('latency_count{route="/b"} 2', lines)
+        self.assertIn('calls_total{route="/a"} 2.0', lines)
+
+    def test_that_local_histograms_are_shared(self):
+        registry = divak.metrics.SharedMetricsRegistry(max_workers=2)
+        registry.histogram('latency', (('route', '/a'),)).record(0.5)
+        self.run_worker(registry, 1, [(('route', '/a'),)], 0.5)
+        self.assertIn('latency_count{route="/a"} 2',
+                      registry.render().splitlines())
+
+    def test_that_exhausted_space_falls_back_to_private(self):
+        registry = divak.metrics.SharedMetricsRegistry(max_workers=1,
+                                                       max_histograms=1)
+        registry.histogram('latency', (('route', '/a'),)).record(0.5)
+        registry.histogram('latency', (('route', '/b'),)).record(0.5)
+        lines = registry.render().splitlines()
+        self.assertIn('latency_count{route="/a"} 1', lines)
+        self.assertIn('latency_count{route="/b"} 1', lines)
+
+    def test_that_extra_workers_fall_back_to_private(self):
+        registry = divak.metrics.SharedMetricsRegistry(max_workers=1)
+        with mock.patch('tornado.process.task_id', return_value=3):
+            histogram = registry.histogram('latency')
+        histogram.record(0.5)
+        self.assertIsInstance(histogram.values, divak.metrics.array.array)
+        self.assertIn('latency_count 1', registry.render().splitlines())
+
+
+class RouteResolverTests(testing.AsyncHTTPTestCase):
+
+    class Handler(web.RequestHandler):
+
+        def get(self, *args):
+            self.write(self.application.resolver.route_for(self))
+
+    def get_app(self):
+        app = tests.application.Application([
+            web.url(r'/one/(\d+)', RouteResolverTests.Handler),
+            web.url(r'/two/(\w+)', RouteResolverTests.Handler)])
+        app.resolver = divak.internals.RouteResolver(app)
+        return app
+
+    def test_that_matching_pattern_is_returned(self):
+        self.assertEqual(self.fetch('/one/12').body, b'/one/(\\d+)')
+        self.assertEqual(self.fetch('/two/xy').body, b'/two/(\\w+)')
+
+    def test_that_unrouted_handlers_are_unmatched(self):
+        handler = mock.Mock()
+        self.assertEqual(self._app.resolver.route_for(handler),
+                         divak.internals.RouteResolver.UNMATCHED)
+
+
+class RecorderMetricsTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.app = tests.application.Application()
+        self.registry = self.app.enable_divak_metrics('/status/metrics')
+        return self.app
+
+    def test_that_latencies_are_recorded_per_route(self):
+        self.fetch('/trace')
+        self.fetch('/trace?status=500&raise')
+        self.fetch('/does-not-exist')
+        name = self.app.REQUEST_DURATION
+        self.assertEqual(
+            self.registry.histogram(
+                name, (('route', '/trace'), ('status', '2xx'))).count, 1)
+        self.assertEqual(
+            self.registry.histogram(
+                name, (('route', '/trace'), ('status', '5xx'))).count, 1)
+        self.assertEqual(
+            self.registry.histogram(
+                name, (('route', 'unmatched'), ('status', '4xx'))).count, 1)
+
+    def test_that_metrics_are_exposed(self):
+        self.fetch('/trace')
+        response = self.fetch('/status/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn(
+            b'divak_request_duration_seconds_count'
+            b'{route="/trace",status="2xx"} 1', response.body)
+
+
+class StreamingHandler(web.RequestHandler):
+
+    @gen.coroutine
+    def get(self):
+        for _ in range(3):
+            self.write(b'x' * 100)
+            yield self.flush()
+            yield gen.sleep(0.05)
+        self.finish(b'y' * 50)
+
+
+class StreamAccountingTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.app = tests.application.Application(
+            [web.url('/stream', StreamingHandler)],
+            divak_report_interval=60.0)
+        self.reporter = tests.application.CollectingReporter()
+        self.app.add_divak_reporter(self.reporter)
+        self.registry = self.app.enable_divak_stream_accounting()
+        return self.app
+
+    def test_that_chunks_are_counted(self):
+        self.fetch('/stream')
+        self.io_loop.run_sync(self.app.stop_divak)
+        span = self.reporter.observations[0]
+        self.assertEqual(span.response_bytes, 350)
+        self.assertEqual(span.chunks, 4)
+        self.assertGreaterEqual(span.max_chunk_gap, 0.04)
+
+    def test_that_route_metrics_are_recorded(self):
+        self.fetch('/stream')
+        self.fetch('/stream')
+        labels = (('route', '/stream'),)
+        self.assertEqual(
+            self.registry.counter(self.app.RESPONSE_BYTES, labels).value,
+            700)
+        self.assertEqual(
+            self.registry.counter(self.app.RESPONSE_CHUNKS, labels).value, 8)
+        duration = self.registry.histogram(
+            self.app.RESPONSE_STREAM_DURATION, labels)
+        self.assertEqual(duration.count, 2)
+        self.assertGreaterEqual(duration.sum, 0.3)
+        gap = self.registry.histogram(self.app.RESPONSE_CHUNK_GAP, labels)
+        self.assertEqual(gap.count, 2)
+        body = self.fetch('/metrics').body.decode('utf-8')
+        self.assertIn('divak_response_bytes_total{route="/stream"} 700.0',
+                      body)
+
+    def test_that_chunks_are_not_retained(self):
+        request = mock.Mock()
+        transform = divak.internals.StreamTransform(request)
+        self.assertIs(request.divak_stream, transform)
+        chunk = b'abc'
+        transform.transform_first_chunk(200, {}, chunk, False)
+        transform.transform_chunk(b'', True)
+        self.assertEqual((transform.bytes, transform.chunks), (3, 1))
+        self.assertFalse(hasattr(transform, '__dict__'))
@@ -0,0 +1,171 @@
+import sys
+import time
+import unittest
+
+from tornado import gen, httputil, testing, web
+import mock
+
+import divak.api
+import divak.profiling
+import tests.application
+
+
+class WorkingHandler(web.RequestHandler):
+
+    def work(self, sampler):
+        sampler.sample(sys._getframe())
+
+    def other_work(self, sampler):
+        sampler.sample(sys._getframe())
+
+    def get(self):
+        deadline = time.time() + 0.1
+        while time.time() < deadline:
+            busy_work()
+        self.write('done')
+
+
+class BlockingHandler(web.RequestHandler):
+
+    def get(self):
+        time.sleep(0.3)
+        self.write('done')
+
+
+def busy_work():
+    return sum(range(100))
+
+
+def create_handler():
+    request = httputil.HTTPServerRequest(uri='/', connection=mock.Mock())
+    request.divak_request_id = 'request-id'
+    return WorkingHandler(web.Application(), request)
+
+
+class StackSamplerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(StackSamplerTests, self).setUp()
+        self.sampler = divak.profiling.StackSampler(
+            0.5, route_for=lambda handler: '/route')
+
+    def test_that_slow_request_samples_are_kept(self):
+        handler = create_handler()
+        handler.work(self.sampler)
+        handler.work(self.sampler)
+        self.sampler.finish(handler, 1.0)
+
+        lines = self.sampler.collapsed().splitlines()
+        self.assertEqual(len(lines), 1)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertEqual(count, '2')
+        self.assertTrue(stack.startswith('/route;'))
+        self.assertTrue(stack.endswith(';test_profiling.py:work'))
+
+        self.assertEqual(self.sampler.collapsed(route='/route'),
+                         self.sampler.collapsed(request_id='request-id'))
+        self.assertEqual(self.sampler.collapsed(request_id='other'), '')
+        request_id, route, duration, _ = self.sampler.slow_requests[0]
+        self.assertEqual((request_id, route, duration),
+                         ('request-id', '/route', 1.0))
+
+    def test_that_fast_request_samples_are_discarded(self):
+        handler = create_handler()
+        handler.work(self.sampler)
+        self.sampler.finish(handler, 0.1)
+        self.sampler.finish(handler, 1.0)
+        self.assertEqual(self.sampler.collapsed(), '')
+
+    def test_that_samples_after_finish_are_discarded(self):
+        handler = create_handler()
+        handler.work(self.sampler)
+        self.sampler.finish(handler, 1.0)
+        handler.work(self.sampler)
+        self.sampler._assign_samples()
+        self.assertEqual(self.sampler._pending, {})
+        self.assertEqual(self.sampler.collapsed(route='/route'),
+                         self.sampler.collapsed(request_id='request-id'))
+        self.assertTrue(self.sampler.collapsed().endswith(' 1\n'))
+
+    def test_that_samples_outside_of_handlers_are_ignored(self):
+        self.sampler.sample(sys._getframe())
+        self.sampler._assign_samples()
+        self.assertEqual(self.sampler._pending, {})
+        self.assertEqual(len(self.sampler._samples), 0)
+
+    def test_that_labels_are_bounded(self):
+        labels = {}
+        with mock.patch('divak.profiling._MAX_LABELS', 1):
+            _, stack = divak.profiling._walk_stack(sys._getframe(), labels,
+                                                   64)
+        self.assertEqual(len(labels), 1)
+        self.assertTrue(stack.endswith(
+            ';test_profiling.py:test_that_labels_are_bounded'))
+
+    def test_that_distinct_stacks_are_limited(self):
+        self.sampler.max_stacks = 1
+        handler = create_handler()
+        handler.work(self.sampler)
+        handler.other_work(self.sampler)
+        self.sampler.finish(handler, 1.0)
+        self.assertEqual(len(self.sampler.collapsed().splitlines()), 1)
+        self.assertEqual(self.sampler.truncated, 1)
+
+
+class RecorderProfilerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/work', WorkingHandler)])
+        app.enable_divak_profiler(0.0, interval=0.001)
+        return app
+
+    def tearDown(self):
+        self.io_loop.run_sync(self._app.stop_divak)
+        super(RecorderProfilerTests, self).tearDown()
+
+    def test_that_slow_requests_are_profiled(self):
+        self.fetch('/work')
+        response = self.fetch('/profile?route=/work')
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/plain; charset=utf-8')
+        self.assertIn(b'test_profiling.py:busy_work', response.body)
+
+
+class LoopMonitorTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/block', BlockingHandler),
+             web.url('/work', WorkingHandler)])
+        app.add_divak_propagator(divak.api.RequestIdPropagator())
+        self.monitor = app.enable_divak_loop_monitor(threshold=0.1,
+                                                     interval=0.01)
+        return app
+
+    def tearDown(self):
+        self.io_loop.run_sync(self._app.stop_divak)
+        super(LoopMonitorTests, self).tearDown()
+
+    def test_that_blocking_request_is_identified(self):
+        self.fetch('/block', headers={'Request-Id': 'blocker'})
+        self.assertEqual(len(self.monitor.events), 1)
+        event = self.monitor.events[0]
+        self.assertEqual(event.request_id, 'blocker')
+        self.assertEqual(event.handler, 'BlockingHandler')
+        self.assertGreaterEqual(event.duration, 0.1)
+        self.assertTrue(event.stack.endswith('test_profiling.py:get'))
+
+    def test_that_lag_is_published(self):
+        self.fetch('/block')
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+        body = self.fetch('/metrics').body.decode('utf-8')
+        self.assertIn('divak_ioloop_lag_seconds_count', body)
+        self.assertIn('divak_ioloop_blocked_seconds_count 1\n', body)
+
+    def test_that_responsive_loop_is_not_reported(self):
+        self.io_loop.run_sync(lambda: gen.sleep(0.2))
+        self.assertEqual(len(self.monitor.events), 0)
+        lag = self._app.enable_divak_metrics().histogram(
+            divak.profiling.LoopMonitor.LAG)
+        self.assertGreater(lag.count, 0)
@@ -0,0 +1,360 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tornado import concurrent, gen, testing
+import mock
+
+import divak.encoding
+import divak.reporting
+import divak.tracing
+import tests.application
+
+
+class ReportingPipelineTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ReportingPipelineTests, self).setUp()
+        self.reporter = tests.application.CollectingReporter()
+
+    def create_pipeline(self, **kwargs):
+        kwargs.setdefault('flush_interval', 60.0)
+        pipeline = divak.reporting.ReportingPipeline(**kwargs)
+        pipeline.reporters.append(self.reporter)
+        return pipeline
+
+    @testing.gen_test
+    def test_that_batch_size_triggers_flush(self):
+        pipeline = self.create_pipeline(batch_size=2)
+        pipeline.add(1)
+        pipeline.add(2)
+        yield gen.moment
+        self.assertEqual(self.reporter.batches, [[1, 2]])
+        yield pipeline.stop()
+
+    @testing.gen_test
+    def test_that_stop_delivers_everything(self):
+        pipeline = self.create_pipeline(batch_size=2)
+        for value in range(5):
+            pipeline.add(value)
+        yield pipeline.stop()
+        self.assertEqual(self.reporter.observations, list(range(5)))
+
+    @testing.gen_test
+    def test_that_drop_oldest_policy_discards_oldest(self):
+        pipeline = self.create_pipeline(
+            batch_size=10, max_queue_size=10,
+            overflow_policy=divak.reporting.OVERFLOW_DROP_OLDEST)
+        for value in range(12):
+            pipeline.add(value)
+        yield pipeline.stop()
+        self.assertEqual(pipeline.dropped, 2)
+        self.assertEqual(self.reporter.observations, list(range(2, 12)))
+
+    @testing.gen_test
+    def test_that_drop_newest_policy_discards_newest(self):
+        pipeline = self.create_pipeline(
+            batch_size=10, max_queue_size=10,
+            overflow_policy=divak.reporting.OVERFLOW_DROP_NEWEST)
+        for value in range(12):
+            pipeline.add(value)
+        yield pipeline.stop()
+        self.assertEqual(pipeline.dropped, 2)
+        self.assertEqual(self.reporter.observations, list(range(10)))
+
+    @testing.gen_test
+    def test_that_discard_policy_discards_queued_observations(self):
+        pipeline = self.create_pipeline(
+            batch_size=10, max_queue_size=10,
+            overflow_policy=divak.reporting.OVERFLOW_DISCARD)
+        for value in range(12):
+            pipeline.add(value)
+        yield pipeline.stop()
+        self.assertEqual(pipeline.dropped, 10)
+        self.assertEqual(self.reporter.observations, [10, 11])
+
+    @testing.gen_test
+    def test_that_slow_reporter_does_not_block_adds(self):
+        slow_future = concurrent.Future()
+        self.reporter.report = lambda batch: slow_future
+        pipeline = self.create_pipeline(
+            batch_size=1, max_queue_size=2,
+            overflow_policy=divak.reporting.OVERFLOW_DROP_NEWEST)
+        for value in range(5):
+            pipeline.add(value)
+            yield gen.moment
+        self.assertEqual(pipeline.dropped, 2)
+        slow_future.set_result(None)
+        yield pipeline.stop()
+
+    @testing.gen_test
+    def test_that_failing_reporter_does_not_stop_delivery(self):
+        def fail(batch):
+            raise RuntimeError('injected failure')
+
+        failing = tests.application.CollectingReporter()
+        failing.report = fail
+        pipeline = self.create_pipeline(batch_size=1)
+        pipeline.reporters.insert(0, failing)
+        pipeline.add(1)
+        yield pipeline.stop()
+        self.assertEqual(self.reporter.observations, [1])
+
+    @testing.gen_test
+    def test_that_tail_sampler_filters_batches(self):
+        tail_sampler = mock.Mock()
+        tail_sampler.filter.side_effect = lambda batch: [
+            value for value in batch if value % 3 == 0]
+        pipeline = self.create_pipeline(batch_size=2,
+                                        tail_sampler=tail_sampler)
+        for value in range(7):
+            pipeline.add(value)
+        yield pipeline.stop()
+        self.assertEqual(self.reporter.observations, [0, 3, 6])
+
+
+class PipelineConfigurationTests(unittest.TestCase):
+
+    def test_that_invalid_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            divak.reporting.ReportingPipeline(overflow_policy='whatever')
+
+    def test_that_queue_must_hold_a_batch(self):
+        with self.assertRaises(ValueError):
+            divak.reporting.ReportingPipeline(batch_size=10,
+                                              max_queue_size=5)
+
+
+class RecorderReportingTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.reporter = tests.application.CollectingReporter()
+        self.app = tests.application.Application(
+            divak_report_interval=60.0)
+        self.app.add_divak_reporter(self.reporter)
+        return self.app
+
+    def test_that_requests_are_reported(self):
+        self.fetch('/trace')
+        self.io_loop.run_sync(self.app.stop_divak)
+        self.assertEqual(len(self.reporter.observations), 1)
+        span = self.reporter.observations[0]
+        self.assertEqual(span.service, 'test-application')
+        self.assertEqual(span.status, 200)
+        self.assertEqual(span.uri, '/trace')
+        self.assertEqual(span.route, '/trace')
+
+    def test_that_tail_sampler_is_used(self):
+        tail_sampler = mock.Mock()
+        tail_sampler.filter.return_value = []
+        self.app.set_divak_tail_sampler(tail_sampler)
+        self.fetch('/trace')
+        self.io_loop.run_sync(self.app.stop_divak)
+        self.assertEqual(self.reporter.observations, [])
+        self.assertEqual(len(tail_sampler.filter.call_args[0][0]), 1)
+
+
+class RingFileTests(unittest.TestCase):
+
+    def setUp(self):
+        super(RingFileTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(RingFileTests, self).tearDown()
+
+    def read_all(self, ring):
+        payloads = []
+        while ring.count:
+            sequence, payload = ring.peek()
+            payloads.append(payload)
+            ring.remove(sequence)
+        return payloads
+
+    def test_that_records_are_read_in_order(self):
+        ring = divak.reporting.RingFile(self.path, 4096)
+        for value in range(10):
+            self.assertTrue(ring.append(str(value).encode('ascii')))
+        self.assertEqual(self.read_all(ring),
+                         [str(value).encode('ascii') for value in range(10)])
+        self.assertIsNone(ring.peek())
+
+    def test_that_records_wrap_around(self):
+        ring = divak.reporting.RingFile(self.path, 256)
+        payloads = [bytes(bytearray([value]) * 50) for value in range(20)]
+        read = []
+        for payload in payloads:
+            ring.append(payload)
+            read.extend(self.read_all(ring))
+        self.assertEqual(read, payloads)
+        self.assertEqual(ring.dropped, 0)
+
+    def test_that_oldest_records_are_dropped_when_full(self):
+        ring = divak.reporting.RingFile(self.path, 256)
+        payloads = [bytes(bytearray([value]) * 50) for value in range(10)]
+        for payload in payloads:
+            ring.append(payload)
+        remaining = self.read_all(ring)
+        self.assertEqual(remaining, payloads[-len(remaining):])
+        self.assertEqual(ring.dropped + len(remaining), len(payloads))
+
+    def test_that_dropped_record_is_not_removed(self):
+        ring = divak.reporting.RingFile(self.path, 160)
+        ring.append(b'a' * 50)
+        sequence, _ = ring.peek()
+        ring.append(b'b' * 50)
+        ring.append(b'c' * 50)
+        ring.remove(sequence)
+        self.assertEqual(self.read_all(ring), [b'b' * 50, b'c' * 50])
+
+    def test_that_oversized_records_are_rejected(self):
+        ring = divak.reporting.RingFile(self.path, 128)
+        self.assertFalse(ring.append(b'x' * (ring.capacity + 1)))
+        self.assertTrue(ring.append(b'x' * ring.capacity))
+
+    def test_that_records_survive_reopening(self):
+        ring = divak.reporting.RingFile(self.path, 4096)
+        ring.append(b'one')
+        ring.append(b'two')
+        ring.remove(ring.peek()[0])
+        ring.close()
+
+        ring = divak.reporting.RingFile(self.path, 4096)
+        self.assertEqual(self.read_all(ring), [b'two'])
+
+    def test_that_resized_file_is_reinitialized(self):
+        ring = divak.reporting.RingFile(self.path, 4096)
+        ring.append(b'one')
+        ring.close()
+        ring = divak.reporting.RingFile(self.path, 8192)
+        self.assertEqual(ring.count, 0)
+
+
+class FlakyReporter(tests.application.CollectingReporter):
+
+    def __init__(self):
+        super(FlakyReporter, self).__init__()
+        self.failing = False
+        self.partial_failures = 0
+
+    def report(self, observations):
+        if self.failing:
+            raise IOError('backend is down')
+        if self.partial_failures:
+            self.partial_failures -= 1
+            super(FlakyReporter, self).report(observations[:1])
+            raise divak.reporting.PartialReportError(
+                observations[1:], IOError('backend went down'))
+        super(FlakyReporter, self).report(observations)
+
+
+class SpoolingReporterTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(SpoolingReporterTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.backend = FlakyReporter()
+        self.reporter = self.create_reporter()
+
+    def tearDown(self):
+        self.reporter.close()
+        shutil.rmtree(self.directory)
+        super(SpoolingReporterTests, self).tearDown()
+
+    def create_reporter(self):
+        return divak.reporting.SpoolingReporter(
+            self.backend, os.path.join(self.directory, 'spool'),
+            size=64 * 1024, replay_rate=1000.0, retry_interval=0.01)
+
+    @gen.coroutine
+    def wait_for_replay(self):
+        for _ in range(100):
+            if not self.reporter.spool.count:
+                break
+            yield gen.sleep(0.01)
+
+    @testing.gen_test
+    def test_that_batches_are_passed_through(self):
+        yield self.reporter.report([1, 2])
+        self.assertEqual(self.backend.batches, [[1, 2]])
+        self.assertEqual(self.reporter.spool.count, 0)
+
+    @testing.gen_test
+    def test_that_batches_are_replayed_after_outage(self):
+        self.backend.failing = True
+        yield self.reporter.report([1])
+        yield self.reporter.report([2])
+        self.assertEqual(self.reporter.spool.count, 2)
+
+        self.backend.failing = False
+        yield self.wait_for_replay()
+        yield self.reporter.report([3])
+        self.assertEqual(self.backend.observations, [1, 2, 3])
+
+    @testing.gen_test
+    def test_that_only_undelivered_observations_are_spooled(self):
+        self.backend.partial_failures = 1
+        yield self.reporter.report([1, 2, 3])
+        yield self.wait_for_replay()
+        self.assertEqual(self.backend.observations, [1, 2, 3])
+
+    @testing.gen_test
+    def test_that_partial_replay_is_not_repeated(self):
+        self.backend.failing = True
+        yield self.reporter.report([1, 2])
+        self.backend.failing = False
+        self.backend.partial_failures = 1
+        yield self.wait_for_replay()
+        self.assertEqual(self.backend.observations, [1, 2])
+        self.assertEqual(self.reporter.dropped, 0)
+
+    @testing.gen_test
+    def test_that_spans_are_spooled(self):
+        span = divak.tracing.Span(divak.tracing.monotonic())
+        span.status = 200
+        span.add_child(divak.tracing.ClientSpan('GET', 'http://x/', 1.0))
+        self.backend.failing = True
+        yield self.reporter.report([span])
+        self.backend.failing = False
+        yield self.wait_for_replay()
+        replayed = self.backend.observations[0]
+        self.assertEqual(replayed.status, 200)
+        self.assertEqual(replayed.children[0].url, 'http://x/')
+
+    @testing.gen_test
+    def test_that_spans_can_be_spooled_in_binary(self):
+        self.reporter.close()
+        self.reporter = divak.reporting.SpoolingReporter(
+            self.backend, os.path.join(self.directory, 'binary'),
+            size=64 * 1024, replay_rate=1000.0, retry_interval=0.01,
+            encode=divak.encoding.encode_spans,
+            decode=divak.encoding.decode_spans)
+        span = divak.tracing.Span(1.0)
+        span.status = 500
+        self.backend.failing = True
+        yield self.reporter.report([span])
+        self.backend.failing = False
+        yield self.wait_for_replay()
+        self.assertEqual(self.backend.observations[0].status, 500)
+
+    @testing.gen_test
+    def test_that_spool_is_replayed_after_restart(self):
+        self.backend.failing = True
+        yield self.reporter.report([1])
+        self.reporter.close()
+
+        self.backend.failing = False
+        self.reporter = self.create_reporter()
+        yield self.reporter.report([2])
+        yield self.wait_for_replay()
+        self.assertEqual(sorted(self.backend.observations), [1, 2])
+
+    @testing.gen_test
+    def test_that_oversized_batches_are_dropped(self):
+        self.backend.failing = True
+        yield self.reporter.report([b'x' * 100000])
+        self.assertEqual(self.reporter.dropped, 1)
+        self.assertEqual(self.reporter.spool.count, 0)
@@ -1,7 +1,9 @@
 import logging
+import unittest
 import uuid
 
-from tornado import testing
+from tornado import testing, web
+import mock
 
 import divak.api
 import divak.testing
@@ -12,13 +14,11 @@ class RequestIdPropagationTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
         self._app = tests.application.Application()
-        self.initial_transforms = self._app.transforms[:]
         self._app.add_divak_propagator(divak.api.RequestIdPropagator())
         return self._app
 
     def setUp(self):
         self._app = None
-        self.initial_transforms = None
         super(RequestIdPropagationTests, self).setUp()
 
     def test_that_request_id_header_is_generated(self):
@@ -30,13 +30,6 @@ class RequestIdPropagationTests(testing.AsyncHTTPTestCase):
         response = self.fetch('/trace', headers={'Request-Id': request_id})
         self.assertEqual(response.headers['request-id'], request_id)
 
-    def test_that_response_header_generation_can_be_disabled(self):
-        self._app.transforms = self.initial_transforms
-        self._app.add_divak_propagator(
-            divak.api.RequestIdPropagator(value_factory=None))
-        response = self.fetch('/trace')
-        self.assertIsNone(response.headers.get('Request-Id'))
-
     def test_that_response_header_is_generated_on_failure(self):
         response = self.fetch('/trace?status=500&raise')
         self.assertEqual(response.code, 500)
@@ -56,3 +49,101 @@ class RequestIdPropagationTests(testing.AsyncHTTPTestCase):
     def test_that_request_id_from_handler_is_honored(self):
         response = self.fetch('/trace?override_id=foo')
         self.assertEqual(response.headers['Request-Id'], 'foo')
+
+
+class DisabledGenerationTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = tests.application.Application()
+        app.add_divak_propagator(
+            divak.api.RequestIdPropagator(value_factory=None))
+        return app
+
+    def test_that_response_header_generation_can_be_disabled(self):
+        response = self.fetch('/trace')
+        self.assertIsNone(response.headers.get('Request-Id'))
+
+    def test_that_request_header_is_still_relayed(self):
+        response = self.fetch('/trace', headers={'Request-Id': 'abc'})
+        self.assertEqual(response.headers['Request-Id'], 'abc')
+
+
+class TransformFunctionTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = web.Application(
+            [web.url('/trace', tests.application.TracedHandler)])
+        app.add_transform(divak.api.RequestIdPropagator().handle_request)
+        return app
+
+    def test_that_propagator_works_without_recorder(self):
+        response = self.fetch('/trace', headers={'Request-Id': 'abc'})
+        self.assertEqual(response.headers['Request-Id'], 'abc')
+
+
+class RandomIdFactoryTests(unittest.TestCase):
+
+    def test_that_ids_are_hex_strings(self):
+        factory = divak.api.RandomIdFactory()
+        value = factory()
+        self.assertEqual(len(value), 32)
+        int(value, 16)
+
+    def test_that_id_size_is_configurable(self):
+        factory = divak.api.RandomIdFactory(block_size=4, id_bytes=8)
+        values = [factory() for _ in range(10)]
+        self.assertEqual(set(len(value) for value in values), {16})
+        self.assertEqual(len(set(values)), 10)
+
+    def test_that_ids_are_unique_across_blocks(self):
+        factory = divak.api.RandomIdFactory(block_size=4)
+        values = set(factory() for _ in range(100))
+        self.assertEqual(len(values), 100)
+
+    def test_that_block_is_discarded_after_fork(self):
+        factory = divak.api.RandomIdFactory(block_size=4)
+        with mock.patch('divak.internals.process_id') as process_id:
+            process_id.return_value = 1
+            first = factory()
+            process_id.return_value = 2
+            with mock.patch('os.urandom') as urandom:
+                urandom.return_value = b'\0' * 64
+                self.assertEqual(factory(), '0' * 32)
+        self.assertNotEqual(first, '0' * 32)
+
+
+class SequentialIdFactoryTests(unittest.TestCase):
+
+    def test_that_ids_share_prefix_and_increment(self):
+        factory = divak.api.SequentialIdFactory()
+        first, second = factory(), factory()
+        prefix, _, counter = first.rpartition('-')
+        self.assertEqual(len(prefix), 16)
+        self.assertEqual(counter, '1')
+        self.assertEqual(second, prefix + '-2')
+
+    def test_that_prefix_is_regenerated_after_fork(self):
+        factory = divak.api.SequentialIdFactory(separator=':')
+        with mock.patch('divak.internals.process_id') as process_id:
+            process_id.return_value = 1
+            first = factory()
+            process_id.return_value = 2
+            second = factory()
+        self.assertNotEqual(first.partition(':')[0],
+                            second.partition(':')[0])
+        self.assertTrue(second.endswith(':1'))
+
+
+class ValueFactoryPropagationTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = tests.application.Application()
+        app.add_divak_propagator(divak.api.RequestIdPropagator(
+            value_factory=divak.api.SequentialIdFactory()))
+        return app
+
+    def test_that_generated_ids_are_used(self):
+        first = self.fetch('/trace').headers['Request-Id']
+        second = self.fetch('/trace').headers['Request-Id']
+        self.assertEqual(first[:-1], second[:-1])
+        self.assertNotEqual(first, second)
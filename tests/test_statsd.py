@@ -0,0 +1,206 @@
+import errno
+import socket
+
+from tornado import gen, testing, web
+
+import divak.statsd
+import divak.tracing
+import tests.application
+
+
+class SimpleHandler(web.RequestHandler):
+
+    def get(self):
+        self.write('hi')
+
+
+class BlockingSocket(object):
+    """Socket proxy that reports EAGAIN for the first `blocked` sends."""
+
+    def __init__(self, sock, blocked):
+        self.sock = sock
+        self.blocked = blocked
+
+    def send(self, data):
+        if self.blocked:
+            self.blocked -= 1
+            raise socket.error(errno.EAGAIN, 'would block')
+        return self.sock.send(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+def create_span(route='/orders', status=200, duration=0.25):
+    span = divak.tracing.Span(1000.0)
+    span.finish = span.start + duration
+    span.service = 'orders'
+    span.route = route
+    span.method = 'GET'
+    span.status = status
+    return span
+
+
+class StatsdReporterTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(StatsdReporterTests, self).setUp()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(1.0)
+        self.reporters = []
+
+    def tearDown(self):
+        for reporter in self.reporters:
+            reporter.close()
+        self.listener.close()
+        super(StatsdReporterTests, self).tearDown()
+
+    def create_reporter(self, **kwargs):
+        kwargs.setdefault('flush_interval', 60.0)
+        reporter = divak.statsd.StatsdReporter(
+            port=self.listener.getsockname()[1], **kwargs)
+        self.reporters.append(reporter)
+        return reporter
+
+    def receive(self, count=1):
+        return [self.listener.recv(65536) for _ in range(count)]
+
+    def receive_lines(self, count=1):
+        return [line for datagram in self.receive(count)
+                for line in datagram.decode('utf-8').split('\n')]
+
+    def test_that_spans_are_aggregated_until_flush(self):
+        reporter = self.create_reporter()
+        reporter.report([create_span(), create_span(duration=0.5)])
+        reporter.report([create_span(status=503)])
+        self.listener.setblocking(False)
+        self.assertRaises(socket.error, self.listener.recv, 65536)
+        self.listener.settimeout(1.0)
+
+        reporter.flush()
+        lines = self.receive_lines()
+        tags = '|#service:orders,route:/orders,method:GET,status:{}'
+        self.assertIn('requests:2|c' + tags.format('2xx'), lines)
+        self.assertIn('requests:1|c' + tags.format('5xx'), lines)
+        tags = '|#service:orders,route:/orders,status:2xx'
+        self.assertIn('request.duration.count:2|c' + tags, lines)
+        self.assertIn('request.duration.mean:375|g' + tags, lines)
+        self.assertIn('request.duration.max:500|g' + tags, lines)
+        self.assertTrue(any(line.startswith('request.duration.p99:')
+                            for line in lines))
+
+    def test_that_flush_resets_aggregates(self):
+        reporter = self.create_reporter()
+        reporter.increment('hits')
+        reporter.flush()
+        self.assertEqual(self.receive_lines(), ['hits:1|c'])
+        reporter.flush()
+        reporter.increment('hits', 2)
+        reporter.flush()
+        self.assertEqual(self.receive_lines(), ['hits:2|c'])
+
+    def test_that_lines_are_packed_into_datagrams(self):
+        reporter = self.create_reporter(mtu=64)
+        for index in range(20):
+            reporter.increment('counter.{:02d}'.format(index), 1000)
+        reporter.flush()
+
+        datagrams = self.receive(7)
+        for datagram in datagrams:
+            self.assertLessEqual(len(datagram), 64)
+        lines = [line for datagram in datagrams
+                 for line in datagram.split(b'\n')]
+        self.assertEqual(sorted(lines),
+                         ['counter.{:02d}:1000|c'.format(index).encode()
+                          for index in range(20)])
+
+    def test_that_tags_are_folded_into_names(self):
+        reporter = self.create_reporter(prefix='app.', dogstatsd=False)
+        reporter.gauge('queue', 1.5, (('route', '/orders/(\\d+)'),))
+        reporter.timing('query', 0.002, (('table', 'orders'),))
+        reporter.flush()
+        lines = self.receive_lines()
+        self.assertIn('app.queue._orders___d__:1.5|g', lines)
+        self.assertIn('app.query.count.orders:1|c', lines)
+        self.assertIn('app.query.max.orders:2|g', lines)
+
+    def test_that_child_spans_are_reported(self):
+        span = create_span()
+        child = divak.tracing.ClientSpan('POST', 'http://example.com', 10.0)
+        child.finish = child.start + 0.1
+        child.status = 404
+        span.add_child(child)
+        reporter = self.create_reporter()
+        reporter.report([span])
+        reporter.flush()
+        lines = self.receive_lines()
+        tags = '|#service:orders,method:POST,status:4xx'
+        self.assertIn('outbound.requests:1|c' + tags, lines)
+        self.assertIn('outbound.duration.count:1|c' + tags, lines)
+
+    @testing.gen_test
+    def test_that_blocked_socket_is_drained_by_ioloop(self):
+        reporter = self.create_reporter(mtu=16)
+        reporter.start()
+        reporter._socket = BlockingSocket(reporter._socket, 1)
+        reporter.increment('first')
+        reporter.increment('second')
+        reporter.flush()
+        self.assertTrue(reporter._waiting)
+        self.assertEqual(len(reporter._pending), 2)
+
+        yield gen.sleep(0.05)
+        self.assertFalse(reporter._waiting)
+        self.assertEqual(sorted(self.receive(2)),
+                         [b'first:1|c', b'second:1|c'])
+
+    @testing.gen_test
+    def test_that_pending_datagrams_are_bounded(self):
+        reporter = self.create_reporter(mtu=16, max_pending=1)
+        reporter.start()
+        reporter._socket = BlockingSocket(reporter._socket, 1)
+        reporter.increment('first')
+        reporter.increment('second')
+        reporter.flush()
+        self.assertEqual(reporter.dropped, 1)
+
+        yield gen.sleep(0.05)
+        self.assertEqual(len(reporter._pending), 0)
+        self.assertEqual(len(self.receive()), 1)
+
+
+class RecorderStatsdTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(1.0)
+        super(RecorderStatsdTests, self).setUp()
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/hello', SimpleHandler)], divak_report_interval=0.01)
+        app.set_divak_service('frontend')
+        self.reporter = divak.statsd.StatsdReporter(
+            port=self.listener.getsockname()[1], flush_interval=60.0)
+        app.add_divak_reporter(self.reporter)
+        return app
+
+    def tearDown(self):
+        self.io_loop.run_sync(self._app.stop_divak)
+        self.reporter.close()
+        self.listener.close()
+        super(RecorderStatsdTests, self).tearDown()
+
+    def test_that_requests_are_sent_to_agent(self):
+        self.fetch('/hello')
+        self.fetch('/hello')
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+        self.reporter.flush()
+        lines = self.listener.recv(65536).decode('utf-8').split('\n')
+        self.assertIn('requests:2|c|#service:frontend,route:/hello,'
+                      'method:GET,status:2xx', lines)
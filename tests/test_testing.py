@@ -0,0 +1,113 @@
+import logging
+import unittest
+
+from tornado import testing
+
+import divak.api
+import divak.testing
+import tests.application
+
+
+def create_record(name='tests.logger', request_id=None, message='message'):
+    record = logging.LogRecord(name, logging.INFO, __file__, 1, message,
+                               (), None)
+    record.divak_request_id = request_id
+    return record
+
+
+class RingBufferLogHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(RingBufferLogHandlerTests, self).setUp()
+        self.handler = divak.testing.RingBufferLogHandler(3)
+
+    def test_that_capacity_is_enforced(self):
+        records = [create_record(message=str(n)) for n in range(5)]
+        for record in records:
+            self.handler.handle(record)
+        self.assertEqual(list(self.handler.records), records[2:])
+        self.assertEqual(self.handler.discarded, 2)
+
+    def test_that_capacity_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            divak.testing.RingBufferLogHandler(0)
+
+    def test_that_records_are_indexed_by_request(self):
+        first = create_record(request_id='one')
+        second = create_record(request_id='two')
+        third = create_record(request_id='one')
+        unidentified = create_record(request_id='')
+        for record in (first, second, third, unidentified):
+            self.handler.handle(record)
+
+        self.assertEqual(self.handler.records_for_request('one'), [third])
+        self.assertEqual(self.handler.records_for_request('two'), [second])
+        self.assertEqual(self.handler.records_for_request(''), [])
+
+        self.handler.handle(create_record(request_id='three'))
+        self.assertEqual(self.handler.records_for_request('two'), [])
+        self.assertNotIn('two', self.handler._by_request)
+
+    def test_that_records_are_indexed_by_logger(self):
+        first = create_record('first')
+        second = create_record('second')
+        self.handler.handle(first)
+        self.handler.handle(second)
+        self.handler.handle(create_record('first.child'))
+        self.assertEqual(self.handler.records_for_logger('first'), [first])
+        self.assertEqual(self.handler.records_for_logger('second'), [second])
+
+        self.handler.clear()
+        self.assertEqual(len(self.handler.records), 0)
+        self.assertEqual(self.handler.records_for_logger('first'), [])
+
+
+class GenerateLoadTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(GenerateLoadTests, self).setUp()
+        self.application = tests.application.Application()
+        self.application.add_divak_propagator(
+            divak.api.RequestIdPropagator())
+        self.handler = divak.testing.RingBufferLogHandler(50)
+        self.logger = logging.getLogger('tests.application.TracedHandler')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+        super(GenerateLoadTests, self).tearDown()
+
+    @testing.gen_test(timeout=30)
+    def test_that_requests_are_sent_concurrently(self):
+        result = yield divak.testing.generate_load(
+            self.application, '/trace', requests=100, concurrency=5)
+        self.assertEqual(result.requests, 100)
+        self.assertEqual(dict(result.statuses), {200: 100})
+        self.assertEqual(result.errors, 0)
+        self.assertGreater(result.throughput, 0.0)
+        self.assertLessEqual(result.percentile(0.5),
+                             result.percentile(0.99))
+        self.assertEqual(result.percentile(1.0), result.latencies[-1])
+        self.assertIn('100 requests', repr(result))
+
+        self.assertEqual(len(self.handler.records), 50)
+        self.assertEqual(self.handler.discarded, 50)
+        record = self.handler.records[-1]
+        self.assertEqual(
+            self.handler.records_for_request(record.divak_request_id),
+            [record])
+
+    @testing.gen_test(timeout=30)
+    def test_that_errors_are_counted(self):
+        result = yield divak.testing.generate_load(
+            self.application, '/trace?status=503', requests=10,
+            concurrency=20, method='GET')
+        self.assertEqual(result.requests, 10)
+        self.assertEqual(result.errors, 10)
+
+    def test_that_empty_result_is_handled(self):
+        result = divak.testing.LoadResult(0.0, [], {})
+        self.assertIsNone(result.percentile(0.5))
+        self.assertEqual(result.throughput, 0.0)
@@ -0,0 +1,489 @@
+import logging
+import unittest
+
+from tornado import gen, httputil, testing, web
+import mock
+import tornado
+
+try:
+    import asyncio
+except ImportError:  # pragma: no cover -- python 2
+    asyncio = None
+
+import divak.api
+import divak.internals
+import divak.tracing
+import tests.application
+
+# asyncio futures can only be awaited when the IOLoop runs on asyncio
+ASYNCIO_LOOP = asyncio is not None and tornado.version_info >= (5, 0)
+
+
+class SpanTests(testing.AsyncHTTPTestCase):
+
+    class SpanCapturingHandler(divak.api.Logger, web.RequestHandler):
+
+        def get(self):
+            self.application.spans.append(self.request.divak_span)
+            self.write('chunk one')
+            self.flush()
+            self.finish('chunk two')
+
+    class PlainHandler(web.RequestHandler):
+
+        def get(self):
+            self.application.spans.append(self.request.divak_span)
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/capture', SpanTests.SpanCapturingHandler),
+             web.url('/plain', SpanTests.PlainHandler)])
+        app.spans = []
+        return app
+
+    def test_that_phases_are_recorded_in_order(self):
+        self.fetch('/capture')
+        span = self._app.spans[0]
+        self.assertLessEqual(span.start, span.prepare_start)
+        self.assertLessEqual(span.prepare_start, span.prepare_end)
+        self.assertLessEqual(span.prepare_end, span.first_byte)
+        self.assertLessEqual(span.first_byte, span.finish)
+        self.assertGreaterEqual(span.duration, 0.0)
+
+    def test_that_prepare_is_not_recorded_without_logger(self):
+        self.fetch('/plain')
+        span = self._app.spans[0]
+        self.assertIsNone(span.prepare_start)
+        self.assertIsNone(span.prepare_end)
+        self.assertIsNotNone(span.first_byte)
+
+    def test_that_unfinished_span_has_no_duration(self):
+        span = divak.tracing.Span(divak.tracing.monotonic())
+        self.assertIsNone(span.duration)
+        self.assertIn('Span', repr(span))
+
+
+class CoroutinePrepareHandler(web.RequestHandler):
+
+    @gen.coroutine
+    def prepare(self):
+        yield gen.sleep(0.01)
+        self.prepared = True
+
+
+class NativePrepareHandler(web.RequestHandler):
+
+    def prepare(self):
+        self.prepared = True
+        return asyncio.sleep(0.01)
+
+
+class LoggerPrepareTests(testing.AsyncHTTPTestCase):
+
+    class SynchronousHandler(divak.api.Logger, web.RequestHandler):
+
+        def get(self):
+            self.application.spans.append(self.request.divak_span)
+
+    class CoroutineHandler(divak.api.Logger, CoroutinePrepareHandler):
+
+        def get(self):
+            self.application.spans.append(self.request.divak_span)
+            self.write({'prepared': self.prepared})
+
+    class NativeHandler(divak.api.Logger, NativePrepareHandler):
+
+        def get(self):
+            self.application.spans.append(self.request.divak_span)
+            self.write({'prepared': self.prepared})
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/sync', LoggerPrepareTests.SynchronousHandler),
+             web.url('/coroutine', LoggerPrepareTests.CoroutineHandler),
+             web.url('/native', LoggerPrepareTests.NativeHandler)])
+        app.spans = []
+        return app
+
+    def test_that_synchronous_prepare_returns_none(self):
+        request = httputil.HTTPServerRequest(uri='/', connection=mock.Mock())
+        handler = LoggerPrepareTests.SynchronousHandler(self._app, request)
+        self.assertIsNone(handler.prepare())
+        self.assertEqual(handler.logger.name,
+                         'tests.test_tracing.SynchronousHandler')
+
+    @unittest.skipUnless(divak.internals.ACTIVE_REQUEST_SUPPORTED,
+                         'active request is not propagated')
+    def test_that_logger_is_not_wrapped(self):
+        request = httputil.HTTPServerRequest(uri='/', connection=mock.Mock())
+        handler = LoggerPrepareTests.SynchronousHandler(self._app, request)
+        handler.prepare()
+        self.assertIs(handler.logger, logging.getLogger(
+            'tests.test_tracing.SynchronousHandler'))
+
+    def test_that_synchronous_prepare_is_recorded(self):
+        self.fetch('/sync')
+        span = self._app.spans[0]
+        self.assertLessEqual(span.prepare_start, span.prepare_end)
+
+    def test_that_coroutine_super_prepare_is_awaited(self):
+        response = self.fetch('/coroutine')
+        self.assertEqual(response.body, b'{"prepared": true}')
+        span = self._app.spans[0]
+        self.assertGreaterEqual(span.prepare_end - span.prepare_start, 0.01)
+
+    @unittest.skipUnless(ASYNCIO_LOOP, 'IOLoop does not run on asyncio')
+    def test_that_native_super_prepare_is_awaited(self):
+        response = self.fetch('/native')
+        self.assertEqual(response.body, b'{"prepared": true}')
+        span = self._app.spans[0]
+        self.assertGreaterEqual(span.prepare_end - span.prepare_start, 0.01)
+
+
+class ProbabilisticSamplerTests(unittest.TestCase):
+
+    def test_that_extremes_are_honored(self):
+        request = httputil.HTTPServerRequest(uri='/')
+        never = divak.tracing.ProbabilisticSampler(0.0)
+        always = divak.tracing.ProbabilisticSampler(1.0)
+        for _ in range(100):
+            self.assertFalse(never.should_sample(request))
+            self.assertTrue(always.should_sample(request))
+
+    def test_that_probability_is_validated(self):
+        with self.assertRaises(ValueError):
+            divak.tracing.ProbabilisticSampler(1.5)
+
+
+class RateLimitingSamplerTests(unittest.TestCase):
+
+    def test_that_rate_is_enforced(self):
+        request = httputil.HTTPServerRequest(uri='/')
+        with mock.patch('divak.tracing.monotonic') as monotonic:
+            monotonic.return_value = 100.0
+            sampler = divak.tracing.RateLimitingSampler(2)
+            decisions = [sampler.should_sample(request) for _ in range(3)]
+            self.assertEqual(decisions, [True, True, False])
+
+            monotonic.return_value = 100.5
+            decisions = [sampler.should_sample(request) for _ in range(2)]
+            self.assertEqual(decisions, [True, False])
+
+    def test_that_fractional_rate_samples(self):
+        request = httputil.HTTPServerRequest(uri='/')
+        with mock.patch('divak.tracing.monotonic') as monotonic:
+            monotonic.return_value = 100.0
+            sampler = divak.tracing.RateLimitingSampler(0.5)
+            sampler.should_sample(request)
+            self.assertFalse(sampler.should_sample(request))
+
+            monotonic.return_value = 102.0
+            decisions = [sampler.should_sample(request) for _ in range(3)]
+            self.assertEqual(decisions, [True, False, False])
+
+
+class RouteSamplerTests(unittest.TestCase):
+
+    def test_that_first_matching_route_is_used(self):
+        sampler = divak.tracing.RouteSampler(
+            [(r'/status', divak.tracing.ProbabilisticSampler(0.0)),
+             (r'/orders/.*', divak.tracing.ProbabilisticSampler(1.0))],
+            default=divak.tracing.ProbabilisticSampler(0.0))
+        self.assertFalse(sampler.should_sample(
+            httputil.HTTPServerRequest(uri='/status')))
+        self.assertFalse(sampler.should_sample(
+            httputil.HTTPServerRequest(uri='/status/extra')))
+        self.assertTrue(sampler.should_sample(
+            httputil.HTTPServerRequest(uri='/orders/1?q=2')))
+
+    def test_that_unmatched_requests_are_not_sampled_by_default(self):
+        sampler = divak.tracing.RouteSampler([])
+        self.assertFalse(sampler.should_sample(
+            httputil.HTTPServerRequest(uri='/')))
+
+
+class SamplingPropagatorTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.reporter = tests.application.CollectingReporter()
+        self.sampler = mock.Mock()
+        self.sampler.should_sample.return_value = False
+        self.app = tests.application.Application()
+        self.app.add_divak_reporter(self.reporter)
+        self.app.add_divak_propagator(
+            divak.api.SamplingPropagator(self.sampler))
+        return self.app
+
+    def fetch_and_flush(self, *args, **kwargs):
+        response = self.fetch(*args, **kwargs)
+        self.io_loop.run_sync(self.app.stop_divak)
+        return response
+
+    def test_that_unsampled_requests_are_not_reported(self):
+        response = self.fetch_and_flush('/trace')
+        self.assertEqual(response.headers['Trace-Sampled'], '0')
+        self.assertEqual(self.reporter.observations, [])
+
+    def test_that_sampled_requests_are_reported(self):
+        self.sampler.should_sample.return_value = True
+        response = self.fetch_and_flush('/trace')
+        self.assertEqual(response.headers['Trace-Sampled'], '1')
+        self.assertEqual(len(self.reporter.observations), 1)
+
+    def test_that_upstream_decision_is_honored(self):
+        response = self.fetch_and_flush('/trace',
+                                        headers={'Trace-Sampled': 'true'})
+        self.sampler.should_sample.assert_not_called()
+        self.assertEqual(response.headers['Trace-Sampled'], '1')
+        self.assertEqual(len(self.reporter.observations), 1)
+
+    def test_that_invalid_upstream_decision_is_ignored(self):
+        self.sampler.should_sample.return_value = True
+        response = self.fetch_and_flush('/trace',
+                                        headers={'Trace-Sampled': 'maybe'})
+        self.assertEqual(response.headers['Trace-Sampled'], '1')
+
+
+def create_request(**headers):
+    request = httputil.HTTPServerRequest(
+        uri='/', headers=httputil.HTTPHeaders(headers))
+    request.divak_request_id = None
+    request.divak_sampled = True
+    return request
+
+
+class TraceContextPropagatorTests(unittest.TestCase):
+
+    TRACE_ID = '0af7651916cd43dd8448eb211c80319c'
+    PARENT_ID = 'b7ad6b7169203331'
+
+    def setUp(self):
+        super(TraceContextPropagatorTests, self).setUp()
+        self.propagator = divak.api.TraceContextPropagator()
+
+    def test_that_valid_traceparent_is_joined(self):
+        request = create_request(
+            traceparent='00-{}-{}-00'.format(self.TRACE_ID, self.PARENT_ID),
+            tracestate='congo=t61rcWkgMzE')
+        ((name, value),) = self.propagator.process_request(request)
+        self.assertEqual(request.divak_trace_id, self.TRACE_ID)
+        self.assertEqual(request.divak_parent_id, self.PARENT_ID)
+        self.assertEqual(len(request.divak_span_id), 16)
+        self.assertNotEqual(request.divak_span_id, self.PARENT_ID)
+        self.assertIs(request.divak_sampled, False)
+        self.assertEqual(request.divak_request_id, self.TRACE_ID)
+        self.assertEqual(name, 'traceresponse')
+        self.assertEqual(value, '00-{}-{}-00'.format(
+            self.TRACE_ID, request.divak_span_id))
+        self.assertEqual(
+            dict(self.propagator.outbound_headers(request)),
+            {'traceparent': value, 'tracestate': 'congo=t61rcWkgMzE'})
+
+    def test_that_invalid_traceparents_start_new_traces(self):
+        for header in ['00-{}-{}-01-extra'.format(self.TRACE_ID,
+                                                  self.PARENT_ID),
+                       'ff-{}-{}-01'.format(self.TRACE_ID, self.PARENT_ID),
+                       '00-{}-{}-01'.format('0' * 32, self.PARENT_ID),
+                       '00-{}-{}-01'.format(self.TRACE_ID, '0' * 16),
+                       '00-{}-{}-01'.format(self.TRACE_ID.upper(),
+                                            self.PARENT_ID),
+                       'garbage']:
+            request = create_request(traceparent=header)
+            self.propagator.process_request(request)
+            self.assertNotEqual(request.divak_trace_id, self.TRACE_ID)
+            self.assertEqual(len(request.divak_trace_id), 32)
+            self.assertIsNone(request.divak_parent_id)
+
+    def test_that_future_versions_are_accepted(self):
+        request = create_request(traceparent='01-{}-{}-01-more'.format(
+            self.TRACE_ID, self.PARENT_ID))
+        self.propagator.process_request(request)
+        self.assertEqual(request.divak_trace_id, self.TRACE_ID)
+
+    def test_that_sampler_decides_new_traces(self):
+        sampler = mock.Mock()
+        sampler.should_sample.return_value = False
+        propagator = divak.api.TraceContextPropagator(
+            sampler=sampler, write_response=False)
+        request = create_request()
+        self.assertIsNone(propagator.process_request(request))
+        self.assertIs(request.divak_sampled, False)
+        self.assertEqual(propagator.outbound_headers(request),
+                         (('traceparent', '00-{}-{}-00'.format(
+                             request.divak_trace_id,
+                             request.divak_span_id)),))
+
+    def test_that_client_span_is_sent_as_parent(self):
+        request = create_request(
+            traceparent='00-{}-{}-01'.format(self.TRACE_ID, self.PARENT_ID))
+        self.propagator.process_request(request)
+        self.assertEqual(
+            self.propagator.outbound_headers(request, '00f067aa0ba902b7'),
+            (('traceparent', '00-{}-00f067aa0ba902b7-01'.format(
+                self.TRACE_ID)),))
+
+
+class B3PropagatorTests(unittest.TestCase):
+
+    TRACE_ID = '80f198ee56343ba864fe8b2a57d3eff7'
+    SPAN_ID = 'e457b5a2e4d86bd1'
+
+    def test_that_single_header_is_joined(self):
+        propagator = divak.api.B3Propagator(single_header=True)
+        request = create_request(b3='{}-{}-0-05e3ac9a4f6e3b90'.format(
+            self.TRACE_ID, self.SPAN_ID))
+        ((name, value),) = propagator.process_request(request)
+        self.assertEqual(request.divak_trace_id, self.TRACE_ID)
+        self.assertEqual(request.divak_parent_id, self.SPAN_ID)
+        self.assertIs(request.divak_sampled, False)
+        self.assertEqual(name, 'b3')
+        self.assertEqual(value, '{}-{}-0-{}'.format(
+            self.TRACE_ID, request.divak_span_id, self.SPAN_ID))
+
+    def test_that_multiple_headers_are_joined(self):
+        propagator = divak.api.B3Propagator()
+        request = create_request(**{'X-B3-TraceId': self.TRACE_ID[16:],
+                                    'X-B3-SpanId': self.SPAN_ID,
+                                    'X-B3-Flags': '1',
+                                    'X-B3-Sampled': '0'})
+        request.divak_sampled = False
+        headers = dict(propagator.process_request(request))
+        self.assertIs(request.divak_sampled, True)
+        self.assertEqual(headers, {
+            'X-B3-TraceId': self.TRACE_ID[16:],
+            'X-B3-SpanId': request.divak_span_id,
+            'X-B3-ParentSpanId': self.SPAN_ID,
+            'X-B3-Sampled': '1'})
+
+    def test_that_client_span_is_sent_with_request_span_as_parent(self):
+        request = create_request(b3='{}-{}-1'.format(self.TRACE_ID,
+                                                     self.SPAN_ID))
+        for single_header in (True, False):
+            propagator = divak.api.B3Propagator(single_header=single_header)
+            propagator.process_request(request)
+            headers = dict(
+                propagator.outbound_headers(request, '00f067aa0ba902b7'))
+            if single_header:
+                self.assertEqual(headers, {'b3': '{}-00f067aa0ba902b7-1-{}'
+                                           .format(self.TRACE_ID,
+                                                   request.divak_span_id)})
+            else:
+                self.assertEqual(headers, {
+                    'X-B3-TraceId': self.TRACE_ID,
+                    'X-B3-SpanId': '00f067aa0ba902b7',
+                    'X-B3-ParentSpanId': request.divak_span_id,
+                    'X-B3-Sampled': '1'})
+
+    def test_that_decision_only_header_starts_trace(self):
+        propagator = divak.api.B3Propagator(single_header=True)
+        request = create_request(b3='0')
+        ((name, value),) = propagator.process_request(request)
+        self.assertIs(request.divak_sampled, False)
+        self.assertIsNone(request.divak_parent_id)
+        self.assertEqual(value, '{}-{}-0'.format(request.divak_trace_id,
+                                                 request.divak_span_id))
+
+    def test_that_invalid_headers_start_new_traces(self):
+        sampler = mock.Mock()
+        sampler.should_sample.return_value = True
+        propagator = divak.api.B3Propagator(sampler=sampler,
+                                            write_response=False)
+        for headers in [{'b3': 'nonsense'},
+                        {'X-B3-TraceId': 'xyz', 'X-B3-SpanId': self.SPAN_ID},
+                        {'X-B3-TraceId': self.TRACE_ID}]:
+            request = create_request(**headers)
+            self.assertIsNone(propagator.process_request(request))
+            self.assertNotEqual(request.divak_trace_id, self.TRACE_ID)
+            self.assertIsNone(request.divak_parent_id)
+        self.assertEqual(sampler.should_sample.call_count, 3)
+
+
+class TracePropagationTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.reporter = tests.application.CollectingReporter()
+        self.app = tests.application.Application()
+        self.app.add_divak_reporter(self.reporter)
+        self.app.add_divak_propagator(divak.api.TraceContextPropagator())
+        return self.app
+
+    def test_that_trace_is_reported(self):
+        trace_id = TraceContextPropagatorTests.TRACE_ID
+        parent_id = TraceContextPropagatorTests.PARENT_ID
+        response = self.fetch('/trace', headers={
+            'traceparent': '00-{}-{}-01'.format(trace_id, parent_id)})
+        self.io_loop.run_sync(self.app.stop_divak)
+        span = self.reporter.observations[0]
+        self.assertEqual(span.trace_id, trace_id)
+        self.assertEqual(span.parent_id, parent_id)
+        self.assertEqual(span.request_id, trace_id)
+        self.assertEqual(response.headers['traceresponse'],
+                         '00-{}-{}-01'.format(trace_id, span.span_id))
+
+
+def create_span(duration, status=200):
+    span = divak.tracing.Span(100.0)
+    span.finish = 100.0 + duration
+    span.status = status
+    return span
+
+
+class TailSamplerTests(unittest.TestCase):
+
+    def create_sampler(self, **kwargs):
+        kwargs.setdefault('probability', 0.0)
+        kwargs.setdefault('max_per_second', 1000000)
+        kwargs.setdefault('min_samples', 10)
+        return divak.tracing.TailSampler(**kwargs)
+
+    def test_that_errors_are_always_kept(self):
+        sampler = self.create_sampler()
+        failed = create_span(0.001, status=503)
+        child_failed = create_span(0.001)
+        child = divak.tracing.ClientSpan('GET', 'http://x/', 100.0)
+        child.status = 599
+        child_failed.add_child(child)
+        kept = sampler.filter([create_span(0.001), failed, child_failed])
+        self.assertEqual(kept, [failed, child_failed])
+
+    def test_that_slow_spans_are_kept(self):
+        sampler = self.create_sampler(percentile=0.9)
+        self.assertEqual(sampler.filter([create_span(0.01 * (n + 1))
+                                         for n in range(100)]), [])
+        self.assertIsNotNone(sampler.threshold)
+        slow = create_span(1.0)
+        self.assertEqual(sampler.filter([create_span(0.01), slow]), [slow])
+
+    def test_that_random_fraction_is_kept(self):
+        sampler = self.create_sampler(probability=1.0)
+        spans = [create_span(0.01) for _ in range(5)]
+        self.assertEqual(sampler.filter(spans), spans)
+
+    def test_that_budget_is_enforced(self):
+        sampler = self.create_sampler(probability=1.0, max_per_second=2)
+        kept = sampler.filter([create_span(0.01) for _ in range(5)])
+        self.assertEqual(len(kept), 2)
+        self.assertEqual(sampler.dropped, 3)
+
+    def test_that_fractional_budget_keeps_spans(self):
+        with mock.patch('divak.tracing.monotonic') as monotonic:
+            monotonic.return_value = 100.0
+            sampler = self.create_sampler(probability=1.0,
+                                          max_per_second=0.5)
+            sampler.filter([create_span(0.01)])
+            monotonic.return_value = 102.0
+            kept = sampler.filter([create_span(0.01) for _ in range(3)])
+        self.assertEqual(len(kept), 1)
+
+    def test_that_sketch_decays(self):
+        sampler = self.create_sampler(decay_after=10)
+        sampler.filter([create_span(0.01) for _ in range(10)])
+        self.assertEqual(sampler._sketch.count, 5)
+
+    def test_that_unfinished_spans_are_ignored(self):
+        sampler = self.create_sampler(probability=1.0)
+        self.assertEqual(sampler.filter([divak.tracing.Span(1.0)]), [])
+
+    def test_that_percentile_is_validated(self):
+        with self.assertRaises(ValueError):
+            divak.tracing.TailSampler(percentile=1.0)
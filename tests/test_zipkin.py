@@ -0,0 +1,342 @@
+import json
+import os
+import shutil
+import tempfile
+
+from tornado import gen, httpclient, httpserver, testing, web
+
+import divak.api
+import divak.reporting
+import divak.tracing
+import divak.zipkin
+import tests.application
+
+
+class CollectorHandler(web.RequestHandler):
+
+    def initialize(self, collector):
+        self.collector = collector
+
+    def post(self):
+        self.collector.requests += 1
+        if self.collector.failures:
+            status = self.collector.failures.pop(0)
+            if status is not None:
+                self.set_status(status)
+                return
+        self.collector.batches.append(json.loads(self.request.body))
+        self.set_status(202)
+
+
+class Collector(object):
+    """Stand-in for a Zipkin collector that records each POST."""
+
+    def __init__(self):
+        self.batches = []
+        self.failures = []
+        self.requests = 0
+
+    @property
+    def spans(self):
+        return [span for batch in self.batches for span in batch]
+
+
+class SimpleHandler(web.RequestHandler):
+
+    def get(self):
+        self.write('hi')
+
+
+def create_span(index=0, **kwargs):
+    span = divak.tracing.Span(100.0 + index)
+    span.finish = span.start + 0.25
+    span.service = 'orders'
+    span.route = '/orders/(\\d+)'
+    span.method = 'GET'
+    span.uri = '/orders/{}?expand=true'.format(index)
+    span.request_id = 'request-{}'.format(index)
+    span.status = 200
+    for name, value in kwargs.items():
+        setattr(span, name, value)
+    return span
+
+
+class CollectorMixin(object):
+
+    def start_collector(self):
+        self.collector = Collector()
+        sock, self.collector_port = testing.bind_unused_port()
+        self.collector_server = httpserver.HTTPServer(web.Application(
+            [web.url('/api/v2/spans', CollectorHandler,
+                     {'collector': self.collector})]))
+        self.collector_server.add_sockets([sock])
+
+    def stop_collector(self):
+        self.collector_server.stop()
+
+    def create_reporter(self, **kwargs):
+        kwargs.setdefault('backoff', 0.001)
+        reporter = divak.zipkin.ZipkinReporter(
+            url='http://127.0.0.1:{}/api/v2/spans'.format(
+                self.collector_port), **kwargs)
+        self.addCleanup(reporter.close)
+        return reporter
+
+    @gen.coroutine
+    def wait_for(self, condition, timeout=5.0):
+        deadline = self.io_loop.time() + timeout
+        while not condition() and self.io_loop.time() < deadline:
+            yield gen.sleep(0.01)
+
+
+class ZipkinReporterTests(CollectorMixin, testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ZipkinReporterTests, self).setUp()
+        self.start_collector()
+
+    def tearDown(self):
+        self.stop_collector()
+        super(ZipkinReporterTests, self).tearDown()
+
+    @testing.gen_test
+    def test_that_spans_are_sent_in_zipkin_format(self):
+        reporter = self.create_reporter()
+        reporter.report([
+            create_span(trace_id='0af7651916cd43dd8448eb211c80319c',
+                        span_id='b7ad6b7169203331',
+                        parent_id='00f067aa0ba902b7'),
+            create_span(1, status=503)])
+        yield self.wait_for(lambda: reporter.sent == 2)
+
+        self.assertEqual(len(self.collector.batches), 1)
+        first, second = self.collector.spans
+        self.assertEqual(first['traceId'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertEqual(first['id'], 'b7ad6b7169203331')
+        self.assertEqual(first['parentId'], '00f067aa0ba902b7')
+        self.assertEqual(first['kind'], 'SERVER')
+        self.assertEqual(first['name'], 'get /orders/(\\d+)')
+        self.assertEqual(first['duration'], 250000)
+        self.assertEqual(first['localEndpoint'], {'serviceName': 'orders'})
+        self.assertEqual(first['tags'], {
+            'http.method': 'GET', 'http.route': '/orders/(\\d+)',
+            'http.path': '/orders/0', 'http.status_code': '200',
+            'divak.request_id': 'request-0'})
+
+        self.assertEqual(len(second['traceId']), 32)
+        self.assertEqual(len(second['id']), 16)
+        self.assertNotIn('parentId', second)
+        self.assertEqual(second['tags']['error'], '503')
+        self.assertEqual(second['timestamp'] - first['timestamp'], 1000000)
+
+    @testing.gen_test
+    def test_that_child_spans_are_sent(self):
+        span = create_span()
+        child = divak.tracing.ClientSpan('POST', 'http://example.com/"x"',
+                                         span.start + 0.1, '00f067aa0ba902b7')
+        child.finish = child.start + 0.1
+        child.status = 599
+        span.add_child(child)
+        unfinished = divak.tracing.ClientSpan('GET', 'http://example.com',
+                                              span.start)
+        span.add_child(unfinished)
+        reporter = self.create_reporter()
+        reporter.report([span, create_span(1, finish=None)])
+        yield self.wait_for(lambda: reporter.sent == 2)
+
+        server, client = self.collector.spans
+        self.assertEqual(client['kind'], 'CLIENT')
+        self.assertEqual(client['traceId'], server['traceId'])
+        self.assertEqual(client['id'], '00f067aa0ba902b7')
+        self.assertEqual(client['parentId'], server['id'])
+        self.assertEqual(client['name'], 'post')
+        self.assertEqual(client['duration'], 100000)
+        self.assertEqual(client['tags'], {
+            'http.method': 'POST', 'http.url': 'http://example.com/"x"',
+            'http.status_code': '599', 'error': '599'})
+
+    @testing.gen_test
+    def test_that_large_batches_are_split(self):
+        reporter = self.create_reporter(max_spans=2)
+        reporter.report([create_span(index) for index in range(5)])
+        yield self.wait_for(lambda: reporter.sent == 5)
+        self.assertEqual(sorted(len(batch)
+                                for batch in self.collector.batches),
+                         [1, 2, 2])
+
+    @testing.gen_test
+    def test_that_failed_requests_are_retried(self):
+        self.collector.failures = [503, 429]
+        reporter = self.create_reporter()
+        reporter.report([create_span()])
+        yield self.wait_for(lambda: reporter.sent == 1)
+        self.assertEqual(self.collector.requests, 3)
+        self.assertEqual(reporter.dropped, 0)
+
+    @testing.gen_test
+    def test_that_retries_are_limited(self):
+        self.collector.failures = [500, 500, 500]
+        reporter = self.create_reporter(max_retries=1)
+        reporter.report([create_span()])
+        yield self.wait_for(lambda: reporter.dropped == 1)
+        self.assertEqual(self.collector.requests, 2)
+        self.assertEqual(reporter.sent, 0)
+
+    @testing.gen_test
+    def test_that_client_errors_are_not_retried(self):
+        self.collector.failures = [400]
+        reporter = self.create_reporter()
+        reporter.report([create_span()])
+        yield self.wait_for(lambda: reporter.dropped == 1)
+        self.assertEqual(self.collector.requests, 1)
+
+    @testing.gen_test
+    def test_that_connection_failures_are_retried(self):
+        sock, port = testing.bind_unused_port()
+        sock.close()
+        reporter = divak.zipkin.ZipkinReporter(
+            url='http://127.0.0.1:{}/'.format(port), backoff=0.001,
+            max_retries=2)
+        self.addCleanup(reporter.close)
+        reporter.report([create_span(), create_span(1)])
+        yield self.wait_for(lambda: reporter.dropped == 2)
+        self.assertEqual(reporter.sent, 0)
+
+    @testing.gen_test
+    def test_that_pending_requests_are_bounded(self):
+        reporter = self.create_reporter(max_connections=1, max_pending=1)
+        reporter.report([create_span(0)])
+        reporter.report([create_span(1), create_span(2)])
+        reporter.report([create_span(3)])
+        self.assertEqual(reporter.dropped, 2)
+        yield self.wait_for(lambda: reporter.sent == 2)
+        self.assertEqual([span['tags']['divak.request_id']
+                          for span in self.collector.spans],
+                         ['request-0', 'request-3'])
+
+
+class SpoolingZipkinTests(CollectorMixin, testing.AsyncTestCase):
+
+    def setUp(self):
+        super(SpoolingZipkinTests, self).setUp()
+        self.start_collector()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.stop_collector()
+        super(SpoolingZipkinTests, self).tearDown()
+
+    @testing.gen_test
+    def test_that_failures_are_raised(self):
+        self.collector.failures = [503, 503]
+        reporter = self.create_reporter(raise_errors=True, max_retries=1)
+        with self.assertRaises(httpclient.HTTPError):
+            yield reporter.report([create_span()])
+        self.assertEqual(reporter.dropped, 0)
+
+        yield reporter.report([create_span(1)])
+        self.assertEqual(reporter.sent, 1)
+
+    @testing.gen_test
+    def test_that_undelivered_spans_are_raised(self):
+        self.collector.failures = [None, 503]
+        reporter = self.create_reporter(raise_errors=True, max_retries=0,
+                                        max_spans=1)
+        spans = [create_span(index) for index in range(3)]
+        with self.assertRaises(divak.reporting.PartialReportError) as context:
+            yield reporter.report(spans)
+        self.assertEqual(context.exception.observations, spans[1:])
+        self.assertIsInstance(context.exception.error, httpclient.HTTPError)
+        self.assertEqual(self.collector.requests, 2)
+        self.assertEqual(reporter.sent, 1)
+
+    @testing.gen_test
+    def test_that_children_are_sent_with_their_span(self):
+        span = create_span()
+        for _ in range(2):
+            child = divak.tracing.ClientSpan('GET', 'http://x/', span.start)
+            child.finish = child.start + 0.1
+            span.add_child(child)
+        reporter = self.create_reporter(raise_errors=True, max_spans=2)
+        yield reporter.report([create_span(1), span, create_span(2)])
+        self.assertEqual([len(batch) for batch in self.collector.batches],
+                         [1, 3, 1])
+
+    @testing.gen_test
+    def test_that_client_errors_are_dropped(self):
+        self.collector.failures = [400]
+        reporter = self.create_reporter(raise_errors=True)
+        yield reporter.report([create_span()])
+        self.assertEqual(reporter.dropped, 1)
+
+    @testing.gen_test
+    def test_that_outage_is_spooled(self):
+        self.collector.failures = [503, 503]
+        spooler = divak.reporting.SpoolingReporter(
+            self.create_reporter(raise_errors=True, max_retries=0),
+            os.path.join(self.directory, 'spool'), size=64 * 1024,
+            replay_rate=1000.0, retry_interval=0.01)
+        self.addCleanup(spooler.close)
+        yield spooler.report([create_span(0)])
+        yield spooler.report([create_span(1)])
+        self.assertEqual(spooler.spool.count, 2)
+
+        yield self.wait_for(lambda: not spooler.spool.count)
+        self.assertEqual(spooler.spool.count, 0)
+        self.assertEqual(sorted(span['tags']['divak.request_id']
+                                for span in self.collector.spans),
+                         ['request-0', 'request-1'])
+
+    @testing.gen_test
+    def test_that_delivered_spans_are_not_spooled(self):
+        self.collector.failures = [None, 503]
+        spooler = divak.reporting.SpoolingReporter(
+            self.create_reporter(raise_errors=True, max_retries=0,
+                                 max_spans=1),
+            os.path.join(self.directory, 'spool'), size=64 * 1024,
+            replay_rate=1000.0, retry_interval=0.01)
+        self.addCleanup(spooler.close)
+        yield spooler.report([create_span(index) for index in range(3)])
+        self.assertEqual(spooler.spool.count, 1)
+
+        yield self.wait_for(lambda: not spooler.spool.count)
+        self.assertEqual(sorted(span['tags']['divak.request_id']
+                                for span in self.collector.spans),
+                         ['request-0', 'request-1', 'request-2'])
+
+
+class RecorderZipkinTests(CollectorMixin, testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(RecorderZipkinTests, self).setUp()
+        self.start_collector()
+        self.reporter = self.create_reporter()
+        self._app.add_divak_reporter(self.reporter)
+
+    def get_app(self):
+        app = tests.application.Application(
+            [web.url('/hello', SimpleHandler)], divak_report_interval=0.01)
+        app.set_divak_service('frontend')
+        app.add_divak_propagator(divak.api.TraceContextPropagator())
+        return app
+
+    def tearDown(self):
+        self.io_loop.run_sync(self._app.stop_divak)
+        self.stop_collector()
+        super(RecorderZipkinTests, self).tearDown()
+
+    def test_that_requests_are_sent_to_collector(self):
+        response = self.fetch('/hello', headers={
+            'traceparent':
+            '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'})
+        self.assertEqual(response.code, 200)
+        self.io_loop.run_sync(
+            lambda: self.wait_for(lambda: self.reporter.sent == 1))
+
+        span, = self.collector.spans
+        self.assertEqual(span['traceId'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertEqual(span['parentId'], 'b7ad6b7169203331')
+        self.assertEqual(span['name'], 'get /hello')
+        self.assertEqual(span['localEndpoint'], {'serviceName': 'frontend'})
+        self.assertEqual(span['tags']['http.status_code'], '200')